@@ -0,0 +1,76 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+Helpers for the *bench management commands, which write their
+results as JSON so they can be compared between releases.
+'''
+import json
+from timeit import default_timer
+
+
+__all__ = ('measure_sized', 'per_second', 'percentile', 'summarize',
+           'timed', 'write_json')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def per_second(count, elapsed):
+    return elapsed and count / elapsed or None
+
+
+def timed(func, iterations):
+    '''
+    Call func() iterations times and return the latencies in seconds.
+    '''
+    latencies = []
+    for i in range(iterations):
+        t0 = default_timer()
+        func()
+        latencies.append(default_timer() - t0)
+    return latencies
+
+
+def summarize(case, latencies, elapsed, **extra):
+    '''
+    Return the result of a case: the number of calls, the seconds
+    they took and the p50/p99 latencies, and the extra items.
+    '''
+    latencies.sort()
+    ret = {
+        'case': case,
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+    }
+    ret.update(extra)
+    return ret
+
+
+def measure_sized(case, size, func, iterations):
+    '''
+    Time func() on an input of size characters and return the result
+    with the characters per second.
+    '''
+    latencies = timed(func, iterations)
+    elapsed = sum(latencies)
+    return summarize(case, latencies, elapsed, size=size,
+                     chars_per_second=per_second(size * len(latencies),
+                                                 elapsed))
+
+
+def write_json(stdout, data, output=None):
+    '''
+    Write the results to the output file, or to stdout if there is
+    none.
+    '''
+    data = json.dumps(data, indent=2, separators=(',', ': '),
+                      sort_keys=True)
+    if output:
+        with open(output, 'w') as file_:
+            file_.write(data + '\n')
+    else:
+        stdout.write(data)
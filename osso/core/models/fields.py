@@ -370,6 +370,11 @@ class PhoneNumberField(models.Field):
         defaults.update(kwargs)
         return super(PhoneNumberField, self).formfield(**defaults)
 
+    def format_number(self, value):
+        # The sqlite backend converts decimals through this.
+        from django.db.backends.utils import format_number
+        return format_number(value, self.max_digits, self.decimal_places)
+
     def from_db_value(self, value, expression, connection, context):
         return self.to_python(value)
 
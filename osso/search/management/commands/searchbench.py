@@ -0,0 +1,128 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+import random
+
+from django import VERSION as django_version
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.core.management.bench import measure_sized, write_json
+from osso.search.utils import (KEYWORD_LENGTH, KEYWORD_REGEXP, SearchField,
+                               count_keywords, get_keywords,
+                               get_object_postings)
+
+
+SIZES = (100, 10000, 1000000)
+# The naive count is quadratic, don't wait for it on huge texts.
+NAIVE_MAX_SIZE = 100000
+
+
+def make_text(size, vocabulary=5000, seed=1):
+    '''
+    Return a text of about size characters of words from a vocabulary
+    of the given size, like a long note or description.
+    '''
+    rand = random.Random(seed)
+    letters = u'abcdefghijklmnopqrstuvwxyz\xe9\xeb'
+    words = [u''.join(rand.choice(letters)
+                      for j in range(rand.randint(1, 12)))
+             for i in range(vocabulary)]
+    ret = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        ret.append(word)
+        length += len(word) + 1
+    return u' '.join(ret)[:size]
+
+
+def naive_count(text):
+    '''
+    The tokenizing of old: count every distinct keyword in the list.
+    '''
+    keywords = [i.lower() for i in KEYWORD_REGEXP.findall(text)
+                if len(i) >= 2]
+    return dict((i, keywords.count(i)) for i in set(keywords)
+                if len(i) <= KEYWORD_LENGTH)
+
+
+class Object(object):
+    def __init__(self, text):
+        self.text = text
+
+    def _get_search_fields(self):
+        return [SearchField(self.text, weight=2)]
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Benchmark the osso.search tokenizer on texts of increasing size.
+
+    Measures get_keywords, count_keywords (with and without accent
+    folding and stopwords) and get_object_postings, and the naive
+    list.count() tokenizing for comparison on the smaller texts. The
+    results are written as JSON, so they can be compared between
+    releases.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--iterations', action='store', type='int', default=10,
+                help='Calls per case (default 10)'),
+            optparse.make_option(
+                '--size', action='append', type='int', default=None,
+                help='Text size in characters, may be repeated '
+                     '(default 100, 10000 and 1000000)'),
+            optparse.make_option(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                '--iterations', action='store', type=int, default=10,
+                help='Calls per case (default 10)')
+            parser.add_argument(
+                '--size', action='append', type=int, default=None,
+                help='Text size in characters, may be repeated\n'
+                     '(default 100, 10000 and 1000000)')
+            parser.add_argument(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout')
+
+    def handle(self, *args, **kwargs):
+        self.iterations = int(kwargs.get('iterations') or 10)
+        sizes = kwargs.get('size') or SIZES
+        if self.iterations < 1 or min(sizes) < 1:
+            raise CommandError('Need positive iterations and sizes')
+
+        results = []
+        for size in sizes:
+            text = make_text(size)
+            stopwords = frozenset(text.split()[:100])
+            cases = [
+                ('get_keywords', lambda: get_keywords(text, accents=False)),
+                ('count_keywords',
+                 lambda: count_keywords(text, accents=False)),
+                ('count_keywords_folded',
+                 lambda: count_keywords(text, accents=True)),
+                ('count_keywords_stopwords',
+                 lambda: count_keywords(text, accents=False,
+                                        stopwords=stopwords)),
+                ('get_object_postings',
+                 lambda: get_object_postings(Object(text))),
+            ]
+            if size <= NAIVE_MAX_SIZE:
+                cases.append(('naive_count', lambda: naive_count(text)))
+            for case, func in cases:
+                results.append(measure_sized(
+                    case, size, func, self.iterations))
+
+        data = {
+            'iterations': self.iterations,
+            'results': results,
+        }
+        write_json(self.stdout, data, kwargs.get('output'))
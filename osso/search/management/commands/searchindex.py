@@ -0,0 +1,100 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+
+from django import VERSION as django_version
+try:
+    from django.apps import apps
+    get_model, get_models = apps.get_model, apps.get_models
+except ImportError:
+    from django.db.models import get_model, get_models
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.search.typeahead import save_keyword_index
+from osso.search.utils import drain_index_queue, index_queryset
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Rebuild the search index for the given models, or for all
+    searchable models if none are given.
+
+    The objects are indexed in chunks: keywords are resolved and
+    occurrences replaced in bulk, and only one chunk of objects is in
+    memory at a time.
+
+    With --queue, index the objects that were queued by saves with
+    SEARCH_DEFER_INDEXING enabled instead.
+
+    Afterwards the typeahead keyword index is written to
+    SEARCH_TYPEAHEAD_FILE, if that is set.
+    """)
+    args = '[app_label.model_name...]'
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--chunk-size', action='store', type='int', default=1000,
+                help='Objects to index at once (default 1000)'),
+            optparse.make_option(
+                '--queue', action='store_true', default=False,
+                help='Index the queued objects'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                'args', nargs='*', help='The app_label.model_name to index')
+            parser.add_argument(
+                '--chunk-size', action='store', type=int, default=1000,
+                help='Objects to index at once (default 1000)')
+            parser.add_argument(
+                '--queue', action='store_true', default=False,
+                help='Index the queued objects')
+
+    def handle(self, *args, **kwargs):
+        verbose = int(kwargs.get('verbosity', '1'))
+        chunk_size = int(kwargs.get('chunk_size') or 1000)
+        if chunk_size < 1:
+            raise CommandError('The chunk size must be positive')
+
+        if kwargs.get('queue'):
+            if args:
+                raise CommandError('Cannot combine --queue with models')
+            count = drain_index_queue(batch_size=chunk_size)
+            if verbose:
+                self.stdout.write('Indexed %d queued objects' % (count,))
+        else:
+            for model in self.get_searchable_models(args):
+                count = index_queryset(model._base_manager.all(),
+                                       chunk_size=chunk_size)
+                if verbose:
+                    self.stdout.write('Indexed %d %s.%s objects' % (
+                        count, model._meta.app_label,
+                        model._meta.object_name))
+
+        path = save_keyword_index()
+        if path and verbose:
+            self.stdout.write('Wrote keyword index to %s' % (path,))
+
+    def get_searchable_models(self, labels):
+        if not labels:
+            return [model for model in get_models()
+                    if callable(getattr(model, '_get_search_fields', None))]
+
+        models = []
+        for label in labels:
+            if '.' not in label:
+                raise CommandError('Format model as app_label.model_name')
+            try:
+                # Note that old get_model returns None
+                model = get_model(*label.split('.', 1))
+            except LookupError:
+                model = None
+            if model is None:
+                raise CommandError('No model found: %s' % (label,))
+            if not callable(getattr(model, '_get_search_fields', None)):
+                raise CommandError('Model is not searchable: %s' % (label,))
+            models.append(model)
+        return models
@@ -0,0 +1,68 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+
+from django import VERSION as django_version
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.search.management.commands.searchindex import (
+    Command as IndexCommand)
+from osso.search.utils import check_queryset
+
+
+class Command(IndexCommand):
+    __doc__ = help = docstring("""
+    Check the search index for the given models, or for all searchable
+    models if none are given, and reindex only the objects whose
+    search fields differ from the stored keywords.
+
+    The objects are checked in chunks by primary key range: a
+    fingerprint of the search fields of each object is compared with
+    one of its stored keywords, which are fetched for the whole chunk
+    at once. Index entries of objects that no longer exist are
+    removed. Use this after bulk updates or raw SQL instead of a full
+    rebuild.
+
+    With --dry-run, only report the differences.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--chunk-size', action='store', type='int', default=1000,
+                help='Objects to check at once (default 1000)'),
+            optparse.make_option(
+                '--dry-run', action='store_true', default=False,
+                help='Report the differences without repairing them'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                'args', nargs='*', help='The app_label.model_name to check')
+            parser.add_argument(
+                '--chunk-size', action='store', type=int, default=1000,
+                help='Objects to check at once (default 1000)')
+            parser.add_argument(
+                '--dry-run', action='store_true', default=False,
+                help='Report the differences without repairing them')
+
+    def handle(self, *args, **kwargs):
+        verbose = int(kwargs.get('verbosity', '1'))
+        chunk_size = int(kwargs.get('chunk_size') or 1000)
+        if chunk_size < 1:
+            raise CommandError('The chunk size must be positive')
+        repair = not kwargs.get('dry_run')
+
+        for model in self.get_searchable_models(args):
+            checked, reindexed, stale = check_queryset(
+                model._base_manager.all(), chunk_size=chunk_size,
+                repair=repair)
+            if verbose:
+                self.stdout.write(
+                    '%s %d %s.%s objects: %d %s, %d stale' % (
+                        'Repaired' if repair else 'Checked', checked,
+                        model._meta.app_label, model._meta.object_name,
+                        reindexed, 'reindexed' if repair else 'differ',
+                        stale))
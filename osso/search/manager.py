@@ -1,6 +1,220 @@
-import copy
+import heapq
+import math
+import threading
+from collections import namedtuple
+from hashlib import md5
+from time import time
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.signals import request_finished
+from django.db import connection, models, transaction
+
+
+# A KeywordOccurrence row without the model overhead.
+Posting = namedtuple('Posting', ('keyword_id', 'content_type_id', 'object_id',
+                                 'frequency', 'weight'))
+
+# Search results are cached for SEARCH_CACHE_TIME seconds (default 0,
+# disabled), but only the best SEARCH_CACHE_HITS of them. The cache
+# keys include a generation number that every (un)indexing bumps once
+# its transaction commits, so cached results never outlive a change of
+# the index. The generation is shared through the cache: only enable
+# this with a cache that all processes share (not the default
+# LocMemCache).
+CACHE_TIME = 0
+CACHE_HITS = 1000
+GENERATION_KEY = 'osso.search.generation'
+GENERATION_TIME = 86400
+
+try:
+    on_commit = transaction.on_commit
+except AttributeError:  # Django 1.8-
+    on_commit = None
+
+# The calls that wait for the outermost atomic block to end (Django
+# 1.8-, where there is no on_commit).
+_pending = threading.local()
+
+
+def get_generation():
+    flush_pending()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # start at a number that was not used before the cache lost it
+        generation = int(time() * 1000)
+        if not cache.add(GENERATION_KEY, generation, GENERATION_TIME):
+            generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def bump_generation():
+    '''
+    bumps the generation once the current transaction commits
+    '''
+    if on_commit is None and in_transaction():
+        # Without commit hooks, bump both now and after the outermost
+        # atomic block. A search in between may cache uncommitted
+        # results under the first bump.
+        _bump_generation()
+    after_commit(_bump_generation)
+
+
+def after_commit(func):
+    '''
+    calls func once the current transaction commits, or right away
+    outside a transaction; without commit hooks (Django 1.8-) once the
+    outermost atomic block has ended, committed or not, see
+    flush_pending()
+    '''
+    if on_commit is not None:
+        on_commit(func)
+    elif in_transaction():
+        calls = _pending.__dict__.setdefault('calls', [])
+        if func not in calls:
+            calls.append(func)
+    else:
+        func()
+
+
+def flush_pending():
+    '''
+    does the calls that wait for the outermost atomic block, if it has
+    ended (Django 1.8-); called after the indexing transactions, before
+    every search and at the end of every request
+    '''
+    calls = getattr(_pending, 'calls', None)
+    if calls and not in_transaction():
+        _pending.calls = []
+        for func in calls:
+            func()
+
+
+def in_transaction():
+    if getattr(connection, 'in_atomic_block', False):
+        return True
+    try:
+        return not transaction.get_autocommit()  # Django 1.6+
+    except AttributeError:
+        return transaction.is_managed()
+
+
+def _bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:  # not in the cache
+        get_generation()
+
+
+def _flush_pending(sender, **kwargs):
+    flush_pending()
+request_finished.connect(_flush_pending)
+
+
+# The number of indexed objects, for BM25 scoring. It is counted when
+# it is not in the cache and kept up to date by the (un)indexing; it
+# does not have to be exact.
+DOCUMENTS_KEY = 'osso.search.documents'
+DOCUMENTS_TIME = 86400
+
+
+def get_document_count():
+    documents = cache.get(DOCUMENTS_KEY)
+    if documents is None:
+        from osso.search.models import KeywordOccurrence
+        documents = (KeywordOccurrence.objects
+                     .values('content_type', 'object_id')
+                     .distinct().count())
+        cache.set(DOCUMENTS_KEY, documents, DOCUMENTS_TIME)
+    return documents
+
+
+def add_document_count(delta):
+    if delta:
+        try:
+            cache.incr(DOCUMENTS_KEY, delta)
+        except ValueError:  # not in the cache, count it when needed
+            pass
+
+
+class Scorer(object):
+    '''
+    scores the postings of a search; the hits are ranked by the summed
+    score and then by weight, frequency and number of matched keywords
+
+    This scorer gives every posting the same score, so the hits are
+    ranked by weight and frequency only.
+    '''
+    name = 'weight'
+
+    def prepare(self, keyword_ids):
+        '''
+        called once per search with the ids of all matched keywords,
+        before score() is called for their postings
+        '''
+        pass
+
+    def score(self, posting):
+        return 0
+
+
+class BM25Scorer(Scorer):
+    '''
+    Okapi BM25: the frequency of a keyword in an object is saturated
+    and multiplied by the inverse document frequency of the keyword,
+    so common keywords count less. The field weight is a boost.
+
+    The index does not store the length of the objects, so there is no
+    length normalization (BM25 with b=0).
+    '''
+    name = 'bm25'
+
+    def __init__(self, k1=1.2):
+        self.k1 = k1
+        self.idf = {}
+
+    def prepare(self, keyword_ids):
+        from osso.search.models import Keyword
+        self.idf = {}
+        keyword_ids = list(keyword_ids)
+        if not keyword_ids:
+            return
+        documents = get_document_count()
+        for i in range(0, len(keyword_ids), 500):
+            for id, frequency in (Keyword.objects
+                                  .filter(id__in=keyword_ids[i:(i + 500)])
+                                  .values_list('id', 'document_frequency')):
+                # the counts may lag, keep the logarithm positive
+                frequency = min(frequency, documents)
+                self.idf[id] = math.log(
+                    1 + (documents - frequency + 0.5) / (frequency + 0.5))
+
+    def score(self, posting):
+        frequency = posting.frequency
+        return (self.idf.get(posting.keyword_id, 0) * posting.weight *
+                frequency * (self.k1 + 1) / (frequency + self.k1))
+
+
+SCORERS = {
+    Scorer.name: Scorer,
+    BM25Scorer.name: BM25Scorer,
+}
+
+
+def get_scorer(scorer=None):
+    '''
+    returns a scorer instance for a scorer name, or for the
+    SEARCH_SCORER setting (default 'weight') if no scorer is given
+    '''
+    if scorer is None:
+        scorer = getattr(settings, 'SEARCH_SCORER', Scorer.name)
+    if isinstance(scorer, Scorer):
+        return scorer
+    try:
+        return SCORERS[scorer]()
+    except KeyError:
+        raise ValueError('invalid search scorer %r' % (scorer,))
 
 
 class SearchHitManager(object):
@@ -12,30 +226,34 @@ class SearchHitManager(object):
         self.hit_total = {}
         self.hit_keywords = {}
 
-    def add(self, keyword, occurrence):
+    def add(self, keyword, occurrence, score=0):
         '''
         adds a hit to the given keyword
         '''
-        hit = SearchHit(keyword, occurrence)
+        key = (occurrence.content_type_id, occurrence.object_id)
         # add the hit to the keyword set
         if keyword in self.hit_keywords:
-            self.hit_keywords[keyword].add(hit.key)
+            self.hit_keywords[keyword].add(key)
         else:
-            self.hit_keywords[keyword] = set([hit.key,])
+            self.hit_keywords[keyword] = set([key,])
 
-        # add the hit to the global set
-        # create a copy because the hit will be updated with hits
-        # that share the same key
-        if hit.key in self.hit_total:
-            self.hit_total[hit.key].update(hit)
+        # add the hit to the global set, or update the hit that
+        # shares the same key
+        if key in self.hit_total:
+            self.hit_total[key].add(keyword, occurrence, score)
         else:
-            self.hit_total[hit.key] = copy.copy(hit)
+            self.hit_total[key] = SearchHit(keyword, occurrence, score)
 
-    def get_hits(self, type='and'):
+    def get_hits(self, type='and', limit=None, offset=0):
         '''
         returns the results from all keywords using the inclusion type `type`
         type = 'and': return the hits that match all keywords
         type = 'or': return the hits that match any of the keywords
+
+        The results are ordered by score, weight, frequency and number
+        of matched keywords. If `limit` is given, only the `limit` best
+        hits starting at `offset` are returned; the total number of
+        hits is available as the `total` attribute of the result.
         '''
         results = set(self.hit_total.keys())
         for hits in self.hit_keywords.values():
@@ -43,34 +261,96 @@ class SearchHitManager(object):
                 results.update(hits)
             else:
                 results.intersection_update(hits)
-        return sorted([self.hit_total[hit] for hit in results], reverse=True)
+
+        hits = [self.hit_total[hit] for hit in results]
+        key = SearchHit.sort_key
+        if limit is None:
+            page = sorted(hits, key=key, reverse=True)[offset:]
+        else:
+            # a heap of offset+limit hits instead of sorting them all
+            page = heapq.nlargest(offset + limit, hits, key=key)[offset:]
+        return SearchResults(page, total=len(hits))
+
+
+class SearchResults(list):
+    '''
+    list of search hits that also knows the total number of hits, of
+    which this list may only be a page
+    '''
+    def __init__(self, hits, total):
+        super(SearchResults, self).__init__(hits)
+        self.total = total
+
+
+def resolve_objects(hits):
+    '''
+    looks up the objects of the given hits, with a single query per
+    content type; call it on the hits you are going to show, after
+    sorting and slicing
+    '''
+    object_ids = {}
+    for hit in hits:
+        if not hasattr(hit, '_object'):
+            object_ids.setdefault(hit.key[0], set()).add(hit.key[1])
+
+    objects = {}
+    for content_type_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is not None:
+            for pk, object in model._base_manager.in_bulk(ids).items():
+                objects[(content_type_id, pk)] = object
+
+    for hit in hits:
+        if not hasattr(hit, '_object'):
+            # stale index entries get None, like GenericForeignKey does
+            hit.object = objects.get(hit.key)
+    return hits
 
 
 class SearchHit(object):
     '''
     class that represents a search hit
+
+    The occurrence can be a KeywordOccurrence or a Posting. The object
+    is looked up when it is first accessed; use resolve_objects() to
+    look up the objects of many hits at once.
     '''
-    def __init__(self, keyword, occurrence):
+    @classmethod
+    def from_cache(cls, row):
+        content_type_id, object_id, score, weight, frequency, keywords = row
+        hit = cls(keywords[0], Posting(None, content_type_id, object_id,
+                                       frequency, weight), score)
+        hit.keywords.update(keywords)
+        return hit
+
+    def __init__(self, keyword, occurrence, score=0):
         self.key = (occurrence.content_type_id, occurrence.object_id)
         self.keywords = set([keyword,])
-        self.object = occurrence.content_object
+        self.score = score
         self.frequency = occurrence.frequency
         self.weight = occurrence.weight
 
     def __repr__(self):
-        return '<SearchHit(key=%s, weight=%s, frequency=%s, keywords=%s)>' % \
-                (self.key, self.weight, self.frequency, self.keywords)
+        return ('<SearchHit(key=%s, score=%s, weight=%s, frequency=%s, '
+                'keywords=%s)>' % (self.key, self.score, self.weight,
+                                   self.frequency, self.keywords))
 
     def __hash__(self):
         return self.key.__hash__()
 
     def __cmp__(self, other):
-        value = (self.weight, self.frequency, len(self.keywords))
+        value = self.sort_key()
         if isinstance(other, SearchHit):
-            return cmp(value, (other.weight, other.frequency, len(other.keywords)))
+            return cmp(value, other.sort_key())
         else:
             return cmp(value, other)
 
+    def __lt__(self, other):
+        if isinstance(other, SearchHit):
+            return self.sort_key() < other.sort_key()
+        else:
+            return self.sort_key() < other
+
     def __eq__(self, other):
         if isinstance(other, SearchHit):
             return self.key == other.key
@@ -80,24 +360,78 @@ class SearchHit(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def get_object(self):
+        if not hasattr(self, '_object'):
+            content_type = ContentType.objects.get_for_id(self.key[0])
+            try:
+                self._object = content_type.get_object_for_this_type(
+                    pk=self.key[1])
+            except ObjectDoesNotExist:
+                # stale index entry, like GenericForeignKey does
+                self._object = None
+        return self._object
+
+    def set_object(self, object):
+        self._object = object
+
+    object = property(get_object, set_object)
+
+    def to_cache(self):
+        return (self.key[0], self.key[1], self.score, self.weight,
+                self.frequency, tuple(self.keywords))
+
+    def sort_key(self):
+        return (self.score, self.weight, self.frequency, len(self.keywords))
+
+    def add(self, keyword, occurrence, score=0):
+        '''
+        update this hit object with another occurrence
+        '''
+        self.keywords.add(keyword)
+        self.score += score
+        self.frequency += occurrence.frequency
+        self.weight += occurrence.weight
+
     def update(self, hit):
         '''
         update this hit object with the data from the given hit object
         '''
         self.keywords.update(hit.keywords)
+        self.score += hit.score
         self.frequency += hit.frequency
         self.weight += hit.weight
 
 
 class SearchManager(models.Manager):
-    def search(self, query, content_types=None):
-        from search.utils import get_keywords
-        keywords = get_keywords(query)
+    # exact: the query keywords must match the indexed keywords
+    # prefix: the query keywords must match the start of the indexed
+    #         keywords (search-as-you-type)
+    # substring: the query keywords may match anywhere in the indexed
+    #            keywords; this needs a table scan per keyword, so it
+    #            is slow on large indexes
+    MODES = ('exact', 'prefix', 'substring')
+
+    def search(self, query, content_types=None, mode='prefix', limit=None,
+               offset=0, use_cache=True, scorer=None):
+        '''
+        returns the best hits for the query, see
+        SearchHitManager.get_hits() for the `limit` and `offset` and
+        get_scorer() for the `scorer`
+        '''
+        from osso.search.utils import get_keywords, get_stopwords
+        if mode not in self.MODES:
+            raise ValueError('invalid search mode %r' % (mode,))
+        scorer = get_scorer(scorer)
+
+        # the operators may be stopwords, look for them first
+        keywords = get_keywords(query, stopwords=())
         type = 'and'
         for t in ['and', 'or']:
             if t in keywords:
                 keywords.remove(t)
                 type = t
+        stopwords = get_stopwords()
+        keywords = [i for i in keywords if i not in stopwords]
 
         base_filter = {}
         if content_types is not None and len(content_types) > 0:
@@ -106,11 +440,142 @@ class SearchManager(models.Manager):
             else:
                 base_filter = {'content_type__pk__in': content_types}
 
+        cache_time = getattr(settings, 'SEARCH_CACHE_TIME', CACHE_TIME)
+        if use_cache and cache_time:
+            cache_key = self.get_cache_key(keywords, type, mode, base_filter,
+                                           scorer)
+            hits = self.get_cached_hits(cache_key, limit, offset)
+            if hits is not None:
+                return hits
+
         shm = SearchHitManager()
+        # a keyword without any hits must make an 'and' search fail
         for keyword in keywords:
-            filter = base_filter.copy()
-            filter['keyword__keyword__contains'] = keyword
-            ko = self.filter(**filter)
-            for occurrence in ko:
-                shm.add(keyword, occurrence)
-        return shm.get_hits(type=type)
+            shm.hit_keywords[keyword] = set()
+
+        if mode == 'substring':
+            postings = []
+            for keyword in keywords:
+                filter = base_filter.copy()
+                filter['keyword__keyword__contains'] = keyword
+                ko = self.filter(**filter).values_list(
+                    'keyword', 'content_type', 'object_id', 'frequency',
+                    'weight')
+                postings.extend((keyword, Posting(*occurrence))
+                                for occurrence in ko)
+        else:
+            postings = list(self.get_postings(keywords, base_filter, mode))
+
+        scorer.prepare(set(posting.keyword_id for unused, posting
+                           in postings))
+        for keyword, posting in postings:
+            shm.add(keyword, posting, scorer.score(posting))
+        if not (use_cache and cache_time):
+            return shm.get_hits(type=type, limit=limit, offset=offset)
+
+        # cache (at least) the best CACHE_HITS hits
+        cache_limit = None
+        if limit is not None:
+            cache_limit = max(getattr(settings, 'SEARCH_CACHE_HITS',
+                                      CACHE_HITS), offset + limit)
+        hits = shm.get_hits(type=type, limit=cache_limit)
+        cache.set(cache_key, (hits.total, [hit.to_cache() for hit in hits]),
+                  cache_time)
+        end = None if limit is None else offset + limit
+        return SearchResults(hits[offset:end], total=hits.total)
+
+    def get_cache_key(self, keywords, type, mode, base_filter, scorer):
+        content_types = sorted(
+            getattr(i, 'pk', i) for i in
+            (base_filter.get('content_type__in') or
+             base_filter.get('content_type__pk__in') or ()))
+        key = repr((sorted(set(keywords)), type, mode, content_types,
+                    scorer.name))
+        return 'osso.search.results.%s.%s' % (
+            get_generation(), md5(key.encode('utf-8')).hexdigest())
+
+    def get_cached_hits(self, cache_key, limit, offset):
+        cached = cache.get(cache_key)
+        if cached is None:
+            return None
+
+        total, rows = cached
+        if limit is None:
+            if len(rows) < total:
+                return None
+            end = None
+        else:
+            end = offset + limit
+            if len(rows) < min(end, total):
+                return None
+        return SearchResults([SearchHit.from_cache(row)
+                              for row in rows[offset:end]], total=total)
+
+    def get_keyword_ids(self, keywords, mode='exact'):
+        '''
+        returns a dictionary of keyword ids with the list of query
+        keywords they match, using a single query on the keyword index
+
+        With SEARCH_TYPEAHEAD enabled, prefixes are looked up in the
+        in-memory keyword index of osso.search.typeahead instead.
+        '''
+        from osso.search.models import Keyword
+        keywords = set(keywords)
+        if not keywords:
+            return {}
+
+        if mode == 'prefix' and getattr(settings, 'SEARCH_TYPEAHEAD', False):
+            # no LIKE queries, the keyword index has the ids
+            from osso.search.typeahead import get_keyword_index
+            index = get_keyword_index()
+            ret = {}
+            for keyword in keywords:
+                for id in index.get_ids(keyword):
+                    ret.setdefault(id, []).append(keyword)
+            return ret
+
+        if mode == 'exact':
+            filter = models.Q(keyword__in=keywords)
+        else:
+            filter = models.Q()
+            for keyword in keywords:
+                filter |= models.Q(keyword__startswith=keyword)
+
+        ret = {}
+        for id, keyword in (Keyword.objects.filter(filter)
+                            .values_list('id', 'keyword')):
+            if mode == 'exact':
+                ret[id] = [keyword]
+            else:
+                ret[id] = [i for i in keywords if keyword.startswith(i)]
+        return ret
+
+    def complete(self, prefix, limit=10):
+        '''
+        returns the first `limit` indexed keywords that start with the
+        (last word of the) prefix, for search-as-you-type suggestions
+        '''
+        from osso.search.typeahead import get_keyword_index
+        from osso.search.utils import get_keywords
+        keywords = get_keywords(prefix)
+        if not keywords:
+            return []
+        return get_keyword_index().complete(keywords[-1], limit=limit)
+
+    def get_postings(self, keywords, base_filter=None, mode='exact'):
+        '''
+        yields (query keyword, Posting) tuples for all occurrences of
+        the keywords, fetching the postings of all keywords at once
+        '''
+        keyword_ids = self.get_keyword_ids(keywords, mode=mode)
+        if not keyword_ids:
+            return
+
+        postings = (self.filter(keyword__in=keyword_ids.keys(),
+                                **(base_filter or {}))
+                    .values_list('keyword', 'content_type', 'object_id',
+                                 'frequency', 'weight'))
+        for posting in postings:
+            posting = Posting(*posting)
+            for keyword in keyword_ids[posting.keyword_id]:
+                yield keyword, posting
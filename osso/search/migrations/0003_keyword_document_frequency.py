@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def count_documents(apps, schema_editor):
+    Keyword = apps.get_model('search', 'Keyword')
+    KeywordOccurrence = apps.get_model('search', 'KeywordOccurrence')
+    counts = (KeywordOccurrence.objects.values_list('keyword')
+              .annotate(Count('id')).order_by())
+    for keyword_id, count in counts:
+        Keyword.objects.filter(id=keyword_id).update(
+            document_frequency=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0002_indexqueueitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='document_frequency',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(count_documents, migrations.RunPython.noop),
+    ]
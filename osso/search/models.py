@@ -10,6 +10,9 @@ from osso.search.manager import SearchManager
 
 class Keyword(models.Model):
     keyword = models.SlugField(unique=True)
+    # The number of indexed objects with this keyword, kept up to date
+    # by index_objects() and unindex_objects() for BM25 scoring.
+    document_frequency = models.PositiveIntegerField(default=0)
 
     def __unicode__(self):
         return self.keyword
@@ -29,3 +32,15 @@ class KeywordOccurrence(models.Model):
     def __unicode__(self):
         return (u'%s, frequency=%d, weight=%d' %
                 (self.keyword, self.frequency, self.weight))
+
+
+class IndexQueueItem(models.Model):
+    """
+    An object that was saved with deferred indexing enabled and that
+    still has to be (re)indexed by the searchindex --queue worker.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    def __unicode__(self):
+        return u'%s:%d' % (self.content_type_id, self.object_id)
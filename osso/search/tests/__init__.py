@@ -0,0 +1,2 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+from .test_search import *
@@ -0,0 +1,34 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+from django.contrib.auth.models import Group
+from django.db import models
+from osso.search.utils import SearchableMixin, SearchField
+
+
+class SearchableGroup(SearchableMixin, Group):
+    '''
+    Group that indexes its name, so we need no tables of our own.
+    '''
+    class Meta:
+        app_label = 'search'
+        proxy = True
+
+    def _get_search_fields(self):
+        return [SearchField(self.name, weight=2)]
+
+
+class VisibleGroupManager(models.Manager):
+    def get_queryset(self):
+        return models.query.QuerySet(self.model, using=self._db).exclude(
+            name__startswith='hidden')
+    get_query_set = get_queryset  # Django 1.5-
+
+
+class VisibleSearchableGroup(SearchableGroup):
+    '''
+    SearchableGroup whose default manager hides some of the objects.
+    '''
+    objects = VisibleGroupManager()
+
+    class Meta:
+        app_label = 'search'
+        proxy = True
@@ -0,0 +1,208 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import os
+import threading
+from bisect import bisect_left, insort
+from time import time
+
+from django.conf import settings
+from osso.search.manager import (after_commit, flush_pending, in_transaction,
+                                 on_commit)
+from osso.search.models import Keyword
+
+
+class KeywordIndex(object):
+    '''
+    In-memory sorted array of all keywords, for prefix completion
+    (search-as-you-type) and prefix lookups without LIKE queries.
+
+    Keywords are never removed from the Keyword table, so the index is
+    kept up to date by loading the keywords with a higher id than the
+    ones we have. This happens when the index is older than
+    `refresh_interval` seconds; keywords created by this process are
+    added once they are committed, see add_committed(). Only refreshes
+    advance `max_id`, so keywords of other processes are not skipped
+    because we created a higher id.
+
+    Ids are not committed in order: a keyword can show up after a
+    higher id has been loaded. The refreshes load the last
+    `refresh_window` ids again for those, and every `rebuild_interval`
+    seconds the whole index is loaded again.
+    '''
+    def __init__(self, refresh_interval=60, refresh_window=1000,
+                 rebuild_interval=3600):
+        self.refresh_interval = refresh_interval
+        self.refresh_window = refresh_window
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.keywords = []
+            self.ids = {}
+            self.max_id = 0
+            self.refreshed = None
+            self.rebuilt = None
+
+    def is_loaded(self):
+        return self.refreshed is not None
+
+    def refresh(self, force=False):
+        '''
+        load the keywords that are new since the last refresh
+        '''
+        refreshed = time()
+        if (not force and self.refreshed is not None and
+                self.refreshed + self.refresh_interval > refreshed):
+            return
+        if (self.rebuilt is None or
+                self.rebuilt + self.rebuild_interval <= refreshed):
+            self.rebuild()
+            return
+        new = list(Keyword.objects
+                   .filter(id__gt=(self.max_id - self.refresh_window))
+                   .values_list('keyword', 'id'))
+        self.add(new)
+        if new:
+            self.max_id = max(self.max_id, max(id for keyword, id in new))
+        self.refreshed = refreshed
+
+    def rebuild(self):
+        '''
+        load all keywords, replacing the index
+        '''
+        rebuilt = time()
+        ids = dict(Keyword.objects.values_list('keyword', 'id'))
+        keywords = sorted(ids)
+        with self._lock:
+            self.keywords, self.ids = keywords, ids
+            self.max_id = max(ids.values() or [0])
+            self.refreshed = self.rebuilt = rebuilt
+
+    def add(self, keyword_ids):
+        '''
+        add (keyword, id) pairs to the index
+        '''
+        with self._lock:
+            new = [(keyword, id) for keyword, id in keyword_ids
+                   if keyword not in self.ids]
+            if len(new) > 100:
+                # resorting is cheaper than many inserts
+                self.keywords = sorted(
+                    self.keywords + [keyword for keyword, id in new])
+            else:
+                for keyword, id in new:
+                    insort(self.keywords, keyword)
+            for keyword, id in new:
+                self.ids[keyword] = id
+
+    def add_committed(self, keyword_ids):
+        '''
+        add (keyword, id) pairs that were created in the current
+        transaction to the index, once it commits
+        '''
+        keyword_ids = list(keyword_ids)
+        if on_commit is None and in_transaction():
+            # Without commit hooks (Django 1.8-) this waits for the
+            # outermost atomic block, which may have rolled back: add
+            # the keywords that exist by then.
+            after_commit(lambda: self.add(_existing(keyword_ids)))
+        else:
+            after_commit(lambda: self.add(keyword_ids))
+
+    def complete(self, prefix, limit=None):
+        '''
+        return the keywords that start with prefix, in sorted order
+        '''
+        keywords = self.keywords
+        ret = []
+        i = bisect_left(keywords, prefix)
+        while i < len(keywords) and keywords[i].startswith(prefix):
+            if limit is not None and len(ret) >= limit:
+                break
+            ret.append(keywords[i])
+            i += 1
+        return ret
+
+    def get_ids(self, prefix):
+        '''
+        return a dictionary of id to keyword for the keywords that
+        start with prefix
+        '''
+        return dict((self.ids[keyword], keyword)
+                    for keyword in self.complete(prefix))
+
+    def save(self, path):
+        '''
+        write the index to path, as sorted keyword<TAB>id lines
+        '''
+        with self._lock:
+            keywords = list(self.keywords)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as file_:
+            for keyword in keywords:
+                file_.write(('%s\t%d\n' % (keyword, self.ids[keyword]))
+                            .encode('utf-8'))
+        os.rename(tmp_path, path)  # atomic replacement
+
+    def load(self, path):
+        '''
+        load the index from a file written by save(); the rest is
+        picked up by the next refresh
+        '''
+        keywords = []
+        ids = {}
+        with open(path, 'rb') as file_:
+            for line in file_:
+                keyword, id = line.decode('utf-8').rstrip('\n').split('\t')
+                keywords.append(keyword)
+                ids[keyword] = int(id)
+        with self._lock:
+            self.keywords, self.ids = keywords, ids
+            self.max_id = max(ids.values() or [0])
+            self.refreshed = None
+            # the refresh window and the rebuilds catch up with the
+            # keywords that the file missed
+            self.rebuilt = time()
+
+
+def _existing(keyword_ids):
+    # The (keyword, id) pairs that are in the Keyword table. Keywords
+    # created together have nearby ids, so fetch their id range.
+    if not keyword_ids:
+        return []
+    ids = [id for keyword, id in keyword_ids]
+    existing = set(Keyword.objects.filter(id__range=(min(ids), max(ids)))
+                   .values_list('keyword', 'id'))
+    return [i for i in keyword_ids if i in existing]
+
+
+# The index of this process, see get_keyword_index().
+keyword_index = KeywordIndex()
+
+
+def get_keyword_index():
+    '''
+    return the keyword index of this process, loaded and refreshed
+
+    If SEARCH_TYPEAHEAD_FILE is set, an index that is not loaded yet
+    is read from that file first, so only the keywords that are newer
+    than the file are queried.
+    '''
+    flush_pending()
+    if not keyword_index.is_loaded():
+        path = getattr(settings, 'SEARCH_TYPEAHEAD_FILE', None)
+        if path and os.path.exists(path) and not keyword_index.keywords:
+            keyword_index.load(path)
+    keyword_index.refresh()
+    return keyword_index
+
+
+def save_keyword_index():
+    '''
+    write the (refreshed) index to SEARCH_TYPEAHEAD_FILE, if it is set
+    '''
+    path = getattr(settings, 'SEARCH_TYPEAHEAD_FILE', None)
+    if path:
+        get_keyword_index().save(path)
+    return path
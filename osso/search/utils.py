@@ -1,15 +1,32 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
 import re
+import unicodedata
+from collections import Counter
+from hashlib import md5
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import F
 try:
     from django.utils.encoding import force_text
 except ImportError:
     from django.utils.encoding import force_unicode as force_text
-from osso.search.models import Keyword, KeywordOccurrence
+from osso.search.manager import (add_document_count, bump_generation,
+                                 flush_pending)
+from osso.search.models import IndexQueueItem, Keyword, KeywordOccurrence
+from osso.search.typeahead import keyword_index
 
 
 KEYWORD_LENGTH = Keyword._meta.get_field('keyword').max_length
-KEYWORD_REGEXP = re.compile(r'[A-Za-z0-9-_]{2,}', re.UNICODE)
+KEYWORD_MIN_LENGTH = 2
+KEYWORD_REGEXP = re.compile(r'[A-Za-z0-9-_]+', re.UNICODE)
+# Stay below the SQLite limit of 999 variables per query.
+IN_QUERY_SIZE = 500
+
+try:
+    atomic = transaction.atomic
+except AttributeError:  # Django 1.5-
+    atomic = transaction.commit_on_success
 
 
 class SearchField(object):
@@ -19,13 +36,24 @@ class SearchField(object):
 
 
 class SearchableMixin(object):
+    # Set SEARCH_DEFER_INDEXING to True (or this to True on a model) to
+    # only queue the object on save. The searchindex --queue worker
+    # then indexes it later, once for multiple saves.
+    search_defer_indexing = None
+
     def save(self, force_insert=False, force_update=False, **kwargs):
         super(SearchableMixin, self).save(force_insert=force_insert,
                                           force_update=force_update,
                                           **kwargs)
         # save the object first so the object id is set
         # then let the search app index it
-        index_object(self)
+        defer = self.search_defer_indexing
+        if defer is None:
+            defer = getattr(settings, 'SEARCH_DEFER_INDEXING', False)
+        if defer:
+            queue_object(self)
+        else:
+            index_object(self)
 
     def delete(self):
         # remove all references to the object from the search app
@@ -33,50 +61,290 @@ class SearchableMixin(object):
         super(SearchableMixin, self).delete()
 
 
-def get_keywords(text):
+def fold_accents(text):
+    '''
+    Strip the accents from the text: u'cr\xe8me' becomes u'creme'.
+    '''
+    return u''.join(i for i in unicodedata.normalize('NFKD', text)
+                    if not unicodedata.combining(i))
+
+
+def get_stopwords():
+    '''
+    Return the SEARCH_STOPWORDS setting as a set of keywords.
+    '''
+    return frozenset(getattr(settings, 'SEARCH_STOPWORDS', ()))
+
+
+def iter_keywords(text, min_length=KEYWORD_MIN_LENGTH, max_length=None,
+                  stopwords=None, accents=None):
+    '''
+    Yield the keywords of the text, one at a time, so large texts are
+    not split up in a list first. This is the tokenizer of both the
+    indexing and the search queries:
+
+    - the accents are folded (SEARCH_FOLD_ACCENTS, default False)
+      before tokenizing, otherwise accented letters split the words;
+    - the keywords are lowercased;
+    - keywords shorter than min_length or longer than max_length are
+      skipped;
+    - stopwords (SEARCH_STOPWORDS, default none) are skipped.
+    '''
     text = force_text(text)
-    return [s.lower() for s in KEYWORD_REGEXP.findall(text)]
+    if accents is None:
+        accents = getattr(settings, 'SEARCH_FOLD_ACCENTS', False)
+    if accents:
+        text = fold_accents(text)
+    if stopwords is None:
+        stopwords = get_stopwords()
+    if max_length is None:
+        max_length = len(text)
+
+    for match in KEYWORD_REGEXP.finditer(text):
+        keyword = match.group().lower()
+        if (min_length <= len(keyword) <= max_length and
+                keyword not in stopwords):
+            yield keyword
+
+
+def get_keywords(text, **kwargs):
+    return list(iter_keywords(text, **kwargs))
+
+
+def count_keywords(text, **kwargs):
+    '''
+    Return a Counter of keyword to frequency for the text.
+    '''
+    return Counter(iter_keywords(text, **kwargs))
 
 
 def index_object(object, object_id=None):
     if isinstance(object, ContentType):
         content_type = object
         object = content_type.get_object_for_this_type(pk=object_id)
-    else:
-        content_type = ContentType.objects.get_for_model(object)
 
+    index_objects([object])
+
+
+def get_object_postings(object):
+    '''
+    Return a dictionary of keyword to [frequency, weight] for the
+    object, or None if the object does not want to be indexed.
+
+    A keyword that is found in multiple search fields gets the sum of
+    their frequencies and weights.
+    '''
     # if the object does not implement _get_search_fields
     # it does not want to be indexed
     search_field_func = getattr(object, '_get_search_fields', None)
     if not callable(search_field_func):
-        return
+        return None
 
-    # clear all old references to the object
-    unindex_object(content_type, object.pk)
-
-    search_fields = search_field_func()
-    for search_field in search_fields:
+    stopwords = get_stopwords()
+    postings = {}
+    for search_field in search_field_func():
         assert isinstance(search_field, SearchField), \
             '_get_search_fields() must return a list of SearchField instances'
-        keywords = get_keywords(search_field.value)
-        for keyword in set(keywords):
-            if len(keyword) > KEYWORD_LENGTH:
+        frequencies = count_keywords(search_field.value,
+                                     max_length=KEYWORD_LENGTH,
+                                     stopwords=stopwords)
+        for keyword, frequency in frequencies.items():
+            if keyword in postings:
+                postings[keyword][0] += frequency
+                postings[keyword][1] += search_field.weight
+            else:
+                postings[keyword] = [frequency, search_field.weight]
+    return postings
+
+
+def get_keyword_ids(keywords):
+    '''
+    Return a dictionary of keyword to Keyword id, creating the missing
+    keywords in bulk.
+    '''
+    keywords = list(set(keywords))
+    keyword_ids = {}
+    for i in range(0, len(keywords), IN_QUERY_SIZE):
+        keyword_ids.update(Keyword.objects.filter(
+            keyword__in=keywords[i:(i + IN_QUERY_SIZE)])
+            .values_list('keyword', 'id'))
+
+    missing = [i for i in keywords if i not in keyword_ids]
+    if missing:
+        sid = transaction.savepoint()
+        try:
+            for i in range(0, len(missing), IN_QUERY_SIZE):
+                Keyword.objects.bulk_create(
+                    [Keyword(keyword=j)
+                     for j in missing[i:(i + IN_QUERY_SIZE)]])
+        except IntegrityError:
+            # someone else is indexing the same new keywords
+            transaction.savepoint_rollback(sid)
+            for keyword in missing:
+                keyword_ids[keyword] = Keyword.objects.get_or_create(
+                    keyword=keyword)[0].id
+        else:
+            transaction.savepoint_commit(sid)
+            for i in range(0, len(missing), IN_QUERY_SIZE):
+                keyword_ids.update(Keyword.objects.filter(
+                    keyword__in=missing[i:(i + IN_QUERY_SIZE)])
+                    .values_list('keyword', 'id'))
+        if keyword_index.is_loaded():
+            keyword_index.add_committed((i, keyword_ids[i]) for i in missing)
+
+    return keyword_ids
+
+
+def index_objects(objects):
+    '''
+    Index all objects at once: the keywords are looked up and created
+    in bulk, the old occurrences are removed with one delete per
+    content type and the new ones are inserted with bulk_create.
+
+    Objects without _get_search_fields are skipped.
+    '''
+    postings_by_object = []
+    keywords = set()
+    for object in objects:
+        postings = get_object_postings(object)
+        if postings is None:
+            continue
+        content_type = ContentType.objects.get_for_model(object)
+        postings_by_object.append((content_type.pk, object.pk, postings))
+        keywords.update(postings.keys())
+
+    if not postings_by_object:
+        return
+
+    with atomic():
+        keyword_ids = get_keyword_ids(keywords)
+        # the document frequencies change by the difference between the
+        # new and the old occurrences
+        frequencies, documents = _unindex_objects(
+            [(content_type_id, object_id)
+             for content_type_id, object_id, unused in postings_by_object])
+        for unused, unused, object_postings in postings_by_object:
+            frequencies.update(keyword_ids[i] for i in object_postings)
+        occurrences = [
+            KeywordOccurrence(keyword_id=keyword_ids[keyword],
+                              frequency=frequency, weight=weight,
+                              content_type_id=content_type_id,
+                              object_id=object_id)
+            for content_type_id, object_id, object_postings
+            in postings_by_object
+            for keyword, (frequency, weight) in object_postings.items()]
+        # (bulk_create got batch_size only in Django 1.5.)
+        for i in range(0, len(occurrences), IN_QUERY_SIZE):
+            KeywordOccurrence.objects.bulk_create(
+                occurrences[i:(i + IN_QUERY_SIZE)])
+        update_document_frequencies(frequencies)
+    add_document_count(len(postings_by_object) - documents)
+    bump_generation()
+    flush_pending()
+
+
+def index_queryset(queryset, chunk_size=1000):
+    '''
+    Index all objects in the queryset, chunk_size objects at a time.
+    The objects are fetched in primary key order, so only one chunk is
+    in memory at a time. Returns the number of objects.
+    '''
+    count = 0
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        if last_pk is None:
+            chunk = list(queryset[0:chunk_size])
+        else:
+            chunk = list(queryset.filter(pk__gt=last_pk)[0:chunk_size])
+        if not chunk:
+            break
+        index_objects(chunk)
+        count += len(chunk)
+        last_pk = chunk[-1].pk
+    return count
+
+
+def get_postings_fingerprint(postings):
+    '''
+    Return a fingerprint of a dictionary of keyword to (frequency,
+    weight), like get_object_postings() returns.
+    '''
+    data = u'\n'.join(u'%s %d %d' % (keyword, frequency, weight)
+                      for keyword, (frequency, weight)
+                      in sorted(postings.items()))
+    return md5(data.encode('utf-8')).hexdigest()
+
+
+def get_stored_fingerprints(content_type_id, after_id=None, last_id=None):
+    '''
+    Return a dictionary of object id to the fingerprint of its stored
+    postings, for the indexed objects with an id after after_id up to
+    and including last_id.
+    '''
+    occurrences = KeywordOccurrence.objects.filter(
+        content_type__pk=content_type_id)
+    if after_id is not None:
+        occurrences = occurrences.filter(object_id__gt=after_id)
+    if last_id is not None:
+        occurrences = occurrences.filter(object_id__lte=last_id)
+
+    postings = {}
+    for object_id, keyword, frequency, weight in occurrences.values_list(
+            'object_id', 'keyword__keyword', 'frequency', 'weight'):
+        postings.setdefault(object_id, {})[keyword] = (frequency, weight)
+    return dict((object_id, get_postings_fingerprint(object_postings))
+                for object_id, object_postings in postings.items())
+
+
+def check_queryset(queryset, chunk_size=1000, repair=True):
+    '''
+    Compare the search fields of all objects in the queryset with the
+    stored postings, chunk_size objects at a time, and reindex the
+    objects that differ. Stored postings of objects that no longer
+    exist are removed. With repair=False nothing is changed.
+
+    The queryset must hold all objects of its content type, or the
+    postings of the objects that are left out are seen as stale: use
+    the _base_manager of the model, not a default manager that filters.
+    Returns the number of checked, reindexed and stale objects.
+    '''
+    content_type_id = ContentType.objects.get_for_model(queryset.model).pk
+    checked = reindexed = stale = 0
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        if last_pk is None:
+            chunk = list(queryset[0:chunk_size])
+        else:
+            chunk = list(queryset.filter(pk__gt=last_pk)[0:chunk_size])
+        # the last range has no end, for the stale objects after the
+        # last object
+        stored = get_stored_fingerprints(
+            content_type_id, last_pk, chunk[-1].pk if chunk else None)
+
+        mismatches = []
+        for object in chunk:
+            postings = get_object_postings(object)
+            if postings is None:
+                # not searchable (anymore), stale if indexed
                 continue
-            frequency = keywords.count(keyword)
-            kw, created = Keyword.objects.get_or_create(keyword=keyword)
-            ko, created = KeywordOccurrence.objects.get_or_create(
-                keyword=kw,
-                content_type=content_type,
-                object_id=object.pk,
-                defaults={
-                    'frequency': frequency,
-                    'weight': search_field.weight
-                }
-            )
-            if ko.frequency != frequency or ko.weight != search_field.weight:
-                ko.frequency += frequency
-                ko.weight += search_field.weight
-                ko.save()
+            fingerprint = stored.pop(object.pk, None)
+            if fingerprint != (get_postings_fingerprint(postings)
+                               if postings else None):
+                mismatches.append(object)
+        checked += len(chunk)
+        reindexed += len(mismatches)
+        stale += len(stored)
+        if repair and mismatches:
+            index_objects(mismatches)
+        if repair and stored:
+            unindex_objects([(content_type_id, i) for i in stored])
+
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+    return checked, reindexed, stale
 
 
 def unindex_object(object, object_id=None):
@@ -86,7 +354,118 @@ def unindex_object(object, object_id=None):
         content_type = ContentType.objects.get_for_model(object)
         object_id = object.pk
 
-    for obj in KeywordOccurrence.objects.filter(
-            content_type__pk=content_type.pk,
-            object_id=object_id):
-        obj.delete()
+    unindex_objects([(content_type.pk, object_id)])
+
+
+def unindex_objects(keys):
+    '''
+    Remove the occurrences of the (content_type_id, object_id) keys,
+    with one filtered delete per content type.
+    '''
+    with atomic():
+        frequencies, documents = _unindex_objects(keys)
+        update_document_frequencies(frequencies)
+    add_document_count(-documents)
+    bump_generation()
+
+
+def _unindex_objects(keys):
+    '''
+    Remove the occurrences and return the Counter of keyword ids by
+    which the document frequencies must be decreased (as negative
+    counts) and the number of objects that were indexed.
+    '''
+    object_ids = {}
+    for content_type_id, object_id in keys:
+        object_ids.setdefault(content_type_id, []).append(object_id)
+
+    frequencies = Counter()
+    documents = set()
+    for content_type_id, ids in object_ids.items():
+        for i in range(0, len(ids), IN_QUERY_SIZE):
+            occurrences = KeywordOccurrence.objects.filter(
+                content_type__pk=content_type_id,
+                object_id__in=ids[i:(i + IN_QUERY_SIZE)])
+            for keyword_id, object_id in occurrences.values_list(
+                    'keyword', 'object_id'):
+                frequencies[keyword_id] -= 1
+                documents.add((content_type_id, object_id))
+            occurrences.delete()
+    return frequencies, len(documents)
+
+
+def update_document_frequencies(frequencies):
+    '''
+    Add the Counter of keyword id to delta to the document frequencies
+    of the keywords, with one update per distinct delta.
+    '''
+    keyword_ids = {}
+    for keyword_id, delta in frequencies.items():
+        if delta:
+            keyword_ids.setdefault(delta, []).append(keyword_id)
+
+    for delta, ids in keyword_ids.items():
+        for i in range(0, len(ids), IN_QUERY_SIZE):
+            Keyword.objects.filter(id__in=ids[i:(i + IN_QUERY_SIZE)]).update(
+                document_frequency=F('document_frequency') + delta)
+
+
+def queue_object(object):
+    '''
+    Queue the object for indexing by drain_index_queue().
+    '''
+    try:
+        # use the proxy model, it may be the one with the search fields
+        content_type = ContentType.objects.get_for_model(
+            object, for_concrete_model=False)
+    except TypeError:  # Django 1.4-, get_for_model() skips the proxy
+        opts = object._meta
+        content_type = ContentType.objects.get_or_create(
+            app_label=opts.app_label, model=opts.object_name.lower(),
+            defaults={'name': opts.verbose_name_raw})[0]
+    IndexQueueItem.objects.create(content_type=content_type,
+                                  object_id=object.pk)
+
+
+def drain_index_queue(batch_size=1000):
+    '''
+    Index the queued objects, batch_size queue items at a time. An
+    object that was queued multiple times is indexed only once per
+    batch, objects that no longer exist are unindexed. Returns the
+    number of objects handled.
+    '''
+    count = 0
+    while True:
+        items = list(IndexQueueItem.objects.order_by('id')
+                     .values_list('id', 'content_type', 'object_id')
+                     [0:batch_size])
+        if not items:
+            break
+
+        object_ids = {}
+        for id, content_type_id, object_id in items:
+            object_ids.setdefault(content_type_id, set()).add(object_id)
+
+        with atomic():
+            for content_type_id, ids in object_ids.items():
+                model = ContentType.objects.get_for_id(
+                    content_type_id).model_class()
+                objects = {}
+                if model is not None:
+                    ids = list(ids)
+                    for i in range(0, len(ids), IN_QUERY_SIZE):
+                        objects.update(model._base_manager.in_bulk(
+                            ids[i:(i + IN_QUERY_SIZE)]))
+                    index_objects(objects.values())
+                    content_type_id = ContentType.objects.get_for_model(
+                        model).pk
+                unindex_objects([(content_type_id, i) for i in ids
+                                 if i not in objects])
+                count += len(ids)
+
+            item_ids = [i[0] for i in items]
+            for i in range(0, len(item_ids), IN_QUERY_SIZE):
+                IndexQueueItem.objects.filter(
+                    id__in=item_ids[i:(i + IN_QUERY_SIZE)]).delete()
+        flush_pending()
+    return count
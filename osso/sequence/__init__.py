@@ -33,7 +33,8 @@ db_engine = db_engine.rsplit('.', 1)[-1]
 if db_engine:
     backend = load_backend(db_engine)
 
-    sequence = backend.Sequence()
+    sequence = backend.Sequence(cache=getattr(settings, 'SEQUENCE_CACHE',
+                                              None))
 
     post_syncdb.connect(sequence.install, sender=sequence_app)
 else:
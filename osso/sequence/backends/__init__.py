@@ -1,5 +1,10 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
+import os
 import re
+import threading
+
+from django.db import connection, transaction
+from osso.sequence.signals import sequence_created, sequence_dropped
 
 class SequenceError(ValueError):
     pass
@@ -11,37 +16,275 @@ sequence_name_re = re.compile('^[a-zA-Z]{1}[a-zA-Z0-9_]{0,63}$')
 class BaseSequence(object):
     '''
     Base Sequence class
+
+    Sequences can be put in cached mode, comparable to the PostgreSQL
+    ``CACHE n`` option: nextval() then reserves a block of `n` values
+    in a single database statement and hands them out from process
+    memory until the block is exhausted. Enable it per sequence by
+    calling set_cache() or through the SEQUENCE_CACHE setting, a dict
+    of sequence names to block sizes.
+
+    The contract for cached sequences is the same as PostgreSQL's:
+    - values are still unique across all processes;
+    - values are only increasing within a single process; two
+      processes hand out values from different blocks, so they
+      interleave;
+    - unused values of a block are lost when the process exits (or
+      forks, or calls setval() or drop()), leaving gaps;
+    - currval() returns the database value, i.e. the end of the most
+      recently reserved block, not the last value handed out (use
+      currval(name, local=True) for that, which is kept per thread);
+    - setval() and drop() from another process do not affect the
+      block that this process has already reserved.
+
+    If the backend reserves its blocks transactionally (MySQL,
+    SQLite), a block reserved inside a transaction could be rolled
+    back while this process keeps handing out its values. Therefore
+    nextval() on those backends only uses the cache when in autocommit
+    mode, and falls back to a single value otherwise.
+
+    The start and increment of the sequences are kept in a process-local
+    metadata cache, which is updated through the sequence_created and
+    sequence_dropped signals. Known sequences skip the name validation.
+    Missing sequences are not cached: another process may create them
+    (or a drop may be rolled back) at any time, so they are looked up
+    again every time.
+
+    The public methods do the validation and bookkeeping; the backends
+    implement the underscored methods that talk to the database.
     '''
+    # Whether nextval_many() is undone by a transaction rollback.
+    transactional_nextval = True
+
+    def __init__(self, cache=None):
+        self._cache_lock = threading.RLock()
+        self._cache_pid = os.getpid()
+        self._cache_sizes = {}
+        self._cache_blocks = {}
+        self._metadata = {}
+        self._local = threading.local()
+        for name, size in (cache or {}).items():
+            self.set_cache(name, size)
+
+        sequence_created.connect(self._sequence_created)
+        sequence_dropped.connect(self._sequence_dropped)
+
     def create(self, name, start=1, increment=1):
         '''
-        Create a sequence with identifier `name`
+        create a sequence with identifier `name`
         '''
-        raise NotImplementedError()
+        self.validate_name(name)
+        self._create(name, start, increment)
+        sequence_created.send(sender=self, name=name, start=start,
+                              increment=increment)
 
     def drop(self, name):
         '''
-        Drop the sequence with identifier `name`
+        drop the sequence with identifier `name`
         '''
-        raise NotImplementedError()
+        self.validate_name(name)
+        try:
+            self._drop(name)
+        except SequenceDoesNotExist:
+            # Not there at all, which is just as gone.
+            sequence_dropped.send(sender=self, name=name)
+            raise
+        sequence_dropped.send(sender=self, name=name)
 
-    def currval(self, name):
+    def currval(self, name, local=False):
         '''
         return the current value of the sequence `name`
+
+        If `local` is set, return the last value that nextval() or
+        nextval_many() handed out in this thread instead, without
+        querying the database (like the PostgreSQL currval() does per
+        session).
         '''
-        raise NotImplementedError()
+        if local:
+            self.get_metadata(name)
+            try:
+                return self._last_values[name]
+            except KeyError:
+                raise SequenceError('sequence %r has no value in this '
+                                    'process' % name)
+        return self._checked(self._currval, name)
 
     def nextval(self, name):
         '''
         return the next value for the sequence `name`
         '''
-        raise NotImplementedError()
+        if name in self._cache_sizes and self.can_cache():
+            value = self._cached_nextval(name)
+        else:
+            value = self._checked(self._nextval, name)
+        self._last_values[name] = value
+        return value
+
+    def nextval_many(self, name, count):
+        '''
+        reserve `count` values for the sequence `name` in a single
+        atomic statement and return them as a range object
+
+        The values are consecutive (with the sequence increment as
+        step), except on PostgreSQL when other sessions call nextval()
+        concurrently; then a list of the reserved values is returned.
+        '''
+        self.validate_count(count)
+        values = self._checked(self._nextval_many, name, count)
+        self._last_values[name] = values[-1]
+        return values
 
     def setval(self, name, value):
         '''
         set the value for sequence `name` to `value`
         '''
+        self.discard_cache(name)
+        self._checked(self._setval, name, value)
+
+    def get_metadata(self, name):
+        '''
+        return a (start, increment) tuple for the sequence `name`, from
+        the process-local cache if possible
+        '''
+        try:
+            return self._metadata[name]
+        except KeyError:
+            pass
+
+        self.validate_name(name)
+        metadata = self._get_metadata(name)
+        if metadata is None:
+            raise SequenceDoesNotExist('sequence %r does not exist' % name)
+        self._metadata[name] = metadata
+        return metadata
+
+    @property
+    def _last_values(self):
+        # The values for currval(local=True), per thread.
+        try:
+            return self._local.last_values
+        except AttributeError:
+            self._local.last_values = {}
+            return self._local.last_values
+
+    def _checked(self, func, name, *args):
+        self.get_metadata(name)
+        try:
+            return func(name, *args)
+        except SequenceDoesNotExist:
+            # Dropped by someone else.
+            self._forget(name)
+            raise
+
+    def _forget(self, name):
+        self._metadata.pop(name, None)
+        self._last_values.pop(name, None)
+        self.discard_cache(name)
+
+    def _sequence_created(self, sender, name, start, increment, **kwargs):
+        self._forget(name)
+        self._metadata[name] = (start, increment)
+
+    def _sequence_dropped(self, sender, name, **kwargs):
+        self._forget(name)
+
+    def _create(self, name, start, increment):
+        '''
+        create the sequence `name` in the database
+        '''
+        raise NotImplementedError()
+
+    def _drop(self, name):
+        '''
+        drop the sequence `name` from the database
+        '''
         raise NotImplementedError()
 
+    def _currval(self, name):
+        '''
+        return the current value of the sequence `name` from the database
+        '''
+        raise NotImplementedError()
+
+    def _nextval(self, name):
+        '''
+        return the next value for the sequence `name` from the database
+        '''
+        raise NotImplementedError()
+
+    def _nextval_many(self, name, count):
+        '''
+        reserve `count` values for the sequence `name` in the database
+        '''
+        raise NotImplementedError()
+
+    def _setval(self, name, value):
+        '''
+        set the value for sequence `name` to `value` in the database
+        '''
+        raise NotImplementedError()
+
+    def _get_metadata(self, name):
+        '''
+        return a (start, increment) tuple for the sequence `name` from
+        the database, or None if it does not exist
+        '''
+        raise NotImplementedError()
+
+    def set_cache(self, name, size):
+        '''
+        make nextval() reserve blocks of `size` values for the sequence
+        `name`; a size of 1 or less disables the cache again
+        '''
+        self.validate_name(name)
+        with self._cache_lock:
+            self._cache_blocks.pop(name, None)
+            if size > 1:
+                self._cache_sizes[name] = int(size)
+            else:
+                self._cache_sizes.pop(name, None)
+
+    def discard_cache(self, name=None):
+        '''
+        forget the values reserved by this process for sequence `name`
+        (or for all sequences); they will never be handed out
+        '''
+        with self._cache_lock:
+            if name is None:
+                self._cache_blocks.clear()
+            else:
+                self._cache_blocks.pop(name, None)
+
+    def can_cache(self):
+        '''
+        whether reserved blocks survive the current transaction state
+        '''
+        if not self.transactional_nextval:
+            return True
+        if getattr(connection, 'in_atomic_block', False):
+            return False
+        try:
+            return transaction.get_autocommit()  # Django 1.6+
+        except AttributeError:
+            return not transaction.is_managed()
+
+    def _cached_nextval(self, name):
+        with self._cache_lock:
+            if self._cache_pid != os.getpid():
+                # We were forked: our parent hands out the same values.
+                self._cache_pid = os.getpid()
+                self._cache_blocks.clear()
+
+            block = self._cache_blocks.get(name)
+            if block is not None:
+                for value in block:
+                    return value
+
+            block = iter(self._checked(self._nextval_many, name,
+                                       self._cache_sizes[name]))
+            self._cache_blocks[name] = block
+            return next(block)
+
     def install(self, **kwargs):
         '''
         hook to prepare the database for sequences
@@ -56,6 +299,13 @@ class BaseSequence(object):
         if not match:
             raise SequenceError('invalid sequence name %r' % name)
 
+    def validate_count(self, count):
+        '''
+        validate if the given count is a valid number of values
+        '''
+        if count < 1:
+            raise SequenceError('invalid value count %r' % (count,))
+
     def has_savepoint_issues(self):
         '''
         set to true if this connection has problems with savepoints in
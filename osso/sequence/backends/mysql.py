@@ -6,6 +6,7 @@ from MySQLdb import IntegrityError, OperationalError
 
 from django.db import (DatabaseError, IntegrityError as DjangoIntegrityError,
                        connection, transaction)
+from osso.core.loanwords import xrange64
 from osso.sequence.backends import (BaseSequence, SequenceDoesNotExist,
                                     SequenceError)
 
@@ -14,11 +15,63 @@ class Sequence(BaseSequence):
     '''
     MySQL Sequence class
     '''
-    def create(self, name, start=1, increment=1):
+    NEXTVAL_PROCEDURE = 'procedure'
+    NEXTVAL_FUNCTION = 'function'
+    NEXTVAL_UPDATE = 'update'
+
+    def __init__(self, *args, **kwargs):
+        super(Sequence, self).__init__(*args, **kwargs)
+        self._nextval_strategy = None
+        self._nextval_strategies = {}
+
+    def get_nextval_strategy(self):
+        '''
+        Return how nextval() obtains its values: by calling the nextval
+        stored procedure, by selecting the (older) nextval stored
+        function, or by a plain UPDATE when neither routine exists.
+
+        The routines are looked up once per database connection alias
+        and server version, so a reconnect to another (e.g. failed
+        over) server probes again. Assign nextval_strategy to override
+        the choice for all connections; assign None to probe again.
+        '''
+        if self._nextval_strategy is not None:
+            return self._nextval_strategy
+
+        cursor = connection.cursor()
+        # The cursor() call has connected us, so we can ask the server.
+        key = (connection.alias, connection.connection.get_server_info())
+        strategy = self._nextval_strategies.get(key)
+        if strategy is None:
+            cursor.execute('SELECT routine_type '
+                           'FROM information_schema.routines '
+                           'WHERE routine_schema = DATABASE() '
+                           'AND routine_name = %s',
+                           ('nextval',))
+            types = set(row[0].upper() for row in cursor.fetchall())
+            if 'PROCEDURE' in types:
+                strategy = self.NEXTVAL_PROCEDURE
+            elif 'FUNCTION' in types:
+                strategy = self.NEXTVAL_FUNCTION
+            else:
+                strategy = self.NEXTVAL_UPDATE
+            self._nextval_strategies[key] = strategy
+        return strategy
+
+    def set_nextval_strategy(self, value):
+        if value not in (self.NEXTVAL_PROCEDURE, self.NEXTVAL_FUNCTION,
+                         self.NEXTVAL_UPDATE, None):
+            raise ValueError('invalid nextval strategy %r' % (value,))
+        self._nextval_strategy = value
+        if value is None:
+            self._nextval_strategies.clear()
+
+    nextval_strategy = property(get_nextval_strategy, set_nextval_strategy)
+
+    def _create(self, name, start, increment):
         '''
         Create a sequence with identifier `name`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
 
         sid = transaction.savepoint()
@@ -37,22 +90,20 @@ class Sequence(BaseSequence):
         else:
             transaction.savepoint_commit(sid)
 
-    def drop(self, name):
+    def _drop(self, name):
         '''
         Drop the sequence with identifier `name` if it exists
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         rows = cursor.execute('DELETE FROM sequence_sequence WHERE name = %s',
                               (name,))
         if rows == 0:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
-    def currval(self, name):
+    def _currval(self, name):
         '''
         Return the current value of the sequence `name`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         cursor.execute('SELECT value FROM sequence_sequence WHERE name = %s',
                        (name,))
@@ -63,13 +114,13 @@ class Sequence(BaseSequence):
             raise SequenceError('sequence %r has no value' % name)
         return row[0]
 
-    def nextval(self, name):
+    def _nextval(self, name):
         '''
         Return the next value for the sequence `name`
         '''
-        self.validate_name(name)
+        strategy = self.nextval_strategy
         cursor = connection.cursor()
-        try:
+        if strategy == self.NEXTVAL_PROCEDURE:
             # The new way. We're using a stored prodecure nowadays
             # instead of a function, because the function does not
             # guarantee proper replication. The SP will get split up
@@ -77,25 +128,57 @@ class Sequence(BaseSequence):
             # http://dev.mysql.com/doc/refman/5.1/en/ \
             #        stored-programs-logging.html
             cursor.callproc('nextval', (name,))
-        except (DatabaseError, OperationalError):  # SP does not exist
+            row = cursor.fetchone()
+            discard = cursor.nextset()  # must call nextset for SP
+            assert discard == 1
+        elif strategy == self.NEXTVAL_FUNCTION:
             # The old way
             cursor.execute('SELECT nextval(%s)',
                            (name,))
             row = cursor.fetchone()
         else:
-            row = cursor.fetchone()
-            discard = cursor.nextset()  # must call nextset for SP
-            assert discard == 1
+            # No stored routine: the UPDATE does the same as the SP.
+            # The LAST_INSERT_ID(expr) value is returned to the client
+            # as insert id, so we need no additional SELECT.
+            rows = cursor.execute('UPDATE sequence_sequence '
+                                  'SET value = LAST_INSERT_ID('
+                                  '    COALESCE(value + increment, start)) '
+                                  'WHERE name = %s',
+                                  (name,))
+            row = rows and (cursor.lastrowid,) or None
 
         if row is None or row[0] is None:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
         return row[0]
 
-    def setval(self, name, value):
+    def _nextval_many(self, name, count):
+        '''
+        Reserve `count` consecutive values for the sequence `name`
+        '''
+        cursor = connection.cursor()
+        # A plain UPDATE replicates fine, unlike the nextval function.
+        rows = cursor.execute('UPDATE sequence_sequence '
+                              'SET value = LAST_INSERT_ID('
+                              '    COALESCE(value + increment * %s, '
+                              '             start + increment * %s)) '
+                              'WHERE name = %s',
+                              (count, count - 1, name))
+        if rows == 0:
+            raise SequenceDoesNotExist('sequence %r does not exist' % name)
+        # Read the increment of the row we updated (its lock is held in
+        # a transaction), not the one of our metadata cache: another
+        # process may have dropped and re-created the sequence.
+        cursor.execute('SELECT LAST_INSERT_ID(), increment '
+                       'FROM sequence_sequence WHERE name = %s',
+                       (name,))
+        last, increment = cursor.fetchone()
+        return xrange64(last - increment * (count - 1), last + increment,
+                        increment)
+
+    def _setval(self, name, value):
         '''
         Set the value for sequence `name` to `value`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         rows = cursor.execute('UPDATE sequence_sequence SET value = %s '
                               'WHERE name = %s',
@@ -103,10 +186,23 @@ class Sequence(BaseSequence):
         if rows == 0:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
+    def _get_metadata(self, name):
+        '''
+        Return the (start, increment) of the sequence `name`
+        '''
+        cursor = connection.cursor()
+        cursor.execute('SELECT start, increment FROM sequence_sequence '
+                       'WHERE name = %s',
+                       (name,))
+        row = cursor.fetchone()
+        return row and tuple(row)
+
     def install(self, **kwargs):
         '''
         Hook to prepare the database for sequences
         '''
+        # Probe again after creating the SP.
+        self._nextval_strategies.clear()
         cursor = connection.cursor()
         try:
             cursor.execute('''
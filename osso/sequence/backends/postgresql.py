@@ -2,6 +2,7 @@
 from functools import wraps
 
 from django.db import DatabaseError, connection, transaction
+from osso.core.loanwords import xrange64
 from osso.sequence.backends import (BaseSequence, SequenceDoesNotExist,
                                     SequenceError)
 
@@ -28,6 +29,9 @@ class Sequence(BaseSequence):
     """
     PostgreSQL Sequence class
     """
+    # PostgreSQL sequences are never rolled back.
+    transactional_nextval = False
+
     def seqname(self, name):
         # http://www.postgresql.org/docs/9.3/static/sql-syntax-lexical.html\
         #   #SQL-SYNTAX-IDENTIFIERS
@@ -49,11 +53,10 @@ class Sequence(BaseSequence):
         return '\'"%s"\'::text' % (self.seqname(name),)
 
     @savepoint
-    def create(self, name, start=1, increment=1):
+    def _create(self, name, start, increment):
         '''
         Create a sequence with identifier `name`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         try:
             cursor.execute('CREATE SEQUENCE "%s" '
@@ -63,11 +66,10 @@ class Sequence(BaseSequence):
             raise SequenceError('sequence %r already exists' % name)
 
     @savepoint
-    def drop(self, name):
+    def _drop(self, name):
         '''
         Drop the sequence with identifier `name` if it exists
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         try:
             cursor.execute('DROP SEQUENCE "%s"' % (self.seqname(name),))
@@ -75,11 +77,10 @@ class Sequence(BaseSequence):
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
     @savepoint
-    def currval(self, name):
+    def _currval(self, name):
         '''
         Return the current value of the sequence `name`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         try:
             cursor.execute('SELECT last_value, is_called from "%s"' %
@@ -93,11 +94,10 @@ class Sequence(BaseSequence):
         return value
 
     @savepoint
-    def nextval(self, name):
+    def _nextval(self, name):
         '''
         Return the next value for the sequence `name`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         try:
             cursor.execute('SELECT nextval(%s)' % (self.seqname2(name),))
@@ -108,11 +108,33 @@ class Sequence(BaseSequence):
         return row[0]
 
     @savepoint
-    def setval(self, name, value):
+    def _nextval_many(self, name, count):
+        '''
+        Reserve `count` values for the sequence `name`
+        '''
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT nextval(%s) FROM generate_series(1, %%s)' %
+                           (self.seqname2(name),), (count,))
+        except DatabaseError:
+            raise SequenceDoesNotExist('sequence %r does not exist' % name)
+        values = [row[0] for row in cursor.fetchall()]
+
+        # There is no atomic "advance by n" for sequences (a setval()
+        # based on nextval() races with other sessions), so all values
+        # come from a single nextval() series instead. They are
+        # consecutive unless another session interleaved.
+        step = (values[-1] - values[0]) // (count - 1) if count > 1 else 1
+        if step and values == list(xrange64(values[0], values[-1] + step,
+                                            step)):
+            return xrange64(values[0], values[-1] + step, step)
+        return values
+
+    @savepoint
+    def _setval(self, name, value):
         '''
         Set the value for sequence `name` to `value`
         '''
-        self.validate_name(name)
         cursor = connection.cursor()
         try:
             cursor.execute('SELECT setval(%s, %s)' %
@@ -120,6 +142,20 @@ class Sequence(BaseSequence):
         except DatabaseError:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
+    def _get_metadata(self, name):
+        '''
+        Return the (start, increment) of the sequence `name`
+        '''
+        cursor = connection.cursor()
+        cursor.execute('SELECT start_value, increment '
+                       'FROM information_schema.sequences '
+                       'WHERE sequence_schema = current_schema() '
+                       'AND sequence_name = %s',
+                       (self.seqname(name),))
+        row = cursor.fetchone()
+        # The information_schema has them as character data.
+        return row and (int(row[0]), int(row[1]))
+
     def install(self, **kwargs):
         '''
         Hook to prepare the database for sequences
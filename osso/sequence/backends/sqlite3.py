@@ -4,6 +4,7 @@ try:
     from django.db.utils import DatabaseError, IntegrityError
 except ImportError:  # Django 1.1-
     from django.db.backends.sqlite3.base import DatabaseError, IntegrityError
+from osso.core.loanwords import xrange64
 from osso.sequence.backends import (BaseSequence, SequenceDoesNotExist,
                                     SequenceError)
 
@@ -55,12 +56,10 @@ class Sequence(BaseSequence):
         """
         pass
 
-    def create(self, name, start=1, increment=1):
+    def _create(self, name, start, increment):
         """
         Create a sequence with identifier ``name``.
         """
-        self.validate_name(name)
-
         cursor = connection.cursor()
         self.lock(cursor)
         try:
@@ -73,12 +72,10 @@ class Sequence(BaseSequence):
         finally:
             self.unlock(cursor)
 
-    def drop(self, name):
+    def _drop(self, name):
         """
         Drop the sequence with identifier ``name`` if it exists.
         """
-        self.validate_name(name)
-
         cursor = connection.cursor()
         self.lock(cursor)
         try:
@@ -92,12 +89,10 @@ class Sequence(BaseSequence):
         if rowcount == 0:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
-    def currval(self, name):
+    def _currval(self, name):
         """
         Return the current value of the sequence ``name``.
         """
-        self.validate_name(name)
-
         cursor = connection.cursor()
         self.lock(cursor)
         try:
@@ -116,12 +111,10 @@ class Sequence(BaseSequence):
 
         return value
 
-    def nextval(self, name):
+    def _nextval(self, name):
         """
         Return the next value for the sequence ``name``.
         """
-        self.validate_name(name)
-
         cursor = connection.cursor()
         self.lock(cursor)
         try:
@@ -150,12 +143,36 @@ class Sequence(BaseSequence):
 
         return value
 
-    def setval(self, name, value):
+    def _nextval_many(self, name, count):
         """
-        Set the value for sequence ``name`` to ``value``.
+        Reserve ``count`` consecutive values for the sequence ``name``.
         """
-        self.validate_name(name)
+        cursor = connection.cursor()
+        self.lock(cursor)
+        try:
+            cursor.execute('UPDATE sequence_sequence '
+                           'SET value = COALESCE(value + increment * %s, '
+                           '                     start + increment * %s) '
+                           'WHERE name = %s',
+                           (count, count - 1, name))
+            cursor.execute('SELECT value, increment FROM sequence_sequence '
+                           'WHERE name = %s',
+                           (name,))
+            row = cursor.fetchone()
+            if row is None:
+                raise SequenceDoesNotExist('sequence %r does not exist' % name)
+
+            last, increment = row
+        finally:
+            self.unlock(cursor)
+
+        return xrange64(last - increment * (count - 1), last + increment,
+                        increment)
 
+    def _setval(self, name, value):
+        """
+        Set the value for sequence ``name`` to ``value``.
+        """
         cursor = connection.cursor()
         self.lock(cursor)
         try:
@@ -170,6 +187,17 @@ class Sequence(BaseSequence):
         if rowcount == 0:
             raise SequenceDoesNotExist('sequence %r does not exist' % name)
 
+    def _get_metadata(self, name):
+        """
+        Return the ``(start, increment)`` of the sequence ``name``.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT start, increment FROM sequence_sequence '
+                       'WHERE name = %s',
+                       (name,))
+        row = cursor.fetchone()
+        return row and tuple(row)
+
     def install(self, **kwargs):
         """
         Hook to prepare the database for sequences.
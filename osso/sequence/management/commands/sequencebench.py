@@ -0,0 +1,221 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import multiprocessing
+import optparse
+import os
+import threading
+from timeit import default_timer
+
+from django import VERSION as django_version
+from django.db import connection
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.core.management.bench import (
+    per_second, summarize, timed, write_json)
+from osso.sequence import SequenceError, sequence
+
+
+def _process_worker(args):
+    name, iterations, cache = args
+    # The parent closed its connection before forking, so we get our
+    # own here.
+    try:
+        if cache:
+            sequence.set_cache(name, cache)
+        return timed(lambda: sequence.nextval(name), iterations)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Benchmark the osso.sequence backend of the default database.
+
+    Measures throughput and p50/p99 latency of nextval, cached nextval,
+    nextval_many, currval, setval, create (including the savepoint
+    rollback of a duplicate create) and has_savepoint_issues, single
+    threaded and with multiple threads and processes. The results are
+    written as JSON, so they can be compared between releases.
+
+    The multi-threaded and multi-process cases need a database that is
+    shared between connections; they are skipped for in-memory SQLite.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--iterations', action='store', type='int', default=1000,
+                help='Calls per case and per worker (default 1000)'),
+            optparse.make_option(
+                '--workers', action='store', type='int', default=4,
+                help='Threads/processes for the concurrent cases '
+                     '(default 4)'),
+            optparse.make_option(
+                '--cache', action='store', type='int', default=100,
+                help='Block size for the cached cases (default 100)'),
+            optparse.make_option(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                '--iterations', action='store', type=int, default=1000,
+                help='Calls per case and per worker (default 1000)')
+            parser.add_argument(
+                '--workers', action='store', type=int, default=4,
+                help='Threads/processes for the concurrent cases (default 4)')
+            parser.add_argument(
+                '--cache', action='store', type=int, default=100,
+                help='Block size for the cached cases (default 100)')
+            parser.add_argument(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout')
+
+    def handle(self, *args, **kwargs):
+        if sequence is None:
+            raise CommandError('No sequence backend configured')
+
+        self.iterations = int(kwargs.get('iterations') or 1000)
+        self.workers = int(kwargs.get('workers') or 4)
+        self.cache = int(kwargs.get('cache') or 100)
+        if self.iterations < 1 or self.workers < 1 or self.cache < 2:
+            raise CommandError('Need positive iterations and workers and '
+                               'a cache of at least 2')
+
+        # Unique per run, so we don't trample on concurrent runs.
+        self.name = 'bench%d' % (os.getpid(),)
+        sequence.create(self.name)
+        try:
+            results = self.run_cases()
+        finally:
+            sequence.set_cache(self.name, 0)
+            sequence.drop(self.name)
+
+        data = {
+            'backend': sequence.__class__.__module__.rsplit('.', 1)[-1],
+            'vendor': connection.vendor,
+            'iterations': self.iterations,
+            'workers': self.workers,
+            'cache': self.cache,
+            'results': results,
+        }
+        write_json(self.stdout, data, kwargs.get('output'))
+
+    def run_cases(self):
+        name = self.name
+        results = []
+
+        results.append(self.measure(
+            'nextval', lambda: sequence.nextval(name)))
+        results.append(self.measure(
+            'currval', lambda: sequence.currval(name)))
+        results.append(self.measure(
+            'setval', lambda: sequence.setval(name, 1)))
+
+        sequence.set_cache(name, self.cache)
+        try:
+            results.append(self.measure(
+                'nextval_cached', lambda: sequence.nextval(name),
+                cached=sequence.can_cache()))
+        finally:
+            sequence.set_cache(name, 0)
+
+        results.append(self.measure(
+            'nextval_many', lambda: sequence.nextval_many(name, self.cache),
+            values_per_op=self.cache))
+
+        results.append(self.measure(
+            'has_savepoint_issues', sequence.has_savepoint_issues))
+        results.append(self.measure('create_drop', self.create_drop))
+        results.append(self.measure('create_duplicate',
+                                    self.create_duplicate))
+
+        if self.is_shared_database():
+            for cache in (None, self.cache):
+                suffix = cache and '_cached' or ''
+                for case, run in (('nextval_threads', self.run_threads),
+                                  ('nextval_processes', self.run_processes)):
+                    t0 = default_timer()
+                    latencies = run(cache)
+                    results.append(self.result(
+                        case + suffix, latencies, default_timer() - t0,
+                        workers=self.workers))
+        else:
+            for case in ('nextval_threads', 'nextval_processes'):
+                results.append({'case': case,
+                                'skipped': 'in-memory database'})
+
+        return results
+
+    def measure(self, case, func, **extra):
+        t0 = default_timer()
+        latencies = timed(func, self.iterations)
+        return self.result(case, latencies, default_timer() - t0, **extra)
+
+    def result(self, case, latencies, elapsed, **extra):
+        return summarize(case, latencies, elapsed,
+                         ops_per_second=per_second(len(latencies), elapsed),
+                         **extra)
+
+    def create_drop(self):
+        sequence.create(self.name + 'x')
+        sequence.drop(self.name + 'x')
+
+    def create_duplicate(self):
+        # Takes the savepoint rollback path on MySQL and PostgreSQL.
+        try:
+            sequence.create(self.name)
+        except SequenceError:
+            pass
+        else:
+            raise AssertionError('duplicate create did not fail')
+
+    def is_shared_database(self):
+        if connection.vendor != 'sqlite':
+            return True
+        name = connection.settings_dict['NAME']
+        return name and name != ':memory:' and 'mode=memory' not in name
+
+    def run_threads(self, cache):
+        results = []
+
+        def worker():
+            try:
+                results.append(
+                    timed(lambda: sequence.nextval(self.name),
+                          self.iterations))
+            finally:
+                connection.close()
+
+        if cache:
+            sequence.set_cache(self.name, cache)
+        try:
+            threads = [threading.Thread(target=worker)
+                       for i in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sequence.set_cache(self.name, 0)
+
+        if len(results) != self.workers:
+            raise CommandError('%d of %d threads failed' % (
+                self.workers - len(results), self.workers))
+        return [i for latencies in results for i in latencies]
+
+    def run_processes(self, cache):
+        # Don't share our connection with the children.
+        connection.close()
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            results = pool.map(
+                _process_worker,
+                [(self.name, self.iterations, cache)] * self.workers)
+        finally:
+            pool.close()
+            pool.join()
+        return [i for latencies in results for i in latencies]
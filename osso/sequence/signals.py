@@ -0,0 +1,10 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+from django.dispatch import Signal
+
+
+# Sent after a sequence has been created or dropped through a Sequence
+# backend. The backends listen to these themselves to keep their
+# process-local metadata cache up to date. The sender is the backend
+# instance.
+sequence_created = Signal(providing_args=('name', 'start', 'increment'))
+sequence_dropped = Signal(providing_args=('name',))
@@ -1,3 +1,4 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
+from .test_commands import *
 from .test_doctest import *
 from .test_sequence import *
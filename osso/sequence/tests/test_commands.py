@@ -0,0 +1,27 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import json
+import os
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from .. import SequenceDoesNotExist, sequence
+
+
+class SequenceBenchTestCase(TestCase):
+    def test_sequencebench(self):
+        out = StringIO()
+        call_command('sequencebench', iterations=5, cache=3, stdout=out)
+        data = json.loads(out.getvalue())
+
+        cases = dict((i['case'], i) for i in data['results'])
+        self.assertEqual(cases['nextval']['ops'], 5)
+        self.assertEqual(cases['nextval_many']['values_per_op'], 3)
+        self.assertIn('p99_us', cases['create_duplicate'])
+        # The test database lives in memory.
+        self.assertIn('skipped', cases['nextval_threads'])
+
+        # The benchmark sequence is cleaned up.
+        name = 'bench%d' % (os.getpid(),)
+        self.assertRaises(SequenceDoesNotExist, sequence.currval, name)
@@ -1,5 +1,7 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
-from django.test import TestCase
+import threading
+
+from django.test import TestCase, TransactionTestCase
 
 from .. import SequenceDoesNotExist, SequenceError, sequence
 
@@ -45,6 +47,29 @@ class SequenceTest(TestCase):
         self.assertEqual(sequence.nextval('counter'), 3)
         self.assertEqual(sequence.nextval('invoice'), 120)
 
+    def test_nextval_many(self):
+        sequence.create('counter')
+        sequence.create('invoice', start=100, increment=10)
+
+        self.assertEqual(list(sequence.nextval_many('counter', 3)),
+                         [1, 2, 3])
+        self.assertEqual(sequence.currval('counter'), 3)
+        self.assertEqual(list(sequence.nextval_many('counter', 1)), [4])
+        self.assertEqual(sequence.nextval('counter'), 5)
+
+        self.assertEqual(sequence.nextval('invoice'), 100)
+        values = sequence.nextval_many('invoice', 1000)
+        self.assertEqual(len(values), 1000)
+        self.assertEqual((values[0], values[-1]), (110, 10100))
+        self.assertEqual(sequence.nextval('invoice'), 10110)
+
+    def test_nextval_many_errors(self):
+        sequence.create('counter')
+        self.assertRaises(SequenceError, sequence.nextval_many, 'counter', 0)
+        self.assertRaises(SequenceError, sequence.nextval_many, '1337', 1)
+        self.assertRaises(SequenceDoesNotExist,
+                          sequence.nextval_many, 'invoice', 5)
+
     def test_reset(self):
         sequence.create('counter')
         self.assertEqual(sequence.nextval('counter'), 1)
@@ -135,3 +160,129 @@ class SequenceTest(TestCase):
         sequence.create('Counter')
         sequence.drop('Counter')
         self.assertEqual(sequence.nextval('counter'), 1)
+
+    def test_currval_local(self):
+        sequence.create('counter')
+        sequence.create('invoice', start=100, increment=10)
+        self.assertRaises(SequenceError, sequence.currval, 'counter', True)
+
+        self.assertEqual(sequence.nextval('counter'), 1)
+        self.assertEqual(list(sequence.nextval_many('invoice', 3)),
+                         [100, 110, 120])
+        sequence.setval('counter', 10)  # someone else
+        with self.assertNumQueries(0):
+            self.assertEqual(sequence.currval('counter', local=True), 1)
+            self.assertEqual(sequence.currval('invoice', local=True), 120)
+        self.assertEqual(sequence.currval('counter'), 10)
+
+    def test_metadata(self):
+        sequence.create('invoice', start=100, increment=10)
+        with self.assertNumQueries(0):
+            self.assertEqual(sequence.get_metadata('invoice'), (100, 10))
+
+        sequence.drop('invoice')
+        # Missing sequences are looked up again.
+        with self.assertNumQueries(2):
+            self.assertRaises(SequenceDoesNotExist,
+                              sequence.nextval, 'invoice')
+            self.assertRaises(SequenceDoesNotExist,
+                              sequence.currval, 'invoice')
+
+        sequence.create('invoice', start=5)
+        self.assertEqual(sequence.get_metadata('invoice'), (5, 1))
+        self.assertEqual(sequence.nextval('invoice'), 5)
+
+    def test_metadata_unknown(self):
+        # Created by someone else.
+        sequence.create('counter')
+        sequence._forget('counter')
+        self.assertEqual(sequence.get_metadata('counter'), (1, 1))
+
+        # Dropped by someone else.
+        sequence._drop('counter')
+        self.assertRaises(SequenceDoesNotExist, sequence.nextval, 'counter')
+        self.assertRaises(SequenceDoesNotExist, sequence.nextval, 'counter')
+
+        # And created again right after the miss.
+        sequence._create('counter', 1, 1)
+        self.assertEqual(sequence.nextval('counter'), 1)
+
+    def test_currval_local_thread(self):
+        sequence.create('counter')
+        self.assertEqual(sequence.nextval('counter'), 1)
+        errors = []
+
+        def currval():
+            try:
+                sequence.currval('counter', local=True)
+            except SequenceError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=currval)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(sequence.currval('counter', local=True), 1)
+
+
+class CachedSequenceTest(TransactionTestCase):
+    def setUp(self):
+        sequence.create('counter')
+        sequence.create('invoice', start=100, increment=10)
+        sequence.set_cache('counter', 5)
+        sequence.set_cache('invoice', 3)
+
+    def tearDown(self):
+        sequence.set_cache('counter', 0)
+        sequence.set_cache('invoice', 0)
+        sequence.drop('counter')
+        sequence.drop('invoice')
+
+    def test_block(self):
+        self.assertEqual(sequence.nextval('counter'), 1)
+        # The entire block is reserved in the database.
+        self.assertEqual(sequence.currval('counter'), 5)
+        self.assertEqual([sequence.nextval('counter') for i in range(5)],
+                         [2, 3, 4, 5, 6])
+        self.assertEqual(sequence.currval('counter'), 10)
+
+    def test_increment(self):
+        self.assertEqual([sequence.nextval('invoice') for i in range(4)],
+                         [100, 110, 120, 130])
+        self.assertEqual(sequence.currval('invoice'), 150)
+
+    def test_setval_discards_block(self):
+        self.assertEqual(sequence.nextval('counter'), 1)
+        sequence.setval('counter', 20)
+        self.assertEqual(sequence.nextval('counter'), 21)
+
+    def test_other_process(self):
+        self.assertEqual(sequence.nextval('counter'), 1)
+        # Another process reserves the next block.
+        sequence.nextval_many('counter', 5)
+        self.assertEqual(sequence.nextval('counter'), 2)
+        sequence.discard_cache()
+        self.assertEqual(sequence.nextval('counter'), 11)
+
+    def test_does_not_exist(self):
+        sequence.set_cache('nothing', 5)
+        try:
+            self.assertRaises(SequenceDoesNotExist,
+                              sequence.nextval, 'nothing')
+        finally:
+            sequence.set_cache('nothing', 0)
+
+
+class CachedSequenceInTransactionTest(TestCase):
+    def test_no_block(self):
+        # Inside a transaction, the reservation could be rolled back,
+        # so MySQL and SQLite do not cache.
+        sequence.create('counter')
+        sequence.set_cache('counter', 5)
+        try:
+            self.assertEqual(sequence.nextval('counter'), 1)
+            if sequence.transactional_nextval:
+                self.assertEqual(sequence.currval('counter'), 1)
+            self.assertEqual(sequence.nextval('counter'), 2)
+        finally:
+            sequence.set_cache('counter', 0)
@@ -4,9 +4,11 @@ from importlib import import_module
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from osso.sms.pool import SendResult, submit
+
 
 __all__ = ('BackendError', 'DestinationError', 'TransientError',
-           'get_connection', 'BaseSmsBackend')
+           'get_connection', 'get_connection_async', 'BaseSmsBackend')
 
 
 class BackendError(Exception):
@@ -59,11 +61,22 @@ def get_connection(backend=None, fail_silently=False, **kwargs):
     return klass(fail_silently=fail_silently, **kwargs)
 
 
+def get_connection_async(backend=None, fail_silently=False, **kwargs):
+    '''
+    Like get_connection(), but set up the backend in the sms thread
+    pool. Returns a result whose get() returns the backend.
+    '''
+    return submit(get_connection, backend, fail_silently=fail_silently,
+                  **kwargs)
+
+
 class BaseSmsBackend(object):
     '''
     Base class for sms backend implementations.
 
-    Subclasses must at least overwrite send_messages().
+    Subclasses must at least overwrite send_messages(), which sends in
+    the calling thread. Backends that can send several messages at
+    once can overwrite send_messages_async() as well.
     '''
     def __init__(self, fail_silently=False, **kwargs):
         self.fail_silently = fail_silently
@@ -75,3 +88,27 @@ class BaseSmsBackend(object):
         sent messages.
         '''
         raise NotImplementedError()
+
+    def send_messages_async(self, sms_messages, reply_to=None,
+                            shortcode_keyword=None, tariff_cent=None):
+        '''
+        Start sending one or more TextMessage objects and return a
+        SendResult, whose get() returns the number of sent messages.
+        By default send_messages() is called in the sms thread pool.
+
+        The pool threads have database connections of their own: the
+        messages are saved outside any transaction of the caller, so
+        they must have been committed before. Use send_messages() to
+        send from within a transaction.
+        '''
+        return SendResult([submit(
+            self.send_messages, sms_messages, reply_to=reply_to,
+            shortcode_keyword=shortcode_keyword, tariff_cent=tariff_cent)])
+
+    def get_gateway(self, message):
+        '''
+        Return the key of the gateway that the message will be sent
+        through, or None for the default gateway. The dispatcher keeps
+        concurrency and rate limits per gateway.
+        '''
+        return None
@@ -1,6 +1,7 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
 import datetime, sys, threading
 from osso.sms import BaseSmsBackend
+from osso.sms.pool import SendResult, call_now
 
 
 class ConsoleSmsBackend(BaseSmsBackend):
@@ -10,6 +11,13 @@ class ConsoleSmsBackend(BaseSmsBackend):
         super(ConsoleSmsBackend, self).__init__(*args, **kwargs)
 
     def send_messages(self, sms_messages, reply_to=None, shortcode_keyword=None, tariff_cent=None):
+        return self.send_messages_async(sms_messages, reply_to, shortcode_keyword, tariff_cent).get()
+
+    def send_messages_async(self, sms_messages, reply_to=None, shortcode_keyword=None, tariff_cent=None):
+        # Writing to the stream does not block, so we are done already.
+        return SendResult([call_now(self._write, sms_messages)])
+
+    def _write(self, sms_messages):
         self._lock.acquire()
         try:
             for message in sms_messages:
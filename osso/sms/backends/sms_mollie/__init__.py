@@ -13,6 +13,7 @@ from xml.dom.minidom import parseString
 from django.core.mail import mail_admins
 from osso.aboutconfig.utils import aboutconfig
 from osso.sms import BaseSmsBackend
+from osso.sms.httpclient import get_http_client
 from osso.sms.utils import sms_bodies_needed, sms_split
 
 try:
@@ -39,6 +40,7 @@ URL_CHOICES = (
 
 class MollieSmsBackend(BaseSmsBackend):
     def __init__(self, *args, **kwargs):
+        self.http_client = kwargs.pop('http_client', None) or get_http_client()
         super(MollieSmsBackend, self).__init__(*args, **kwargs)
         self.url = aboutconfig('sms.backends.sms_mollie.url',
                                URL_CHOICES[0]).encode('utf-8')
@@ -314,15 +316,17 @@ class MollieSmsBackend(BaseSmsBackend):
             fail_silently=True)
 
         try:
-            # Do not forget the timeout here. Also we need to be wary of
+            # The shared client reuses the connection to the gateway and
+            # applies the SMS_HTTP_TIMEOUT. Also we need to be wary of
             # a python (2.6/2.7) bug in ssl.py. See these and confirm
             # that it has been fixed locally.
             # http://bugs.python.org/issue5103
             # http://svn.python.org/view?view=rev&revision=80453
             # http://svn.python.org/view/python/branches/release26-maint/\
             #   Lib/ssl.py?r1=80453&r2=80452&pathrev=80453&diff_format=u
-            response = urllib2.urlopen(url, timeout=20)
-            responsexml = response.read()
+            response = self.http_client.get(url)
+            response.raise_for_status()
+            responsexml = response.body
         except urllib2.URLError as e:  # (should catch more errors here?)
             log('result: %r' % (e.args,), log='sms', subsys='mollie-out',
                 fail_silently=True)
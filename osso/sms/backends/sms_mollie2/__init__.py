@@ -7,12 +7,17 @@
 # van der Wijk)
 import urllib
 import urllib2
+from collections import OrderedDict
 from xml.dom.minidom import parseString
 
 from django.core.mail import mail_admins
+from django.utils import timezone
 from osso.aboutconfig.utils import aboutconfig
 from osso.sms import BaseSmsBackend, DestinationError
-from osso.sms.models import TextMessageExtra
+from osso.sms.backends.sms_mollie2.routing import routing_table
+from osso.sms.httpclient import get_http_client
+from osso.sms.pool import SendResult, submit
+from osso.sms.models import TextMessage, TextMessageExtra
 
 try:
     from osso.autolog.utils import log
@@ -39,6 +44,7 @@ URL_CHOICES = (
 
 class MollieSmsBackend(BaseSmsBackend):
     def __init__(self, *args, **kwargs):
+        self.http_client = kwargs.pop('http_client', None) or get_http_client()
         super(MollieSmsBackend, self).__init__(*args, **kwargs)
         self.url = (aboutconfig('sms.backends.sms_mollie.url', URL_CHOICES[0])
                     .encode('utf-8'))
@@ -49,6 +55,9 @@ class MollieSmsBackend(BaseSmsBackend):
             aboutconfig('sms.backends.sms_mollie.md5pass').encode('utf-8')
         default_args['gateway'] = \
             aboutconfig('sms.backends.sms_mollie.gateway', '2').encode('utf-8')
+        # The number of recipients per request of send_messages().
+        self.max_recipients = int(
+            aboutconfig('sms.backends.sms_mollie.max_recipients', '100'))
         default_args['charset'] = 'UTF-8'
         default_args['type'] = 'normal'  # SMSTYPE_CHOICES
         default_args['replace_illegal_chars'] = 'true'
@@ -63,17 +72,57 @@ class MollieSmsBackend(BaseSmsBackend):
 
     def send_messages(self, sms_messages, reply_to=None,
                       shortcode_keyword=None, tariff_cent=None):
+        '''
+        Send the messages in the calling thread, one request after
+        another. Regular messages with the same body, originator and
+        gateway are sent together, with up to max_recipients recipients
+        per request. Premium messages are sent one by one.
+        '''
+        return sum(int(func(*args)) for func, args in self.get_requests(
+            sms_messages, reply_to, shortcode_keyword, tariff_cent))
+
+    def send_messages_async(self, sms_messages, reply_to=None,
+                            shortcode_keyword=None, tariff_cent=None):
+        '''
+        Like send_messages(), but start every request in the sms thread
+        pool, in parallel. The order of the messages is not kept; send
+        them one at a time if it matters.
+
+        The pool threads save the messages through their own database
+        connections, committed outside any transaction of the caller.
+        The messages must have been committed before.
+        '''
+        return SendResult([submit(func, *args) for func, args in
+                           self.get_requests(sms_messages, reply_to,
+                                             shortcode_keyword, tariff_cent)])
+
+    def get_requests(self, sms_messages, reply_to=None,
+                     shortcode_keyword=None, tariff_cent=None):
+        '''
+        Yield the (method, args) of the requests that send the
+        messages.
+        '''
         # We should probably remove the assertion and make it compatible
         # with molliev1.
         assert (reply_to is None and shortcode_keyword is None and
                 tariff_cent is None), 'We use TextMessageExtra only.'
-        sent = 0
+        batches = OrderedDict()
         for message in sms_messages:
-            if self.send_sms(message):
-                sent += 1
-        return sent
-
-    def send_sms(self, message):
+            gateway, premium_args = self.get_send_args(message)
+            if premium_args:
+                yield self.send_sms, (message, (gateway, premium_args))
+            else:
+                key = (message.body, message.local_address, gateway)
+                batches.setdefault(key, []).append(message)
+
+        for (body, local_address, gateway), messages in batches.items():
+            for chunk in self.get_chunks(messages):
+                if len(chunk) == 1:
+                    yield self.send_sms, (chunk[0], (gateway, None))
+                else:
+                    yield self.send_batch, (chunk, gateway)
+
+    def send_sms(self, message, send_args=None):
         '''
         Use the mollie gateway to send out a message. The only
         difference between "premium" and "regular" sms is really
@@ -90,6 +139,89 @@ class MollieSmsBackend(BaseSmsBackend):
         parameter for replies. For subscription premium sms, you do not
         need the mid, but must use the correct shortcode and keyword.
         '''
+        gateway, premium_args = send_args or self.get_send_args(message)
+
+        # Send it on
+        new_status, body_count = self._send(
+            body=message.body,
+            recipient_list=[message.remote_address],
+            local_address=message.local_address,
+            gateway=gateway,
+            reference=message.id,
+            premium_args=premium_args
+        )
+
+        # Update info and return status
+        assert body_count == message.body_count or message.body_count == 1, \
+            ('Expected lazy mans 1 or correct body count (%d != %d for %d)' %
+             (body_count, message.body_count, message.id))
+        message.body_count = body_count
+        if new_status != 'retry':  # some things you have to try again
+            message.status = new_status
+        message.save()
+        return new_status == 'pnd'  # moved to pending => success
+
+    def send_batch(self, messages, gateway):
+        '''
+        Send the messages with the same body and originator to distinct
+        recipients in a single request. The gateway accepts or refuses
+        them all at once, the statuses are updated in a single query.
+
+        The reference is the range of message ids. It is stored as the
+        batch of the messages before sending, and the delivery reports
+        are matched by batch and recipient: other messages in the range
+        may have the same recipient and body.
+        '''
+        reference = '%d-%d' % (messages[0].id, messages[-1].id)
+        TextMessage.objects.filter(id__in=[i.id for i in messages]).update(
+            batch=reference)
+        for message in messages:
+            message.batch = reference
+
+        message = messages[0]
+        new_status, body_count = self._send(
+            body=message.body,
+            recipient_list=[i.remote_address for i in messages],
+            local_address=message.local_address,
+            gateway=gateway,
+            reference=reference
+        )
+
+        update = {'body_count': body_count, 'modified': timezone.now()}
+        if new_status != 'retry':  # some things you have to try again
+            update['status'] = new_status
+        TextMessage.objects.filter(id__in=[i.id for i in messages]).update(
+            **update)
+        for message in messages:
+            for key, value in update.items():
+                setattr(message, key, value)
+        return (0, len(messages))[new_status == 'pnd']
+
+    def get_chunks(self, messages):
+        '''
+        Split the messages into chunks of at most max_recipients
+        distinct recipients, in id order so the id ranges of the chunks
+        do not overlap.
+        '''
+        chunk, recipients = [], set()
+        for message in sorted(messages, key=(lambda i: i.id)):
+            if (len(chunk) >= self.max_recipients or
+                    message.remote_address in recipients):
+                yield chunk
+                chunk, recipients = [], set()
+            chunk.append(message)
+            recipients.add(message.remote_address)
+        if chunk:
+            yield chunk
+
+    def get_gateway(self, message):
+        return self.get_send_args(message)[0] or self.default_args['gateway']
+
+    def get_send_args(self, message):
+        '''
+        Return the gateway override (or None) and the premium arguments
+        (or None) for the message.
+        '''
         try:
             extra = message.extra
         except TextMessageExtra.DoesNotExist:
@@ -100,25 +232,17 @@ class MollieSmsBackend(BaseSmsBackend):
         # Select optional parameters from the metadata. For now we only
         # accept 'gateway'.
         gateway = None  # none means default, other means override
-        meta = message.meta
-        if meta and isinstance(meta, list) and isinstance(meta[0], dict):
-            gateway = meta[0].get('gateway')
-        elif not is_premium and message.remote_operator:
+        options = message.get_meta_options()
+        if options is not None:
+            gateway = options.get('gateway')
+        elif not is_premium and message.remote_operator_id:
             # Optionally use custom gateway for specific countries, like
             # 1 (business+) for Vodafone which is unreliable with 2
             # (regular). Same for Belgium where 50 is more reliable and
             # it doesn't unnecessarily quote-enclose the shortcode.
             # sms.backends.sms_mollie.gateway.204.04 = 1
             # sms.backends.sms_mollie.gateway.206 = 50
-            oper_cc, oper_oc = (message.remote_operator.entire_code()
-                                .split('-'))  # quick
-            gateway = (
-                aboutconfig('sms.backends.sms_mollie.gateway.%s.%s' %
-                            (oper_cc, oper_oc))
-                or aboutconfig('sms.backends.sms_mollie.gateway.%s' %
-                               (oper_cc,))
-                or None  # aboutconfig returns '' by default if not found
-            )
+            gateway = routing_table.get_gateway(message.remote_operator_id)
 
         # Compile premium_args
         if is_premium:
@@ -149,25 +273,7 @@ class MollieSmsBackend(BaseSmsBackend):
         else:
             premium_args = None
 
-        # Send it on
-        new_status, body_count = self._send(
-            body=message.body,
-            recipient_list=[message.remote_address],
-            local_address=message.local_address,
-            gateway=gateway,
-            reference=message.id,
-            premium_args=premium_args
-        )
-
-        # Update info and return status
-        assert body_count == message.body_count or message.body_count == 1, \
-            ('Expected lazy mans 1 or correct body count (%d != %d for %d)' %
-             (body_count, message.body_count, message.id))
-        message.body_count = body_count
-        if new_status != 'retry':  # some things you have to try again
-            message.status = new_status
-        message.save()
-        return new_status == 'pnd'  # moved to pending => success
+        return gateway, premium_args
 
     def _send(self, body, recipient_list, local_address, gateway=None,
               reference=None, premium_args=None):
@@ -229,15 +335,17 @@ class MollieSmsBackend(BaseSmsBackend):
             fail_silently=True)
 
         try:
-            # Do not forget the timeout here. Also we need to be wary of
+            # The shared client reuses the connection to the gateway and
+            # applies the SMS_HTTP_TIMEOUT. Also we need to be wary of
             # a python bug in ssl.py. See these and confirm that it has
             # been fixed locally.
             # http://bugs.python.org/issue5103
             # http://svn.python.org/view?view=rev&revision=80453
             # http://svn.python.org/view/python/branches/release26-maint/ \
             #   Lib/ssl.py?r1=80453&r2=80452&pathrev=80453&diff_format=u
-            response = urllib2.urlopen(url, timeout=20)
-            responsexml = response.read()
+            response = self.http_client.get(url)
+            response.raise_for_status()
+            responsexml = response.body
         except urllib2.URLError as e:  # (SSLError is a URLError too)
             log('result: %r' % (e.args,), log='sms', subsys='mollie2-out',
                 fail_silently=True)
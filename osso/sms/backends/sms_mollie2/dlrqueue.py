@@ -0,0 +1,213 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+The delivery report queue of the mollie2 backend.
+
+With the SMS_DLR_SPOOL setting pointing to a file, the delivery_report
+view appends the reports to that file and acknowledges them right
+away, instead of looking up and saving the message for every report.
+The drain() function, run by "manage.py sms draindlr", applies them in
+batches later.
+
+Writers lock the spool file while appending. The drainer renames it
+out of the way, takes the lock to wait for writers that still have it
+open, and removes it when done. A writer that gets the lock after
+that notices the file is gone and appends to a new spool file instead.
+A drainer that dies leaves the renamed file, which the next drain
+picks up again.
+'''
+import fcntl
+import glob
+import json
+import os
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.core.mail import mail_admins
+from django.utils import timezone
+from osso.sms.models import TextMessage
+
+
+__all__ = ('apply_reports', 'drain', 'enqueue', 'get_spool_path')
+
+
+def get_spool_path():
+    return getattr(settings, 'SMS_DLR_SPOOL', None)
+
+
+def enqueue(reference, recipient, status, path=None):
+    '''
+    Append a delivery report to the spool file.
+    '''
+    path = path or get_spool_path()
+    line = json.dumps({
+        'reference': reference, 'recipient': recipient, 'status': status,
+        'received': timezone.now().strftime('%Y-%m-%dT%H:%M:%S.%f')}) + '\n'
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_nlink:
+                os.write(fd, line.encode('utf-8'))
+                return
+            # The drainer took the file away before we had the lock.
+        finally:
+            os.close(fd)
+
+
+def drain(path=None, chunk_size=500):
+    '''
+    Apply the queued delivery reports. Returns the number of applied
+    and the number of rejected reports.
+    '''
+    path = path or get_spool_path()
+    try:
+        os.rename(path, '%s.%s.draining' % (path, os.getpid()))
+    except OSError:
+        pass  # nothing new queued
+
+    applied = rejected = 0
+    for work_path in sorted(glob.glob('%s.*.draining' % (path,))):
+        fd = os.open(work_path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)  # wait for the writers
+            if not os.fstat(fd).st_nlink:
+                continue  # drained by another drainer already
+            with os.fdopen(os.dup(fd), 'r') as file_:
+                reports = (json.loads(i) for i in file_ if i.strip())
+                while True:
+                    chunk = list(islice(reports, chunk_size))
+                    if not chunk:
+                        break
+                    chunk_applied, chunk_rejected = apply_reports(chunk)
+                    applied += chunk_applied
+                    rejected += len(chunk_rejected)
+                    if chunk_rejected:
+                        _mail_rejected(chunk_rejected)
+            os.unlink(work_path)
+        finally:
+            os.close(fd)
+    return applied, rejected
+
+
+def apply_reports(reports):
+    '''
+    Apply the delivery reports, dictionaries with the reference,
+    recipient, status and received time. They are applied like the
+    DeliveryReportForm does, with one update per status (or per
+    status and received time on Django 1.7-). Returns the number of
+    updated messages and the reports that did not match a message.
+    '''
+    messages, rejected = _find_messages(reports)
+
+    # Per message, the first final report wins. A pending report after
+    # a final one does not change anything either.
+    final = {}
+    for message_id, report in messages:
+        if message_id not in final or (
+                final[message_id]['status'] in (51, 52) and
+                report['status'] not in (51, 52)):
+            final[message_id] = report
+
+    ack, nak, pnd = {}, {}, []
+    for message_id, report in final.items():
+        received = _parse_datetime(report['received'])
+        if report['status'] == 50:
+            ack[message_id] = received
+        elif report['status'] in (51, 52):
+            pnd.append(message_id)
+        else:
+            nak[message_id] = received
+
+    now = timezone.now()
+    applied = 0
+    for status, delivery_dates in (('ack', ack), ('nak', nak)):
+        if delivery_dates:
+            applied += _update_delivered(status, delivery_dates, now)
+    if pnd:
+        applied += TextMessage.objects.filter(
+            id__in=pnd, delivery_date=None, status='out'
+        ).update(status='pnd', modified=now)
+    return applied, rejected
+
+
+def _update_delivered(status, delivery_dates, now):
+    # Set the status and the delivery dates of the messages: with a
+    # single CASE update, or with one update per distinct delivery date
+    # on Django 1.7- (which has no conditional expressions).
+    undelivered = TextMessage.objects.filter(
+        delivery_date=None, status__in=('out', 'pnd'))
+    try:
+        from django.db.models import Case, DateTimeField, Value, When
+    except ImportError:  # Django 1.7-
+        by_date = {}
+        for message_id, delivery_date in delivery_dates.items():
+            by_date.setdefault(delivery_date, []).append(message_id)
+        return sum(
+            undelivered.filter(id__in=message_ids).update(
+                status=status, modified=now, delivery_date=delivery_date)
+            for delivery_date, message_ids in by_date.items())
+
+    return undelivered.filter(id__in=list(delivery_dates)).update(
+        status=status, modified=now, delivery_date=Case(
+            output_field=DateTimeField(),
+            *[When(id=message_id, then=Value(delivery_date))
+              for message_id, delivery_date in delivery_dates.items()]))
+
+
+def _find_messages(reports):
+    # Return (message id, report) for every report that matches a
+    # single outbound message, and the reports that do not.
+    singles, batches = {}, {}
+    for report in reports:
+        if '-' in report['reference']:
+            batches.setdefault(report['reference'], []).append(report)
+        else:
+            singles.setdefault(int(report['reference']), []).append(report)
+
+    # (Django 1.7- does not convert the values_list phone numbers.)
+    phone_number = TextMessage._meta.get_field('remote_address').to_python
+    found = {}  # (id or batch, recipient) => message id
+    outbound = TextMessage.objects.exclude(status__in=('in', 'rd'))
+    if singles:
+        for id, remote_address in (outbound.filter(id__in=list(singles))
+                                   .values_list('id', 'remote_address')):
+            found[(id, phone_number(remote_address))] = id
+    for batch, batch_reports in batches.items():
+        # See MollieSmsBackend.send_batch().
+        for id, remote_address in outbound.filter(
+                batch=batch, remote_address__in=[
+                    i['recipient'] for i in batch_reports]
+                ).values_list('id', 'remote_address'):
+            key = (batch, phone_number(remote_address))
+            # A batch has distinct recipients: reject the ambiguous
+            # ones instead of picking one.
+            found[key] = None if key in found else id
+
+    messages, rejected = [], []
+    for report in reports:
+        key = report['reference']
+        if '-' not in key:
+            key = int(key)
+        message_id = found.get((key, report['recipient']))
+        if message_id is None:
+            rejected.append(report)
+        else:
+            messages.append((message_id, report))
+    return messages, rejected
+
+
+def _parse_datetime(value):
+    value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def _mail_rejected(reports):
+    mail_admins(
+        u'SMS API warn: sms_mollie2 delivery reports rejected',
+        (u'%d queued delivery reports did not match a single outbound '
+         u'message:\n\n%s\n') % (
+            len(reports), u'\n'.join(repr(i) for i in reports)),
+        fail_silently=True)
@@ -1,6 +1,7 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
 import base64
 import datetime
+import re
 import time
 
 from django import forms
@@ -8,6 +9,7 @@ from django.core.mail import mail_admins
 from django.utils.translation import ugettext_lazy as _
 from osso.sms.models import Operator, TextMessage, TextMessageExtra
 from osso.sms.backends.sms_mollie2 import decode_message
+from osso.sms.backends.sms_mollie2.dlrqueue import enqueue
 
 try:
     from osso.autolog.utils import log
@@ -77,6 +79,9 @@ SUBSCRIPTION_CHOICES = (
     ('ON', _('On')),  # aan/on
 )
 
+# A message id, or the range of message ids of a batch.
+REFERENCE_RE = re.compile(r'^[0-9]+(-[0-9]+)?$')
+
 
 def now():
     return datetime.datetime.now().strftime('%Y%m%d%H%M%S')
@@ -289,20 +294,27 @@ class DeliveryReportForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         if 'data' in kwargs:
-            log('data: %r' % kwargs['data'], log='sms', subsys='mollie2-dlr',
-                fail_silently=True)
+            self.log_data(kwargs['data'])
         elif len(args) > 0:
-            log('data: %r' % args[0], log='sms', subsys='mollie2-dlr',
-                fail_silently=True)
+            self.log_data(args[0])
         super(DeliveryReportForm, self).__init__(*args, **kwargs)
 
+    def log_data(self, data):
+        log('data: %r' % data, log='sms', subsys='mollie2-dlr',
+            fail_silently=True)
+
     def clean_reference(self):
+        # A batch of messages is referenced by the range of their ids,
+        # the message is found by the batch and recipient in clean().
+        value = self.cleaned_data['reference'].strip()
+        if not REFERENCE_RE.match(value):
+            raise forms.ValidationError(_('Reference not found.'))
+        if '-' in value:
+            return value
         try:
-            value = TextMessage.objects.get(
-                id=int(self.cleaned_data['reference'].strip()))
-        except (ValueError, TextMessage.DoesNotExist):
+            return TextMessage.objects.get(id=int(value))
+        except TextMessage.DoesNotExist:
             raise forms.ValidationError(_('Reference not found.'))
-        return value
 
     def clean_recipient(self):
         value = self.cleaned_data['recipient'].strip()
@@ -324,6 +336,19 @@ class DeliveryReportForm(forms.Form):
     def clean(self):
         # Double check: compare the message state and recipient
         message = self.cleaned_data.get('reference')
+        if isinstance(message, basestring):
+            if 'recipient' not in self.cleaned_data:
+                return self.cleaned_data
+            try:
+                message = TextMessage.objects.get(
+                    batch=message,
+                    remote_address=self.cleaned_data['recipient'])
+            except TextMessage.DoesNotExist:
+                raise forms.ValidationError(_('Reference not found.'))
+            except TextMessage.MultipleObjectsReturned:
+                # A batch has distinct recipients, see get_chunks().
+                raise forms.ValidationError(_('Reference is ambiguous.'))
+            self.cleaned_data['reference'] = message
         if message:
             if message.remote_address != self.cleaned_data['recipient']:
                 raise forms.ValidationError(_('Reference, recipient and '
@@ -372,3 +397,27 @@ class DeliveryReportForm(forms.Form):
             )
 
         return message
+
+
+class QueuedDeliveryReportForm(DeliveryReportForm):
+    '''
+    Checks the syntax of the delivery report only and appends it to
+    the SMS_DLR_SPOOL queue, see the dlrqueue module.
+    '''
+    def log_data(self, data):
+        # Skip the logging, it looks up the log path in the database
+        # and the queue is a log of its own.
+        pass
+
+    def clean_reference(self):
+        value = self.cleaned_data['reference'].strip()
+        if not REFERENCE_RE.match(value):
+            raise forms.ValidationError(_('Reference not found.'))
+        return value
+
+    def clean(self):
+        return self.cleaned_data
+
+    def save(self):
+        enqueue(self.cleaned_data['reference'],
+                self.cleaned_data['recipient'], self.cleaned_data['status'])
@@ -0,0 +1,93 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+The gateway routing table of the mollie2 backend.
+
+Custom gateways can be configured per operator country and operator,
+like 1 (business+) for Vodafone which is unreliable with 2 (regular):
+
+    sms.backends.sms_mollie.gateway.204.04 = 1
+    sms.backends.sms_mollie.gateway.206 = 50
+
+Looking those up per message costs an operator query and two
+aboutconfig queries, even when nothing is configured. The routing
+table maps every operator id to its gateway at once instead.
+'''
+import threading
+from time import time
+
+from django.db.models.signals import post_delete, post_save
+from osso.aboutconfig.models import Item
+from osso.aboutconfig.utils import CACHE_TIME
+from osso.sms.models import Operator, OperatorCountryCode
+
+
+__all__ = ('GATEWAY_PREFIX', 'RoutingTable', 'routing_table')
+
+GATEWAY_PREFIX = 'sms.backends.sms_mollie.gateway.'
+
+
+class RoutingTable(object):
+    '''
+    Maps operator ids to the configured gateway. The table is loaded
+    at first use and reloaded when an aboutconfig gateway item or an
+    operator is saved in this process, or after refresh_interval
+    seconds for changes made by other processes (like aboutconfig
+    values are cached).
+    '''
+    def __init__(self, refresh_interval=CACHE_TIME):
+        self.refresh_interval = refresh_interval
+        self.gateways = None
+        self.loaded = 0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self.gateways = None
+
+    def get_gateway(self, operator_id):
+        '''
+        Return the gateway for the operator, or None for the default.
+        '''
+        gateways = self.gateways
+        if gateways is None or self.loaded + self.refresh_interval < time():
+            gateways = self.load()
+        return gateways.get(operator_id)
+
+    def load(self):
+        routes = dict(
+            (key[len(GATEWAY_PREFIX):], value) for key, value in
+            Item.objects.filter(key__startswith=GATEWAY_PREFIX)
+            .values_list('key', 'value'))
+
+        gateways = {}
+        if routes:
+            country_codes = dict(
+                OperatorCountryCode.objects.values_list('country', 'code'))
+            for id, country, code in (Operator.objects
+                                      .values_list('id', 'country', 'code')):
+                if country not in country_codes:
+                    continue
+                # Formatted like Operator.entire_code() does.
+                oper_cc = '%3d' % (country_codes[country],)
+                oper_oc = '%02d' % (code,)
+                gateway = (routes.get('%s.%s' % (oper_cc, oper_oc)) or
+                           routes.get(oper_cc))
+                if gateway:
+                    gateways[id] = gateway
+
+        with self._lock:
+            self.gateways = gateways
+            self.loaded = time()
+        return gateways
+
+
+routing_table = RoutingTable()
+
+
+def _clear_routing_table(sender, instance, **kwargs):
+    if sender is not Item or instance.key.startswith(GATEWAY_PREFIX):
+        routing_table.clear()
+
+
+for sender in (Item, Operator, OperatorCountryCode):
+    post_save.connect(_clear_routing_table, sender=sender)
+    post_delete.connect(_clear_routing_table, sender=sender)
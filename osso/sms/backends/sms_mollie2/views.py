@@ -3,7 +3,9 @@ from django.db.transaction import commit_on_success
 from django.http import HttpResponse, HttpResponseServerError
 from django.utils.translation import ugettext_lazy as _
 from osso.core.views import simple_form_view
-from osso.sms.backends.sms_mollie2.forms import DeliveryReportForm, IncomingTextMessageForm
+from osso.sms.backends.sms_mollie2.dlrqueue import get_spool_path
+from osso.sms.backends.sms_mollie2.forms import DeliveryReportForm, IncomingTextMessageForm, \
+        QueuedDeliveryReportForm
 
 
 MOLLIE_IPS = (
@@ -47,5 +49,11 @@ def incoming_text(request):
 
 @commit_on_success
 def delivery_report(request):
-    return simple_form_view(request, form_class=DeliveryReportForm, heading=_(u'Delivery report'),
+    # With SMS_DLR_SPOOL set, the reports are queued and applied in
+    # batches by "manage.py sms draindlr".
+    if get_spool_path():
+        form_class = QueuedDeliveryReportForm
+    else:
+        form_class = DeliveryReportForm
+    return simple_form_view(request, form_class=form_class, heading=_(u'Delivery report'),
             ip_whitelist=MOLLIE_IPS, httpresponse_ok=HttpResponseOk, httpresponse_fail=HttpResponseFail, mail_on_fail=True)
@@ -1,7 +1,8 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
-import hashlib, time, urllib, urllib2
+import hashlib, time, urllib2
 from osso.aboutconfig.utils import aboutconfig
 from osso.sms import BaseSmsBackend
+from osso.sms.httpclient import get_http_client
 
 
 WIRELESS_API_VERSION = '1.1'
@@ -36,6 +37,7 @@ GATEWAY_PATHS = {
 
 class WirelessSmsBackend(BaseSmsBackend):
     def __init__(self, *args, **kwargs):
+        self.http_client = kwargs.pop('http_client', None) or get_http_client()
         super(WirelessSmsBackend, self).__init__(*args, **kwargs)
         self.url = aboutconfig('sms.backends.sms_wireless.url', 'http://gateway.wireless-services.nl/').rstrip('/').encode('utf-8')
         self.backup_url = aboutconfig('sms.backends.sms_wireless.backup_url', 'http://gateway2.wireless-services.nl/').rstrip('/').encode('utf-8')
@@ -122,14 +124,14 @@ class WirelessSmsBackend(BaseSmsBackend):
         })
         if extra_args is not None:
             args.update(extra_args)
-        urlencoded_args = urllib.urlencode(args)
 
         for url in (self.url, self.backup_url):
             if not url:
                 continue
             try:
-                f = urllib2.urlopen('%s%s' % (url, request_path), urlencoded_args)
-                response = f.read()
+                f = self.http_client.post('%s%s' % (url, request_path), args)
+                f.raise_for_status()
+                response = f.body
                 # response: <code>=<info>
                 code, info = response.split('=', 2)
                 # code=0XX: message accepted, XX sent
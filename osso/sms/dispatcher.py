@@ -0,0 +1,345 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+Concurrent dispatching of outbound text messages.
+
+The Dispatcher claims batches of outbound TextMessage rows with a
+claim token, so several dispatchers can run side by side, and sends
+them from a pool of worker threads. Messages to the same destination
+are sent in order by one worker. Each gateway (see
+BaseSmsBackend.get_gateway) gets its own concurrency and token bucket
+rate limits.
+
+Like sendlazy, a destination that fails is skipped for a while: we
+expect the sms service to either work or fail completely, the message
+content shouldn't be to blame. Instead of skipping it for the rest of
+the run, the destination is retried after a backoff that doubles with
+every consecutive failure.
+'''
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import connection as db_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from osso.sms import get_connection
+from osso.sms.models import TextMessage
+
+try:
+    from Queue import Queue
+except ImportError:  # python3
+    from queue import Queue
+
+
+__all__ = ('Dispatcher', 'TokenBucket')
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''
+    Allow rate acquisitions per second on average, with bursts of at
+    most burst acquisitions.
+
+    >>> from osso.sms.dispatcher import TokenBucket
+    >>> bucket = TokenBucket(2, burst=3, clock=lambda: 0.0)
+    >>> [bucket.try_acquire() for i in range(4)]
+    [True, True, True, False]
+    >>> bucket.clock = lambda: 0.5
+    >>> [bucket.try_acquire() for i in range(2)]
+    [True, False]
+    '''
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        '''
+        Take a token if there is one. Returns whether we got it.
+        '''
+        return self._take() == 0
+
+    def acquire(self):
+        '''
+        Take a token, sleeping until there is one.
+        '''
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take(self):
+        # Take a token and return 0, or return the seconds to wait.
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class GatewayLimit(object):
+    '''
+    Limits the concurrency and the send rate of a single gateway. Use
+    it as a context manager around the sending.
+    '''
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        self.semaphore = concurrency and threading.Semaphore(concurrency)
+        self.bucket = rate and TokenBucket(rate, burst)
+
+    def __enter__(self):
+        if self.semaphore:
+            self.semaphore.acquire()
+        if self.bucket:
+            self.bucket.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.semaphore:
+            self.semaphore.release()
+
+
+class Dispatcher(object):
+    '''
+    Send outbound text messages concurrently.
+
+    workers is the number of sending threads; with 0 workers, the
+    messages are sent from the calling thread. concurrency, rate and
+    burst are the default limits per gateway, the gateways dictionary
+    can override them per gateway key, e.g.
+    {'2': {'concurrency': 2, 'rate': 10}}.
+
+    While the claimed messages are being sent, the dispatcher refreshes
+    its claims every claim_timeout / 3 seconds. Claims that are older
+    than claim_timeout seconds are considered abandoned (the dispatcher
+    died, or hung for that long) and are taken over. A dispatcher that
+    comes back after hanging could still send a message that was taken
+    over, so keep claim_timeout well above any pause you expect.
+
+    A failing destination is skipped for backoff seconds, doubling up
+    to max_backoff seconds for every next failure.
+    '''
+    def __init__(self, connection=None, workers=4, batch_size=100,
+                 concurrency=None, rate=None, burst=None, gateways=None,
+                 claim_timeout=300, backoff=60, max_backoff=3600):
+        self.connection = connection or get_connection()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.default_limits = {
+            'concurrency': concurrency, 'rate': rate, 'burst': burst}
+        self.gateway_limits = gateways or {}
+        self.claim_timeout = claim_timeout
+        self.claim_refresh = claim_timeout / 3.0
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.token = uuid.uuid4().hex
+        # destination => (skip until, consecutive failures)
+        self.skip_destinations = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._sent = 0
+        self._stopped = False
+
+    def run(self, once=False, poll_interval=5):
+        '''
+        Dispatch until stop() is called, or until there is nothing
+        left to send if once is set. Returns the number of sent
+        messages.
+        '''
+        self.start()
+        sent = 0
+        try:
+            while not self._stopped:
+                messages = self.claim()
+                if messages:
+                    sent += self.dispatch(messages)
+                elif once:
+                    break
+                else:
+                    time.sleep(poll_interval)
+        finally:
+            self.shutdown()
+        return sent
+
+    def stop(self):
+        self._stopped = True
+
+    def start(self):
+        '''
+        Start the worker threads.
+        '''
+        if self._threads or not self.workers:
+            return
+        self._queue = Queue()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='sms-dispatcher-%d' % (i,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self):
+        '''
+        Stop the worker threads and release our remaining claims.
+        '''
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.release()
+
+    def claim(self):
+        '''
+        Claim a batch of outbound messages and return them in order.
+        Messages to skipped destinations are left alone.
+        '''
+        now = timezone.now()
+        claimable = (Q(claim='') | Q(claimed__lt=(
+            now - timedelta(seconds=self.claim_timeout))))
+        outbound = TextMessage.objects.filter(status='out')
+        skip = self.get_skipped_destinations(now)
+        if skip:
+            outbound = outbound.exclude(remote_address__in=skip)
+
+        ids = list(outbound.filter(claimable).order_by('id')
+                   .values_list('id', flat=True)[0:self.batch_size])
+        if not ids:
+            return []
+        # The update re-checks the claimability, so only one of
+        # several concurrent dispatchers gets each message.
+        (outbound.filter(claimable, id__in=ids)
+         .update(claim=self.token, claimed=now))
+        return list(outbound.filter(id__in=ids, claim=self.token)
+                    .order_by('id'))
+
+    def release(self, messages=None):
+        '''
+        Release the claims on the messages, or on all messages we
+        claimed, so unsent messages can be claimed again.
+        '''
+        qs = TextMessage.objects.filter(claim=self.token)
+        if messages is not None:
+            qs = qs.filter(id__in=[i.id for i in messages])
+        qs.update(claim='', claimed=None)
+
+    def dispatch(self, messages):
+        '''
+        Send the claimed messages and release the claims. Returns the
+        number of sent messages.
+        '''
+        by_destination = OrderedDict()
+        for message in messages:
+            by_destination.setdefault(message.remote_address, []).append(
+                message)
+
+        self._sent = 0
+        refreshed = time.time()
+        if self._threads:
+            for destination_messages in by_destination.values():
+                self._queue.put(destination_messages)
+            while not self._wait_done(
+                    refreshed + self.claim_refresh - time.time()):
+                self.refresh_claims(messages)
+                refreshed = time.time()
+        else:
+            for destination_messages in by_destination.values():
+                if refreshed + self.claim_refresh <= time.time():
+                    self.refresh_claims(messages)
+                    refreshed = time.time()
+                self.send_destination(destination_messages)
+        self.release(messages)
+        return self._sent
+
+    def refresh_claims(self, messages):
+        '''
+        Renew our claims on the messages, so they are not taken over
+        while we are still sending them.
+        '''
+        (TextMessage.objects.filter(claim=self.token,
+                                    id__in=[i.id for i in messages])
+         .update(claimed=timezone.now()))
+
+    def _wait_done(self, timeout):
+        # Wait for the workers to finish the queue, at most timeout
+        # seconds (Queue.join() has no timeout).
+        with self._queue.all_tasks_done:
+            if self._queue.unfinished_tasks and timeout > 0:
+                self._queue.all_tasks_done.wait(timeout)
+            return not self._queue.unfinished_tasks
+
+    def send_destination(self, messages):
+        '''
+        Send the messages to a single destination in order, stopping
+        at the first failure.
+        '''
+        for message in messages:
+            destination = message.remote_address
+            message.connection = self.connection
+            try:
+                with self.get_limit(message):
+                    sent = message.send()
+            except Exception as e:
+                self.fail(destination, e)
+                return
+            if not sent and message.status == 'out':
+                # The backend wants us to try again later.
+                self.fail(destination, 'message %d was not sent' %
+                          (message.id,))
+                return
+            with self._lock:
+                self._sent += sent
+                self.skip_destinations.pop(destination, None)
+
+    def get_limit(self, message):
+        gateway = self.connection.get_gateway(message)
+        with self._lock:
+            if gateway not in self._limits:
+                limits = dict(self.default_limits)
+                limits.update(self.gateway_limits.get(gateway, {}))
+                self._limits[gateway] = GatewayLimit(**limits)
+            return self._limits[gateway]
+
+    def fail(self, destination, exception):
+        with self._lock:
+            failures = self.skip_destinations.get(destination, (None, 0))[1]
+            seconds = min(self.backoff * 2 ** failures, self.max_backoff)
+            self.skip_destinations[destination] = (
+                timezone.now() + timedelta(seconds=seconds), failures + 1)
+        log.warning('Got exception (dst %s), skipping it for %d seconds: %s',
+                    destination, seconds, exception)
+
+    def get_skipped_destinations(self, now=None):
+        now = now or timezone.now()
+        with self._lock:
+            return [destination for destination, (until, failures)
+                    in self.skip_destinations.items() if until > now]
+
+    def _work(self):
+        try:
+            while True:
+                messages = self._queue.get()
+                try:
+                    if messages is None:
+                        break
+                    self.send_destination(messages)
+                finally:
+                    self._queue.task_done()
+        finally:
+            # Every thread has its own database connection.
+            db_connection.close()
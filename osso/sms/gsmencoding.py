@@ -16,18 +16,25 @@ except NameError:
     def bchr(i):
         return bytes([i])
     bord = lambda x: x  # taking an element of bstr returns integer
+    unicode = str
 else:
     bchr = chr
     bord = ord
 
 
 import codecs
+import re
+import struct
 
-__all__ = ('pack7', 'unpack7', 'encode', 'decode')
+__all__ = ('pack7', 'unpack7', 'encode', 'decode', 'encoded_length')
 
 
 # == Codec APIs ==
 
+pack_uint64 = struct.Struct('<Q').pack
+unpack_uint64 = struct.Struct('<Q').unpack
+
+
 def pack7(input, left_pad=0):
     '''
     Pack a 7-bit string into 8-bits according to the GSM bit-packing
@@ -41,18 +48,33 @@ def pack7(input, left_pad=0):
     >>> from . import gsmencoding
     >>> assert gsmencoding.pack7(b'A!AaBbCc') == b'\\xc1P0,\\x14\\x0f\\xc7'
     '''
-    shift, ret, i, j = 0, [], 0, len(input)
-    input += b'\x00'  # add padding byte
+    input = bytearray(input)
+    ret = bytearray()
+    # acc holds the bits that are not written yet, the lowest first
+    acc, bits = 0, 0
     if 1 <= left_pad <= 6:
-        input = b'\x00' + input
-        shift = 7 - left_pad
-        j += 1
+        bits = left_pad
+
+    # eight septets make seven octets, take them at once
+    i, j = 0, len(input) - len(input) % 8
     while i < j:
-        ret.append((bord(input[i]) >> shift) |
-                   ((bord(input[i + 1]) << (7 - shift)) & 0xff))
-        i += 1 + bool(shift == 6)
-        shift = (shift + 1) % 7
-    return b''.join(bchr(i) for i in ret)
+        s0, s1, s2, s3, s4, s5, s6, s7 = input[i:(i + 8)]
+        acc |= (s0 | (s1 << 7) | (s2 << 14) | (s3 << 21) | (s4 << 28) |
+                (s5 << 35) | (s6 << 42) | (s7 << 49)) << bits
+        ret += pack_uint64(acc & 0xffffffffffffff)[0:7]
+        acc >>= 56
+        i += 8
+
+    for septet in input[j:]:
+        acc |= septet << bits
+        bits += 7
+        if bits >= 8:
+            ret.append(acc & 0xff)
+            acc >>= 8
+            bits -= 8
+    if bits:
+        ret.append(acc & 0xff)
+    return bytes(ret)
 
 
 def unpack7(input):
@@ -63,22 +85,52 @@ def unpack7(input):
     >>> from . import gsmencoding
     >>> assert gsmencoding.unpack7(b'\\xc1P0,\\x14\\x0f\\xc7') == b'A!AaBbCc'
     '''
-    shift, left, ret = 0, 0, []
-    for i in input:
-        num = bord(i)
-        ret.append(((num << shift) & 0x7f) | left)
-        left = num >> (7 - shift)
-        if shift == 6:
-            ret.append(left)
-            left = 0
-        shift = (shift + 1) % 7
-    return b''.join(bchr(i) for i in ret)
+    input = bytes(input)
+    ret = bytearray()
+
+    # seven octets make eight septets, take them at once
+    i, j = 0, len(input) - len(input) % 7
+    while i < j:
+        acc = unpack_uint64(input[i:(i + 7)] + b'\x00')[0]
+        ret.extend((acc & 0x7f, (acc >> 7) & 0x7f, (acc >> 14) & 0x7f,
+                    (acc >> 21) & 0x7f, (acc >> 28) & 0x7f,
+                    (acc >> 35) & 0x7f, (acc >> 42) & 0x7f, acc >> 49))
+        i += 7
+
+    acc, bits = 0, 0
+    for octet in bytearray(input[j:]):
+        acc |= octet << bits
+        bits += 8
+        while bits >= 7:
+            ret.append(acc & 0x7f)
+            acc >>= 7
+            bits -= 7
+    return bytes(ret)
 
 
 def encode(input, errors='strict'):
     '''
     Encode the unicode input to the GSM 03.38 character set.
+
+    Unicode input is translated in one go using a precomputed table;
+    only if that finds characters outside the character set does the
+    per-character loop run, to replace them or to raise the error.
+
+    >>> from . import gsmencoding
+    >>> encoded = gsmencoding.encode(u'a\\u20ac[@')
+    >>> assert encoded == (b'a\\x1be\\x1b<\\x00\\r', 4)
+    >>> assert gsmencoding.encode(u'\\xe1\\t', 'replace') == (b'a ', 2)
     '''
+    if isinstance(input, unicode):
+        try:
+            ret = input.translate(encoding_map).encode('latin-1')
+        except UnicodeEncodeError:
+            pass  # not in the character set, find out below
+        else:
+            if input.endswith(u'@'):
+                ret += b'\x0d'  # see below
+            return ret, len(input)
+
     ret = []
     for i, c in enumerate(input):
         try:
@@ -97,7 +149,16 @@ def encode(input, errors='strict'):
 def decode(input, errors='strict'):
     '''
     Decode the GSM 03.38 character string.
+
+    Input without escapes is translated in one go using a precomputed
+    table; escapes and invalid input go through the per-byte loop.
+
+    >>> from . import gsmencoding
+    >>> assert gsmencoding.decode(b'a\\x00\\x1be') == (u'a@\\u20ac', 4)
     '''
+    if isinstance(input, bytes) and not slow_decoding_re.search(input):
+        return input.decode('latin-1').translate(decoding_map), len(input)
+
     ret, i, j = [], 0, len(input)
     while i < j:
         num = bord(input[i])
@@ -118,6 +179,26 @@ def decode(input, errors='strict'):
     return u''.join(ret), j
 
 
+def encoded_length(input):
+    '''
+    Return the length of the GSM 03.38 encoding of the unicode input,
+    like len(encode(input, 'replace')[0]), without encoding it. The
+    extension characters take two bytes, all others one.
+
+    >>> from . import gsmencoding
+    >>> gsmencoding.encoded_length(u'a\\u20ac[\\xe1')
+    6
+    >>> gsmencoding.encoded_length(u'@') == len(u'@'.encode('gsm-0338'))
+    True
+    '''
+    length = len(input)
+    for c in extension_characters:
+        length += input.count(c)
+    if input.endswith(u'@'):
+        length += 1  # the appended 0x0d, see encode()
+    return length
+
+
 # == Encodings module API ==
 
 def getregentry(name):
@@ -155,6 +236,21 @@ encoding_table = dict((bord(c), bchr(i))
 encoding_table.update(dict((bord(c), i)
                            for i, c in decoding_extensions.items()))
 
+# The tables for the translate() fast paths. Characters that are not
+# in the character set are mapped to U+FFFD, so they make the latin-1
+# encoding fail.
+encoding_map = dict(
+    (isinstance(c, int) and c or ord(c), i.decode('latin-1'))
+    for c, i in encoding_table.items())
+encoding_map.update(dict((i, u'\ufffd') for i in range(0x100)
+                         if i not in encoding_map))
+
+decoding_map = dict(enumerate(decoding_table))
+# Escapes and bytes beyond the table need the per-byte decoding loop.
+slow_decoding_re = re.compile(b'[\x1b\x80-\xff]')
+
+extension_characters = tuple(decoding_extensions.values())
+
 replacement_table = {
     u'\t': b' ',
     u'`': b'\'',
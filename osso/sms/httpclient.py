@@ -0,0 +1,249 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+A pooled HTTP client for the sms backends.
+
+urllib2.urlopen sets up a new TCP (and TLS) connection for every
+request. The HttpClient keeps the connections to each host alive and
+hands them out again, so sending a batch of messages pays for the
+handshakes only once per connection.
+
+Errors are raised as urllib2.URLError (and HTTPError for error
+statuses), like urlopen does, so the backends can keep catching those.
+
+Retry policy: failing to connect is retried up to retries times, with
+a backoff that doubles for every attempt. A kept-alive connection that
+the server has closed in the meantime is replaced by a fresh one
+once: that is, when the connection is reset or closed before any byte
+of the response came in. Other errors are not retried: once the
+request is sent, the gateway may have sent the message, so only the
+backend can decide whether to try again.
+'''
+import errno
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import httplib
+    from urllib import urlencode
+    from urllib2 import HTTPError, URLError
+    from urlparse import urlsplit
+except ImportError:  # python3
+    import http.client as httplib
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, urlsplit
+
+
+__all__ = ('HttpClient', 'HttpResponse', 'get_http_client')
+
+
+class HttpResponse(object):
+    '''
+    A read HTTP response.
+    '''
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HTTPError(self.url, self.status, self.reason,
+                            self.headers, None)
+
+    def __repr__(self):
+        return '<HttpResponse(%d %s)>' % (self.status, self.reason)
+
+
+class ConnectionPool(object):
+    '''
+    The kept-alive connections to a single host, at most maxsize at a
+    time. Getting a connection blocks while they are all in use.
+    '''
+    def __init__(self, scheme, host, maxsize=4, connect_timeout=10,
+                 timeout=20, idle_timeout=30):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.idle = []  # (connection, time of last use)
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(maxsize)
+
+    def get(self):
+        '''
+        Return a connection and whether it was used before.
+        '''
+        self._semaphore.acquire()
+        now = time.time()
+        with self._lock:
+            while self.idle:
+                connection, used = self.idle.pop()
+                if now - used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        try:
+            return self.connect(), False
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def connect(self):
+        connection = self.connection_class(
+            self.host, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.timeout)
+        return connection
+
+    def put(self, connection, reuse=True):
+        '''
+        Hand back the connection gotten with get().
+        '''
+        if reuse:
+            with self._lock:
+                self.idle.append((connection, time.time()))
+        else:
+            connection.close()
+        self._semaphore.release()
+
+    def close(self):
+        with self._lock:
+            for connection, used in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class HttpClient(object):
+    '''
+    An HTTP client that keeps at most maxsize connections alive per
+    host. Connecting may take connect_timeout seconds, every next
+    socket operation timeout seconds. See the module documentation
+    for the retry policy.
+    '''
+    def __init__(self, maxsize=4, connect_timeout=10, timeout=20,
+                 retries=2, backoff=0.5, idle_timeout=30):
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        '''
+        POST the data, a string or a dictionary that is sent url
+        encoded.
+        '''
+        headers = dict(headers or {})
+        if data is None or isinstance(data, dict):
+            data = urlencode(data or {})
+            headers.setdefault(
+                'Content-Type', 'application/x-www-form-urlencoded')
+        return self.request('POST', url, body=data, headers=headers)
+
+    def request(self, method, url, body=None, headers=None):
+        '''
+        Do the request and return the HttpResponse. Responses with an
+        error status are returned too, see raise_for_status().
+        '''
+        scheme, host, path, query, fragment = urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise URLError('unsupported scheme %r' % (scheme,))
+        if query:
+            path = '%s?%s' % (path, query)
+        pool = self.get_pool(scheme, host)
+
+        attempt, fresh = 0, False
+        while True:
+            try:
+                connection, reused = pool.get()
+            except (socket.error, httplib.HTTPException) as e:
+                if attempt >= self.retries:
+                    raise URLError(e)
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            reuse = False
+            response = None
+            try:
+                connection.request(method, path or '/', body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+                reuse = not response.will_close
+            except (socket.error, httplib.HTTPException) as e:
+                if (reused and not fresh and response is None and
+                        _is_closed_connection(e)):
+                    # The server closed the idle connection, so it
+                    # has probably closed the other idle ones too.
+                    fresh = True
+                    pool.close()
+                    continue
+                raise URLError(e)
+            finally:
+                pool.put(connection, reuse)
+
+            return HttpResponse(url, response.status, response.reason,
+                                response.msg, data)
+
+    def get_pool(self, scheme, host):
+        with self._lock:
+            key = (scheme, host)
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(
+                    scheme, host, maxsize=self.maxsize,
+                    connect_timeout=self.connect_timeout,
+                    timeout=self.timeout, idle_timeout=self.idle_timeout)
+            return self.pools[key]
+
+    def close(self):
+        with self._lock:
+            for pool in self.pools.values():
+                pool.close()
+
+
+def _is_closed_connection(error):
+    # Whether the server closed the connection without sending anything
+    # back, as servers do with idle keep-alive connections.
+    if isinstance(error, getattr(httplib, 'RemoteDisconnected', ())):
+        return True  # python3
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ('', "''")
+    return (isinstance(error, socket.error) and
+            error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    '''
+    Return the HttpClient shared by the sms backends of this process.
+    It is configured by the SMS_HTTP_POOL_SIZE (default 4),
+    SMS_HTTP_CONNECT_TIMEOUT (10), SMS_HTTP_TIMEOUT (20) and
+    SMS_HTTP_RETRIES (2) settings.
+    '''
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient(
+                maxsize=getattr(settings, 'SMS_HTTP_POOL_SIZE', 4),
+                connect_timeout=getattr(
+                    settings, 'SMS_HTTP_CONNECT_TIMEOUT', 10),
+                timeout=getattr(settings, 'SMS_HTTP_TIMEOUT', 20),
+                retries=getattr(settings, 'SMS_HTTP_RETRIES', 2))
+        return _http_client
@@ -0,0 +1,94 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+import sys
+
+from django import VERSION as django_version
+from django.db import transaction
+from osso.core import pickle
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.sms.models import TextMessage, dump_meta
+
+try:
+    atomic = transaction.atomic
+except AttributeError:  # Django 1.5-
+    atomic = transaction.commit_on_success
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Convert the pickled sms_textmessage metadata to JSON.
+
+    Walks the text messages with pickled metadata in batches of
+    --batch-size, ordered by id, and moves the metadata to the
+    metadata_json field. Only the id and metadata are read and the
+    modified date is left alone. Messages whose metadata would not load
+    from JSON as the same value (because of dates, decimals, tuples or
+    non-string keys) keep their pickled metadata and are listed at the
+    end. It is safe to interrupt and run again.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--batch-size', action='store', type='int', default=500,
+                help='Messages to convert per transaction (default 500)'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                '--batch-size', action='store', type=int, default=500,
+                help='Messages to convert per transaction (default 500)')
+
+    def handle(self, *args, **kwargs):
+        if len(args):
+            raise CommandError('This command takes no arguments.')
+        if kwargs['batch_size'] < 1:
+            raise CommandError('The batch size must be at least 1.')
+
+        quiet = int(kwargs['verbosity']) == 0
+        converted, failed = self.convert(
+            kwargs['batch_size'], progress=(not quiet))
+
+        if not quiet:
+            print('\rConverted %d messages.' % (converted,))
+        if failed:
+            raise CommandError(
+                'Could not convert the metadata of messages %s.' % (
+                    ', '.join(str(i) for i in failed),))
+
+    def convert(self, batch_size, progress=False):
+        pickled = TextMessage.objects.exclude(metadata='').order_by('id')
+        if progress:
+            total = float(pickled.count()) or 1.0
+
+        converted, failed = 0, []
+        last_id = -1
+        while True:
+            batch = list(pickled.filter(id__gt=last_id)
+                         .values_list('id', 'metadata')[0:batch_size])
+            if not batch:
+                break
+
+            with atomic():
+                for id, metadata in batch:
+                    try:
+                        metadata_json = dump_meta(pickle.loadascii(metadata))
+                    except Exception:
+                        failed.append(id)
+                        continue
+                    # (Unless someone else changed it in the meantime.)
+                    converted += TextMessage.objects.filter(
+                        id=id, metadata=metadata).update(
+                            metadata='', metadata_json=metadata_json)
+
+            last_id = batch[-1][0]
+            if progress:
+                sys.stdout.write('\r%d%%' % (
+                    (converted + len(failed)) / total * 100,))
+                sys.stdout.flush()
+
+        return converted, failed
@@ -24,17 +24,35 @@ Choose one of:
                 text message extra table (and possibly some backend
                 specific options in the metadata). (The 'lazy' refers to
                 the fact that it wasn't sent from the creating thread
-                but is left to us to do the job.)'''
+                but is left to us to do the job.) See the smsdispatch
+                command for a concurrent, rate-limited version.
+ * draindlr     Apply the delivery reports that the sms_mollie2
+                delivery_report view queued in the SMS_DLR_SPOOL file,
+                in batches. Run it as a cron job when that setting is
+                used.'''
+
+    args = 'draindlr|fixremoteop|sendlazy'
 
     def get_version(self):
         return '1.0 initial'
 
     def handle(self, *args, **kwargs):
-        if len(args) == 1 and args[0] in ('fixremoteop', 'sendlazy'):
+        if len(args) == 1 and args[0] in ('draindlr', 'fixremoteop',
+                                          'sendlazy'):
             getattr(self, args[0])(quiet=(int(kwargs['verbosity']) == 0))
         else:
             raise CommandError('Invalid arguments, see sms --help')
 
+    def draindlr(self, quiet=False):
+        from osso.sms.backends.sms_mollie2.dlrqueue import (
+            drain, get_spool_path)
+        if not get_spool_path():
+            raise CommandError('SMS_DLR_SPOOL is not set')
+        applied, rejected = drain()
+        if not quiet:
+            print('Applied %d delivery reports, rejected %d.' %
+                  (applied, rejected))
+
     def fixremoteop(self, quiet=False):
         # Broadcast messages do not get the remote_operator field set
         # automatically run this to set them afterwards.
@@ -73,7 +91,7 @@ Choose one of:
         #
         # This is a really simple version of a dequeueing cron job. If
         # you're doing serious SMS business, you'll probably want to
-        # write your own.
+        # use smsdispatch (osso.sms.dispatcher) instead.
         skip_destinations = []
         while True:
             msg = list(TextMessage.objects.filter(status='out')
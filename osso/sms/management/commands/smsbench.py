@@ -0,0 +1,95 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+import random
+
+from django import VERSION as django_version
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.core.management.bench import measure_sized, write_json
+from osso.sms import gsmencoding
+from osso.sms.utils import sms_split, sms_split_parts
+
+
+SIZES = (160, 1600, 16000)
+
+
+def make_message(size, seed=1):
+    '''
+    Return a message of size characters of the GSM 03.38 basic
+    character set, with a few extension characters.
+    '''
+    rand = random.Random(seed)
+    chars = u'abcdefghijklmnopqrstuvwxyz ABCDEFGHIJ 0123456789 .,!?@'
+    return u''.join(rand.choice(chars) if rand.random() < 0.99
+                    else u'\u20ac' for i in range(size))
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Benchmark the osso.sms GSM 03.38 codec and message splitting.
+
+    Measures encode, encoded_length, decode, pack7, unpack7, sms_split
+    and sms_split_parts on messages of increasing size. The results
+    are written as JSON, so they can be compared between releases.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--iterations', action='store', type='int', default=1000,
+                help='Calls per case (default 1000)'),
+            optparse.make_option(
+                '--size', action='append', type='int', default=None,
+                help='Message size in characters, may be repeated '
+                     '(default 160, 1600 and 16000)'),
+            optparse.make_option(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                '--iterations', action='store', type=int, default=1000,
+                help='Calls per case (default 1000)')
+            parser.add_argument(
+                '--size', action='append', type=int, default=None,
+                help='Message size in characters, may be repeated\n'
+                     '(default 160, 1600 and 16000)')
+            parser.add_argument(
+                '--output', action='store', default=None,
+                help='Write the JSON to this file instead of stdout')
+
+    def handle(self, *args, **kwargs):
+        self.iterations = int(kwargs.get('iterations') or 1000)
+        sizes = kwargs.get('size') or SIZES
+        if self.iterations < 1 or min(sizes) < 1:
+            raise CommandError('Need positive iterations and sizes')
+
+        results = []
+        for size in sizes:
+            for case, func in self.get_cases(make_message(size)):
+                results.append(measure_sized(
+                    case, size, func, self.iterations))
+
+        data = {
+            'iterations': self.iterations,
+            'results': results,
+        }
+        write_json(self.stdout, data, kwargs.get('output'))
+
+    def get_cases(self, message):
+        encoded = gsmencoding.encode(message)[0]
+        packed = gsmencoding.pack7(encoded)
+        return [
+            ('encode', lambda: gsmencoding.encode(message)),
+            ('encoded_length', lambda: gsmencoding.encoded_length(message)),
+            ('decode', lambda: gsmencoding.decode(encoded)),
+            ('pack7', lambda: gsmencoding.pack7(encoded)),
+            ('pack7_left_pad', lambda: gsmencoding.pack7(encoded, 1)),
+            ('unpack7', lambda: gsmencoding.unpack7(packed)),
+            ('sms_split', lambda: sms_split(message)),
+            ('sms_split_parts', lambda: sms_split_parts(message)),
+        ]
@@ -0,0 +1,89 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import argparse
+import optparse
+
+from django import VERSION as django_version
+from osso.core.management.base import BaseCommand, CommandError, docstring
+from osso.sms.dispatcher import Dispatcher
+
+
+class Command(BaseCommand):
+    __doc__ = help = docstring("""
+    Send the outbound text messages concurrently.
+
+    Claims batches of outbound messages and sends them from a pool of
+    worker threads, with optional concurrency and rate limits per
+    gateway. Several dispatchers can run at the same time. A
+    destination that fails is skipped for a while, with a backoff that
+    doubles for every consecutive failure.
+
+    Runs until interrupted, or until there is nothing left to send
+    when --once is given. Decrease verbosity to 0 when run as a cron
+    job.
+    """)
+
+    # Optparse was used up to Django 1.8.
+    if django_version < (1, 8):
+        option_list = BaseCommand.option_list + (
+            optparse.make_option(
+                '--workers', action='store', type='int', default=4,
+                help='Sending threads (default 4)'),
+            optparse.make_option(
+                '--batch-size', action='store', type='int', default=100,
+                help='Messages to claim at once (default 100)'),
+            optparse.make_option(
+                '--concurrency', action='store', type='int', default=None,
+                help='Concurrent sends per gateway (default unlimited)'),
+            optparse.make_option(
+                '--rate', action='store', type='float', default=None,
+                help='Messages per second per gateway (default '
+                     'unlimited)'),
+            optparse.make_option(
+                '--poll-interval', action='store', type='float', default=5,
+                help='Seconds to wait for new messages (default 5)'),
+            optparse.make_option(
+                '--once', action='store_true', default=False,
+                help='Stop when there is nothing left to send'),
+        )
+
+    if django_version >= (1, 8):
+        def add_arguments(self, parser):
+            parser.formatter_class = argparse.RawTextHelpFormatter
+            parser.add_argument(
+                '--workers', action='store', type=int, default=4,
+                help='Sending threads (default 4)')
+            parser.add_argument(
+                '--batch-size', action='store', type=int, default=100,
+                help='Messages to claim at once (default 100)')
+            parser.add_argument(
+                '--concurrency', action='store', type=int, default=None,
+                help='Concurrent sends per gateway (default unlimited)')
+            parser.add_argument(
+                '--rate', action='store', type=float, default=None,
+                help='Messages per second per gateway (default unlimited)')
+            parser.add_argument(
+                '--poll-interval', action='store', type=float, default=5,
+                help='Seconds to wait for new messages (default 5)')
+            parser.add_argument(
+                '--once', action='store_true', default=False,
+                help='Stop when there is nothing left to send')
+
+    def handle(self, *args, **kwargs):
+        workers = int(kwargs.get('workers') or 0)
+        batch_size = int(kwargs.get('batch_size') or 100)
+        if workers < 0 or batch_size < 1:
+            raise CommandError('Need positive workers and batch size')
+
+        dispatcher = Dispatcher(
+            workers=workers, batch_size=batch_size,
+            concurrency=kwargs.get('concurrency'), rate=kwargs.get('rate'))
+        try:
+            sent = dispatcher.run(once=kwargs.get('once'),
+                                  poll_interval=kwargs.get('poll_interval'))
+        except KeyboardInterrupt:
+            return
+
+        if int(kwargs.get('verbosity', 1)):
+            self.stdout.write('Sent %d messages\n' % (sent,))
+            for destination in dispatcher.get_skipped_destinations():
+                self.stdout.write('Skipped destination %s\n' % (destination,))
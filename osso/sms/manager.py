@@ -1,6 +1,5 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
 from django.db import models
-from osso.core import pickle
 
 
 class OperatorManager(models.Manager):
@@ -43,15 +42,14 @@ class OperatorManager(models.Manager):
 class TextMessageManager(models.Manager):
     '''
     Updates the create method to take a meta argument which can take
-    any serializable object (instead of the metadata argument which
-    is a serialized string).
+    any serializable object (instead of the metadata and metadata_json
+    arguments which are serialized strings).
     '''
     def create(self, *args, **kwargs):
         if 'meta' in kwargs:
-            from osso.sms.models import TextMessage
-            assert 'metadata' not in kwargs, 'Can\'t have both meta and metadata.'
-            meta = kwargs.pop('meta')
-            if meta not in (None, ''):
-                kwargs['metadata'] = pickle.dumpascii(meta)
+            from osso.sms.models import encode_meta
+            assert 'metadata' not in kwargs and 'metadata_json' not in kwargs, 'Can\'t have both meta and metadata.'
+            kwargs['metadata'], kwargs['metadata_json'] = encode_meta(
+                kwargs.pop('meta'))
 
         return super(TextMessageManager, self).create(*args, **kwargs)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textmessage',
+            name='claim',
+            field=models.CharField(default=b'', help_text='The token of the dispatcher that is sending this outbound message, if any.', max_length=32, db_index=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='textmessage',
+            name='claimed',
+            field=models.DateTimeField(help_text='When the dispatcher claimed the message. Claims that are too old are taken over.', null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0002_textmessage_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textmessage',
+            name='metadata_json',
+            field=models.TextField(default=b'', help_text='Optional metadata as JSON. By convention this is either empty or a list of dictionaries.', blank=True),
+        ),
+        migrations.AlterField(
+            model_name='textmessage',
+            name='metadata',
+            field=models.TextField(help_text='Optional metadata as a pickled python object. Obsolete, see metadata_json.', blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0003_textmessage_metadata_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textmessage',
+            name='batch',
+            field=models.CharField(default=b'', help_text='The reference of the batch that this outbound message was sent in, if any.', max_length=32, db_index=True, blank=True),
+        ),
+    ]
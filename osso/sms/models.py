@@ -1,4 +1,5 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
+import json
 import re
 
 from django.db import models
@@ -26,6 +27,8 @@ STATUS_CHOICES = (
 BLANK_RE = re.compile(r'\s+')
 NON_ALNUM_RE = re.compile(r'[^0-9A-Za-z]+')
 
+JSON_DECODER = json.JSONDecoder()
+
 
 class OperatorCountryCode(models.Model):
     '''
@@ -119,9 +122,22 @@ class TextMessage(models.Model):
         help_text=_('The delivery date. On an outbound message, this '
                     'should be set first on acknowledgement of receipt.'))
     metadata = models.TextField(blank=True,
-        help_text=_('Optional metadata as a pickled python object. By '
-                    'convention this is either None or a list of '
-                    'dictionaries.'))
+        help_text=_('Optional metadata as a pickled python object. '
+                    'Obsolete, see metadata_json.'))
+    metadata_json = models.TextField(blank=True, default='',
+        help_text=_('Optional metadata as JSON. By convention this is '
+                    'either empty or a list of dictionaries.'))
+    claim = models.CharField(max_length=32, blank=True, default='',
+        db_index=True,
+        help_text=_('The token of the dispatcher that is sending this '
+                    'outbound message, if any.'))
+    claimed = models.DateTimeField(blank=True, null=True,
+        help_text=_('When the dispatcher claimed the message. Claims '
+                    'that are too old are taken over.'))
+    batch = models.CharField(max_length=32, blank=True, default='',
+        db_index=True,
+        help_text=_('The reference of the batch that this outbound '
+                    'message was sent in, if any.'))
 
     objects = TextMessageManager()
 
@@ -129,31 +145,43 @@ class TextMessage(models.Model):
         self.connection = kwargs.pop('connection', None)
         super(TextMessage, self).__init__(*args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        # The meta value is decoded once and cached. Store the changes
+        # made to it in place, like those to any other field.
+        if self._meta_cached():
+            self.meta = self._meta_cache[1]
+        super(TextMessage, self).save(*args, **kwargs)
+
+    def _meta_cached(self):
+        cache = self.__dict__.get('_meta_cache')
+        return (cache is not None and
+                cache[0] == (self.metadata_json, self.metadata))
+
     def _meta_read(self):
-        if self.metadata == '':
-            return None
-        # Python pickle routines using protocol 0 use both low and high
-        # bytestring characters (<0x20 and >0x7f). We could do
-        #   return pickle.loads(self.metadata.encode('latin1'))
-        # here and
-        #   self.metadata = pickle.dumps(value).decode('latin1')
-        # in _meta_write. (latin1 is just an example, any encoding that
-        # uses the all 8bit characters is fine.) But then we still get
-        # the low ascii which is fragile in browser textboxes.
-        #
-        # See python issue http://bugs.python.org/issue2980 for the
-        # >0x7f part of the issue.
-        return pickle.loadascii(self.metadata)
+        # The decoded metadata is cached until one of the fields is set.
+        if self._meta_cached():
+            return self._meta_cache[1]
+
+        if self.metadata_json != '':
+            value = json.loads(self.metadata_json)
+        elif self.metadata != '':
+            # Not converted yet, see the convert_metadata_to_json
+            # command. Python pickle routines using protocol 0 use both
+            # low and high bytestring characters (<0x20 and >0x7f),
+            # which is why osso.core.pickle C-escapes them.
+            value = pickle.loadascii(self.metadata)
+        else:
+            value = None
+        self._meta_cache = ((self.metadata_json, self.metadata), value)
+        return value
 
     def _meta_write(self, value):
-        if value in (None, ''):
-            self.metadata = ''
-        else:
-            self.metadata = pickle.dumpascii(value)
+        self.metadata, self.metadata_json = encode_meta(value)
+        self._meta_cache = ((self.metadata_json, self.metadata), value)
 
     def _meta_delete(self):
-        self.metadata = ''
-    meta = property(_meta_read, _meta_write, _meta_delete, 'Get or set freeform metadata.')
+        self.metadata = self.metadata_json = ''
+    meta = property(_meta_read, _meta_write, _meta_delete, 'Get or set freeform metadata. Changes to the value are stored on save().')
 
     def meta_append(self, dict_or_none, commit=True):
         '''
@@ -162,16 +190,51 @@ class TextMessage(models.Model):
         commit is True.
         '''
         if dict_or_none is not None:
-            meta = self.meta
-            if meta is None:
-                meta = [dict_or_none]
+            appended = None
+            if self.metadata_json.startswith('[') and not self._meta_cached():
+                try:
+                    appended = dump_meta(dict_or_none)
+                except ValueError:
+                    pass  # the whole list becomes a pickle below
+            if appended:
+                # Append to the JSON list without decoding it.
+                self.metadata_json = '%s%s%s]' % (
+                    self.metadata_json[:-1],
+                    ('', ',')[self.metadata_json != '[]'],
+                    appended)
             else:
-                assert isinstance(meta, list), 'Expected meta to be a list of dictionaries, not %r.' % meta
-                meta.append(dict_or_none)
-            self.meta = meta
+                meta = self.meta
+                if meta is None:
+                    meta = [dict_or_none]
+                else:
+                    assert isinstance(meta, list), 'Expected meta to be a list of dictionaries, not %r.' % meta
+                    meta.append(dict_or_none)
+                self.meta = meta
         if commit:
             self.save()
 
+    def get_meta_options(self):
+        '''
+        Get the first metadata dictionary, which holds the options for
+        sending an outbound message (like the mollie2 'gateway'), or
+        None. Only that dictionary is decoded; it is for reading only.
+        '''
+        if self.metadata_json.startswith('[') and not self._meta_cached():
+            index = len(self.metadata_json) - len(
+                self.metadata_json[1:].lstrip())
+            try:
+                options = JSON_DECODER.raw_decode(self.metadata_json, index)[0]
+            except ValueError:
+                return None  # the empty list
+        else:
+            meta = self.meta
+            if not meta or not isinstance(meta, list):
+                return None
+            options = meta[0]
+        if not isinstance(options, dict):
+            return None
+        return options
+
     def create_reply(self, body):
         return TextMessage.objects.create(
             status='out',
@@ -330,6 +393,34 @@ class TextMessage(models.Model):
         )
 
 
+def dump_meta(value):
+    '''
+    Serialize TextMessage metadata to JSON. Raises ValueError if it
+    would not load as the same value: JSON has no dates, decimals,
+    tuples or non-string keys.
+    '''
+    if value in (None, ''):
+        return ''
+    try:
+        metadata_json = json.dumps(value, separators=(',', ':'))
+    except TypeError as e:
+        raise ValueError(str(e))
+    if json.loads(metadata_json) != value:
+        raise ValueError('%r does not survive JSON' % (value,))
+    return metadata_json
+
+
+def encode_meta(value):
+    '''
+    Serialize TextMessage metadata to the (metadata, metadata_json)
+    field values: JSON if dump_meta() can, a pickle otherwise.
+    '''
+    try:
+        return '', dump_meta(value)
+    except ValueError:
+        return pickle.dumpascii(value), ''
+
+
 class TextMessageExtra(models.Model):
     '''
     Model that contains SMS-provider specific information. The meta
@@ -0,0 +1,115 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+'''
+The thread pool behind the asynchronous sms backend interface.
+
+The backends spend nearly all their time waiting for the gateways, so
+the asynchronous calls run in a shared pool of SMS_POOL_SIZE threads
+(default 16) and return a result to get() later. A pool size of 0 runs
+the calls right away, in the calling thread.
+
+The pool threads have database connections of their own, so whatever
+they save is committed outside any transaction of the caller.
+'''
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils import six
+try:
+    from django.db import close_old_connections
+except ImportError:  # Django 1.5-
+    from django.db import close_connection as close_old_connections
+
+
+__all__ = ('SendResult', 'call_now', 'get_pool', 'submit')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''
+    Return the shared thread pool, or None if the calls should run
+    right away.
+    '''
+    global _pool
+    size = getattr(settings, 'SMS_POOL_SIZE', 16)
+    if not size:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(size)
+        return _pool
+
+
+def submit(func, *args, **kwargs):
+    '''
+    Call func in the pool. Returns a result with the ready(), wait()
+    and get() methods of a multiprocessing AsyncResult.
+    '''
+    pool = get_pool()
+    if pool is None:
+        return call_now(func, *args, **kwargs)
+    return pool.apply_async(_call, (func, args, kwargs))
+
+
+def call_now(func, *args, **kwargs):
+    '''
+    Call func right away, in the calling thread. Returns the result
+    like submit() does, for calls that do not block.
+    '''
+    try:
+        return DoneResult(func(*args, **kwargs))
+    except Exception:
+        return DoneResult(exc_info=sys.exc_info())
+
+
+def _call(func, args, kwargs):
+    # Like a request does, drop the database connection of this pool
+    # thread if it has gone bad or is too old (on Django 1.5- always).
+    close_old_connections()
+    return func(*args, **kwargs)
+
+
+class DoneResult(object):
+    '''
+    The result of a call that has completed already.
+    '''
+    def __init__(self, value=None, exc_info=None):
+        self.value = value
+        self.exc_info = exc_info
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.exc_info is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self.exc_info:
+            six.reraise(*self.exc_info)
+        return self.value
+
+
+class SendResult(object):
+    '''
+    The result of BaseSmsBackend.send_messages_async(): get() returns
+    the number of sent messages once all parts are done, or raises the
+    exception of the first part that failed.
+    '''
+    def __init__(self, parts=()):
+        self.parts = list(parts)
+
+    def ready(self):
+        return all(part.ready() for part in self.parts)
+
+    def wait(self, timeout=None):
+        for part in self.parts:
+            part.wait(timeout)
+
+    def get(self, timeout=None):
+        return sum(int(part.get(timeout)) for part in self.parts)
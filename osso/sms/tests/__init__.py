@@ -1,2 +1,8 @@
 # vim: set ts=8 sw=4 sts=4 et ai:
+from .test_dispatcher import *
 from .test_doctest import *
+from .test_gsmencoding import *
+from .test_httpclient import *
+from .test_metadata import *
+from .test_mollie2 import *
+from .test_pool import *
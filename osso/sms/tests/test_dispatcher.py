@@ -0,0 +1,167 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import logging
+import sys
+import threading
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from .. import BaseSmsBackend, DestinationError, get_connection
+from ..dispatcher import Dispatcher
+from ..models import TextMessage
+
+
+class RecordingSmsBackend(BaseSmsBackend):
+    '''
+    Records the sent messages and the threads that sent them, without
+    touching the database. Destinations in fail raise an error.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.fail = kwargs.pop('fail', ())
+        self.sent = []
+        self.threads = set()
+        super(RecordingSmsBackend, self).__init__(*args, **kwargs)
+
+    def send_messages(self, sms_messages, reply_to=None,
+                      shortcode_keyword=None, tariff_cent=None):
+        for message in sms_messages:
+            if message.remote_address in self.fail:
+                raise DestinationError('Destination fails')
+            message.status = 'ack'
+            self.sent.append(message.id)
+            self.threads.add(threading.current_thread().name)
+        return len(sms_messages)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class DispatcherTestCase(TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+        self.connection = get_connection(
+            'osso.sms.backends.sms_console.ConsoleSmsBackend',
+            stream=self.stream)
+        self.log = RecordingHandler()
+        logger = logging.getLogger('osso.sms.dispatcher')
+        logger.addHandler(self.log)
+        self.addCleanup(logger.removeHandler, self.log)
+
+    def create(self, remote_address, count=1, status='out'):
+        return [TextMessage.objects.create(
+                    status=status, local_address='TEST',
+                    remote_address=remote_address, body='body %d' % (i,))
+                for i in range(count)]
+
+    def test_run(self):
+        messages = self.create('+31501234567', 2) + self.create('+31612345678')
+        self.create('+31612345678', status='in')
+        dispatcher = Dispatcher(connection=self.connection, workers=0)
+        self.assertEqual(dispatcher.run(once=True), 3)
+        for message in messages:
+            message = TextMessage.objects.get(id=message.id)
+            self.assertEqual(message.status, 'ack')
+            self.assertEqual(message.claim, '')
+        self.assertEqual(self.stream.getvalue().count('body'), 3)
+
+    def test_claim(self):
+        messages = self.create('+31501234567', 5)
+        first = Dispatcher(connection=self.connection, batch_size=3)
+        second = Dispatcher(connection=self.connection, batch_size=3)
+        self.assertEqual([i.id for i in first.claim()],
+                         [i.id for i in messages[0:3]])
+        self.assertEqual([i.id for i in second.claim()],
+                         [i.id for i in messages[3:5]])
+        self.assertEqual(second.claim(), [])
+
+        # Claims of dispatchers that died are taken over.
+        TextMessage.objects.filter(claim=first.token).update(
+            claimed=timezone.now() - timedelta(seconds=600))
+        self.assertEqual([i.id for i in second.claim()],
+                         [i.id for i in messages[0:3]])
+
+        # But not while they are still sending them.
+        TextMessage.objects.filter(claim=second.token).update(
+            claimed=timezone.now() - timedelta(seconds=600))
+        second.refresh_claims(messages)
+        self.assertEqual(first.claim(), [])
+
+        second.release()
+        self.assertEqual(TextMessage.objects.exclude(claim='').count(), 0)
+
+    def test_backoff(self):
+        connection = RecordingSmsBackend(fail=('+31501234567',))
+        self.create('+31501234567', 2)
+        working = self.create('+31612345678', 2)
+        dispatcher = Dispatcher(connection=connection, workers=0,
+                                backoff=60, max_backoff=100)
+        dispatcher.dispatch(dispatcher.claim())
+        # The second message to the failing destination is not tried.
+        self.assertEqual(connection.sent, [i.id for i in working])
+        self.assertEqual(dispatcher.get_skipped_destinations(),
+                         ['+31501234567'])
+        self.assertEqual(
+            [i.getMessage() for i in self.log.records],
+            ['Got exception (dst +31501234567), skipping it for 60 '
+             'seconds: Destination fails'])
+        self.assertEqual(TextMessage.objects.exclude(claim='').count(), 0)
+        # This backend does not save, so only the failing destination
+        # is left out.
+        self.assertEqual(
+            [i.remote_address for i in dispatcher.claim()],
+            ['+31612345678', '+31612345678'])
+
+        # The next failure doubles the backoff, up to max_backoff.
+        until, failures = dispatcher.skip_destinations['+31501234567']
+        self.assertEqual(failures, 1)
+        dispatcher.skip_destinations['+31501234567'] = (
+            timezone.now(), failures)
+        dispatcher.release()
+        dispatcher.dispatch(dispatcher.claim())
+        until, failures = dispatcher.skip_destinations['+31501234567']
+        self.assertEqual(failures, 2)
+        self.assertTrue(timedelta(seconds=99) < until - timezone.now() <=
+                        timedelta(seconds=100))
+
+    def test_workers(self):
+        connection = RecordingSmsBackend()
+        messages = []
+        for i in range(10):
+            messages.extend(self.create('+3161234567%d' % (i,), 3))
+        # (and refresh the claims all the time)
+        dispatcher = Dispatcher(connection=connection, workers=3, rate=1000,
+                                concurrency=2, claim_timeout=0.03)
+        dispatcher.start()
+        try:
+            self.assertEqual(dispatcher.dispatch(dispatcher.claim()), 30)
+        finally:
+            dispatcher.shutdown()
+        self.assertEqual(sorted(connection.sent), [i.id for i in messages])
+        self.assertTrue(all(i.startswith('sms-dispatcher-')
+                            for i in connection.threads))
+        # Per destination, the messages are sent in order.
+        for i in range(10):
+            ids = [j.id for j in messages[(3 * i):(3 * i + 3)]]
+            self.assertEqual([j for j in connection.sent if j in ids], ids)
+
+    def test_command(self):
+        self.create('+31501234567', 2)
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, self.stream
+        try:
+            with self.settings(SMS_BACKEND=(
+                    'osso.sms.backends.sms_console.ConsoleSmsBackend')):
+                call_command('smsdispatch', once=True, workers=0, stdout=out)
+        finally:
+            sys.stdout = stdout
+        self.assertIn('Sent 2 messages', out.getvalue())
+        self.assertEqual(TextMessage.objects.filter(status='out').count(), 0)
@@ -0,0 +1,77 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import json
+import random
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.utils.six import StringIO
+
+from ..gsmencoding import pack7, unpack7
+
+
+class Pack7TestCase(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random(0x338)
+
+    def septets(self, length):
+        return bytes(bytearray(self.random.randint(0, 127)
+                               for i in range(length)))
+
+    def test_examples(self):
+        # E8 32 9B FD 06 DD DF 72 36 19
+        self.assertEqual(pack7(b'hello world'),
+                         b'\xe8\x32\x9b\xfd\x06\xdd\xdf\x72\x36\x19')
+        # D0 65 36 FB 0D BA BF E5 6C 32
+        self.assertEqual(pack7(b'hello world', 1),
+                         b'\xd0\x65\x36\xfb\x0d\xba\xbf\xe5\x6c\x32')
+        self.assertEqual(pack7(b''), b'')
+        self.assertEqual(unpack7(b''), b'')
+
+    def test_round_trip(self):
+        for length in range(0, 50):
+            for n in range(10):
+                septets = self.septets(length)
+                packed = pack7(septets)
+                self.assertEqual(len(packed), (7 * length + 7) // 8)
+                unpacked = unpack7(packed)
+                # the spare bits of the last octet may hold a septet
+                self.assertEqual(unpacked[0:length], septets)
+                self.assertEqual(unpacked[length:],
+                                 b'\x00' * (length % 8 == 7))
+
+    def test_left_pad(self):
+        for length in range(0, 50):
+            septets = self.septets(length)
+            for left_pad in range(1, 7):
+                packed = pack7(septets, left_pad)
+                self.assertEqual(len(packed),
+                                 (7 * length + left_pad + 7) // 8)
+                # align after a header of 7 - left_pad octets, like
+                # a UDH does
+                header = 7 - left_pad
+                unpacked = unpack7(b'\xff' * header + packed)
+                skip = (8 * header + left_pad) // 7
+                self.assertEqual(unpacked[skip:(skip + length)], septets)
+            # other paddings are no padding
+            for left_pad in (-1, 0, 7, 8):
+                self.assertEqual(pack7(septets, left_pad), pack7(septets))
+
+    def test_unpack7_octets(self):
+        for length in range(0, 50):
+            octets = bytes(bytearray(self.random.randint(0, 255)
+                                     for i in range(length)))
+            unpacked = unpack7(octets)
+            self.assertEqual(len(unpacked), length + length // 7)
+            if length % 7 == 0:
+                # otherwise the spare bits of the last octet are lost
+                self.assertEqual(pack7(unpacked), octets)
+
+
+class SmsBenchTestCase(SimpleTestCase):
+    def test_smsbench(self):
+        out = StringIO()
+        call_command('smsbench', iterations=2, size=[10, 100], stdout=out)
+        results = json.loads(out.getvalue())['results']
+        self.assertEqual(len(results), 16)
+        self.assertEqual(set(i['size'] for i in results), set([10, 100]))
+        self.assertIn('p99_us', results[0])
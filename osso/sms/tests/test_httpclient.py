@@ -0,0 +1,121 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import socket
+import threading
+
+from django.test import SimpleTestCase
+
+from ..httpclient import HttpClient, HTTPError, URLError
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # python3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append(self.path)
+        if self.path == '/?truncate':
+            # Fail halfway through the response.
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'200 GET')
+            self.close_connection = True
+            return
+        status = int(self.path.lstrip('/?') or 200)
+        body = ('%d %s' % (status, self.command)).encode('ascii')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.server.posted.append(self.rfile.read(length))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HttpClientTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = set()
+        self.server.posted = []
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % (self.server.server_address[1],)
+        self.client = HttpClient(maxsize=2, timeout=5, backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, b'200 GET')
+        response = self.client.post(self.url, {'a': 'b c'})
+        self.assertEqual(response.body, b'200 POST')
+        self.assertEqual(self.server.posted, [b'a=b+c'])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_concurrency(self):
+        responses = []
+
+        def get():
+            for i in range(5):
+                responses.append(self.client.get(self.url).status)
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(responses, [200] * 20)
+        # At most maxsize connections per host.
+        self.assertTrue(1 <= len(self.server.connections) <= 2)
+
+    def test_stale_connection(self):
+        self.client.get(self.url)
+        # The server drops the idle connection.
+        pool = self.client.get_pool('http', '127.0.0.1:%d' % (
+            self.server.server_address[1],))
+        pool.idle[0][0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.client.get(self.url).status, 200)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_no_retry_after_response(self):
+        self.client.get(self.url)
+        # The request may have been handled, it is not sent again.
+        self.assertRaises(URLError, self.client.get, self.url + '?truncate')
+        self.assertEqual(self.server.requests, ['/', '/?truncate'])
+
+    def test_errors(self):
+        response = self.client.get(self.url + '?503')
+        self.assertEqual(response.status, 503)
+        self.assertRaises(HTTPError, response.raise_for_status)
+        self.assertRaises(URLError, self.client.get, 'ftp://127.0.0.1/')
+
+        # Nothing listens here (any more).
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.assertRaises(URLError, self.client.get,
+                          'http://127.0.0.1:%d/' % (port,))
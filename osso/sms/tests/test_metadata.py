@@ -0,0 +1,106 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import datetime
+from decimal import Decimal
+
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from osso.core import pickle
+
+from ..management.commands.convert_metadata_to_json import Command
+from ..models import TextMessage
+
+
+class MetadataTestCase(TestCase):
+    def create(self, **kwargs):
+        return TextMessage.objects.create(
+            status='out', local_address='TEST',
+            remote_address='+31612345678', body='Hello', **kwargs)
+
+    def test_meta(self):
+        message = self.create(meta=[{'gateway': 1}])
+        self.assertEqual(message.metadata, '')
+        self.assertEqual(message.metadata_json, '[{"gateway":1}]')
+
+        message = TextMessage.objects.get(id=message.id)
+        message.meta_append({'mollie_status': 50}, commit=False)
+        self.assertEqual(message.metadata_json,
+                         '[{"gateway":1},{"mollie_status":50}]')
+        meta = message.meta
+        self.assertEqual(meta, [{'gateway': 1}, {'mollie_status': 50}])
+        self.assertTrue(message.meta is meta)  # decoded once
+
+        # Changes in place are stored on save.
+        meta[0]['gateway'] = 2
+        message.save()
+        self.assertEqual(TextMessage.objects.get(id=message.id).meta,
+                         [{'gateway': 2}, {'mollie_status': 50}])
+
+        del message.meta
+        self.assertEqual(message.meta, None)
+        message.meta_append({'mollie_status': 50}, commit=False)
+        self.assertEqual(message.meta, [{'mollie_status': 50}])
+        message.meta = {'not': 'a list'}
+        self.assertRaises(AssertionError, message.meta_append, {})
+
+    def test_not_json(self):
+        # Values that JSON would change are pickled instead.
+        received = datetime.datetime(2010, 2, 1, 12, 0)
+        message = self.create(meta=[{'mollie_status': 50}])
+        message.meta_append({'prev_delivery_date': received})
+        self.assertEqual(message.metadata_json, '')
+
+        message = TextMessage.objects.get(id=message.id)
+        self.assertEqual(
+            message.meta,
+            [{'mollie_status': 50}, {'prev_delivery_date': received}])
+        self.assertEqual(message.get_meta_options(), {'mollie_status': 50})
+        for meta in ((1, 2), {1: 'a'}, [{'amount': Decimal('1.5')}]):
+            message.meta = meta
+            self.assertEqual(message.metadata_json, '')
+            self.assertEqual(message.meta, meta)
+
+    def test_get_meta_options(self):
+        message = self.create()
+        self.assertEqual(message.get_meta_options(), None)
+        for metadata_json, options in (
+                ('[]', None),
+                ('[1, {"gateway": 2}]', None),
+                ('[ {"gateway": 2}, {"mollie_status": 50}]', {'gateway': 2}),
+                # Only the first dictionary is decoded.
+                ('[{"gateway": 2}, not json', {'gateway': 2})):
+            message.metadata_json = metadata_json
+            self.assertEqual(message.get_meta_options(), options)
+
+        message.metadata_json = ''
+        message.metadata = pickle.dumpascii([{'gateway': 3}])
+        self.assertEqual(message.get_meta_options(), {'gateway': 3})
+
+    def test_convert(self):
+        pickled = self.create(metadata=pickle.dumpascii(
+            [{'mollie_id': u'ab\xe9', 'mollie_id_used': 2}]))
+        unconvertible = self.create(metadata=pickle.dumpascii([set([1])]))
+        lossy = self.create(metadata=pickle.dumpascii(
+            [{'prev_delivery_date': datetime.datetime(2010, 2, 1)}]))
+        empty = self.create()
+        self.assertEqual(
+            TextMessage.objects.get(id=pickled.id).meta,
+            [{'mollie_id': u'ab\xe9', 'mollie_id_used': 2}])
+
+        # Call handle() directly: Django 1.4 and 1.5 turn a CommandError
+        # raised through call_command() into a SystemExit.
+        self.assertRaisesRegexp(
+            CommandError,
+            r'messages %d, %d\.$' % (unconvertible.id, lossy.id),
+            Command().handle, batch_size=1, verbosity=0)
+
+        message = TextMessage.objects.get(id=pickled.id)
+        self.assertEqual(message.metadata, '')
+        self.assertEqual(message.meta,
+                         [{'mollie_id': u'ab\xe9', 'mollie_id_used': 2}])
+        self.assertNotEqual(
+            TextMessage.objects.get(id=unconvertible.id).metadata, '')
+        self.assertEqual(
+            TextMessage.objects.get(id=lossy.id).meta,
+            [{'prev_delivery_date': datetime.datetime(2010, 2, 1)}])
+        self.assertEqual(TextMessage.objects.get(id=empty.id).meta, None)
@@ -0,0 +1,283 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+from osso.aboutconfig.models import Item
+from osso.aboutconfig.utils import aboutconfig
+from osso.relation.models import Country
+
+from ..backends.sms_mollie2 import MollieSmsBackend
+from ..backends.sms_mollie2.dlrqueue import apply_reports, drain, enqueue
+from ..backends.sms_mollie2.forms import (
+    DeliveryReportForm, QueuedDeliveryReportForm)
+from ..backends.sms_mollie2.routing import (
+    GATEWAY_PREFIX, RoutingTable, routing_table)
+from ..httpclient import HttpResponse
+from ..models import Operator, OperatorCountryCode, TextMessage
+
+try:
+    from urlparse import parse_qs, urlsplit
+except ImportError:  # python3
+    from urllib.parse import parse_qs, urlsplit
+
+
+RESPONSE = '''<?xml version="1.0"?>
+<response>
+ <item type="sms">
+  <recipients>%d</recipients>
+  <success>%s</success>
+  <resultcode>%d</resultcode>
+  <resultmessage>%s</resultmessage>
+ </item>
+</response>'''
+
+
+class FakeHttpClient(object):
+    def __init__(self, success=True):
+        self.success = success
+        self.requests = []
+        self.threads = set()
+
+    def get(self, url):
+        args = dict((key, value[0]) for key, value in
+                    parse_qs(urlsplit(url).query).items())
+        self.requests.append(args)
+        self.threads.add(threading.current_thread())
+        if self.success:
+            body = RESPONSE % (len(args['recipients'].split(',')), 'true',
+                               10, 'Message successfully sent.')
+        else:
+            body = RESPONSE % (0, 'false', 20, 'No username given.')
+        return HttpResponse(url, 200, 'OK', {}, body)
+
+
+class MollieBatchTestCase(TestCase):
+    def create(self, remote_address, body='Hello world', status='out'):
+        return TextMessage.objects.create(
+            status=status, local_address='TEST',
+            remote_address=remote_address, body=body)
+
+    def test_batch(self):
+        messages = [self.create(i) for i in (
+            '+31612345670', '+31612345671', '+31612345670',  # again
+            '+31612345672', '+31612345673', '+31612345674')]
+        messages.append(self.create('+31612345670', body='Bye'))
+        http_client = FakeHttpClient()
+        backend = MollieSmsBackend(http_client=http_client)
+        backend.max_recipients = 3
+
+        self.assertEqual(backend.send_messages(messages), 7)
+        self.assertEqual(
+            [(i['recipients'], i['reference'], i['message'])
+             for i in http_client.requests],
+            [('+31612345670,+31612345671',
+              '%d-%d' % (messages[0].id, messages[1].id), 'Hello world'),
+             ('+31612345670,+31612345672,+31612345673',
+              '%d-%d' % (messages[2].id, messages[4].id), 'Hello world'),
+             ('+31612345674', str(messages[5].id), 'Hello world'),
+             ('+31612345670', str(messages[6].id), 'Bye')])
+        self.assertEqual(
+            TextMessage.objects.filter(status='pnd').count(), 7)
+        self.assertTrue(all(i.status == 'pnd' for i in messages))
+        self.assertEqual(
+            [i.batch for i in TextMessage.objects.filter(
+                id__in=[j.id for j in messages]).order_by('id')],
+            2 * [http_client.requests[0]['reference']] +
+            3 * [http_client.requests[1]['reference']] + ['', ''])
+        # With the default pool size, in the calling thread still (the
+        # database of the tests is not shared with the pool threads).
+        self.assertEqual(http_client.threads, set([threading.current_thread()]))
+
+    @override_settings(SMS_POOL_SIZE=0)
+    def test_send_messages_async(self):
+        messages = [self.create('+3161234567%d' % (i,)) for i in range(3)]
+        http_client = FakeHttpClient()
+        backend = MollieSmsBackend(http_client=http_client)
+        self.assertEqual(backend.send_messages_async(messages).get(), 3)
+        self.assertEqual(len(http_client.requests), 1)
+
+    def test_batch_failure(self):
+        messages = [self.create('+3161234567%d' % (i,)) for i in range(2)]
+        backend = MollieSmsBackend(http_client=FakeHttpClient(False),
+                                   fail_silently=True)
+        self.assertEqual(backend.send_messages(messages), 0)
+        self.assertEqual(
+            TextMessage.objects.filter(status='nak').count(), 2)
+
+    def test_delivery_report(self):
+        messages = [self.create('+3161234567%d' % (i,), status='pnd')
+                    for i in range(3)]
+        reference = '%d-%d' % (messages[0].id, messages[2].id)
+        TextMessage.objects.update(batch=reference)
+        form = DeliveryReportForm(data={
+            'reference': reference, 'recipient': '31612345671',
+            'status': '50'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.save().id, messages[1].id)
+        self.assertEqual(
+            TextMessage.objects.get(id=messages[1].id).status, 'ack')
+
+        form = DeliveryReportForm(data={
+            'reference': reference, 'recipient': '31612345679',
+            'status': '50'})
+        self.assertFalse(form.is_valid())
+
+    def test_delivery_report_batches(self):
+        # A message of an earlier batch that failed is in the id range
+        # of the next batch, with the same recipient and body.
+        messages = [self.create(i) for i in (
+            '+31612345670', '+31612345671', '+31612345670')]
+        http_client = FakeHttpClient(False)
+        backend = MollieSmsBackend(http_client=http_client,
+                                   fail_silently=True)
+        self.assertEqual(backend.send_messages(messages[0:2]), 0)
+        http_client.success = True
+        self.assertEqual(backend.send_messages(messages[1:3]), 2)
+        first, second = [i['reference'] for i in http_client.requests]
+        self.assertEqual(second, '%d-%d' % (messages[1].id, messages[2].id))
+
+        form = DeliveryReportForm(data={
+            'reference': second, 'recipient': '31612345670',
+            'status': '50'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.save().id, messages[2].id)
+        form = DeliveryReportForm(data={
+            'reference': first, 'recipient': '31612345671',
+            'status': '50'})
+        self.assertFalse(form.is_valid())  # it was sent again
+
+        # Ambiguous references are rejected, not guessed.
+        TextMessage.objects.filter(id=messages[0].id).update(
+            status='pnd', batch=second)
+        self.assertFalse(DeliveryReportForm(data={
+            'reference': second, 'recipient': '31612345670',
+            'status': '50'}).is_valid())
+        self.assertEqual(apply_reports([
+            {'reference': second, 'recipient': '+31612345670',
+             'status': 50, 'received': '2017-01-01T12:00:00.000000'},
+            {'reference': second, 'recipient': '+31612345671',
+             'status': 50, 'received': '2017-01-01T12:00:00.000000'}
+        ])[0], 1)
+        self.assertEqual(
+            [i.status for i in TextMessage.objects.filter(
+                id__in=[j.id for j in messages]).order_by('id')],
+            ['pnd', 'ack', 'ack'])
+
+
+class RoutingTableTestCase(TestCase):
+    def setUp(self):
+        self.routing_table = RoutingTable()
+        # Django 1.6- loads the countries from the initial_data fixtures.
+        nl = Country.objects.get_or_create(
+            code='nl', defaults={'name': 'NL'})[0]
+        be = Country.objects.get_or_create(
+            code='be', defaults={'name': 'BE'})[0]
+        OperatorCountryCode.objects.get_or_create(country=nl, code=204)
+        OperatorCountryCode.objects.get_or_create(country=be, code=206)
+        self.kpn = Operator.objects.create(country=nl, code=8)
+        self.vodafone = Operator.objects.create(country=nl, code=4)
+        self.proximus = Operator.objects.create(country=be, code=1)
+
+    def test_routing(self):
+        Item.objects.create(key=GATEWAY_PREFIX + '204.04', value='1')
+        Item.objects.create(key=GATEWAY_PREFIX + '206', value='50')
+        with self.assertNumQueries(3):
+            self.assertEqual(
+                [self.routing_table.get_gateway(i) for i in (
+                    self.kpn.id, self.vodafone.id, self.proximus.id, None)],
+                [None, '1', '50', None])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.routing_table.get_gateway(self.vodafone.id), '1')
+
+    def test_refresh(self):
+        self.assertEqual(routing_table.get_gateway(self.kpn.id), None)
+        aboutconfig(GATEWAY_PREFIX + '204.08', '2', set=True)
+        self.assertEqual(routing_table.get_gateway(self.kpn.id), '2')
+        Item.objects.filter(key=GATEWAY_PREFIX + '204.08').get().delete()
+        self.assertEqual(routing_table.get_gateway(self.kpn.id), None)
+
+    def test_get_gateway(self):
+        Item.objects.create(key=GATEWAY_PREFIX + '204.04', value='1')
+        message = TextMessage.objects.create(
+            status='out', local_address='TEST', remote_address='+31612345678',
+            remote_operator=self.vodafone, body='Hello')
+        backend = MollieSmsBackend(http_client=FakeHttpClient())
+        self.assertEqual(backend.get_gateway(message), '1')
+        message.remote_operator = self.kpn
+        self.assertEqual(backend.get_gateway(message), '2')  # the default
+
+
+class DeliveryReportQueueTestCase(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'dlr.queue')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create(self, remote_address, status='pnd'):
+        return TextMessage.objects.create(
+            status=status, local_address='TEST',
+            remote_address=remote_address, body='Hello world')
+
+    def report(self, reference, recipient, status):
+        form = QueuedDeliveryReportForm(data={
+            'reference': reference, 'recipient': recipient,
+            'status': status})
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+    def test_drain(self):
+        messages = [self.create('+3161234567%d' % (i,)) for i in range(4)]
+        inbound = self.create('+31612345679', status='in')
+        batch = '%d-%d' % (messages[1].id, messages[3].id)
+        TextMessage.objects.filter(id__in=[i.id for i in messages[1:]]).update(
+            batch=batch)
+        with override_settings(SMS_DLR_SPOOL=self.path):
+            with self.assertNumQueries(0):
+                self.report(str(messages[0].id), '31612345670', '50')
+                self.report(batch, '31612345672', '52')  # pending
+                self.report(batch, '31612345671', '55')
+                self.report(batch, '31612345672', '50')
+                self.report(batch, '31612345673', '50')
+                self.report(batch, '31612345673', '51')  # too late
+                self.report(str(inbound.id), '31612345679', '50')
+                self.report(batch, '31612345679', '50')
+            self.assertFalse(QueuedDeliveryReportForm(data={
+                'reference': '1-', 'recipient': '31612345670',
+                'status': '50'}).is_valid())
+
+            out = StringIO()
+            stdout, sys.stdout = sys.stdout, out
+            try:
+                call_command('sms', 'draindlr')
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(out.getvalue(),
+                         'Applied 4 delivery reports, rejected 2.\n')
+        self.assertEqual(
+            [(i.status, bool(i.delivery_date)) for i in
+             TextMessage.objects.filter(id__in=[j.id for j in messages])
+             .order_by('id')],
+            [('ack', True), ('nak', True), ('ack', True), ('ack', True)])
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_leftover(self):
+        message = self.create('+31612345670', status='out')
+        enqueue(str(message.id), '+31612345670', 51, path=self.path)
+        # A drainer died while applying this file.
+        os.rename(self.path, self.path + '.1.draining')
+        enqueue(str(message.id), '+31612345670', 50, path=self.path)
+        self.assertEqual(drain(self.path), (2, 0))
+        self.assertEqual(TextMessage.objects.get(id=message.id).status,
+                         'ack')
+        self.assertEqual(drain(self.path), (0, 0))
@@ -0,0 +1,75 @@
+# vim: set ts=8 sw=4 sts=4 et ai:
+import threading
+import time
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from .. import BaseSmsBackend, DestinationError, get_connection_async
+from ..backends.sms_console import ConsoleSmsBackend
+from ..pool import SendResult, submit
+
+
+class BarrierSmsBackend(BaseSmsBackend):
+    '''
+    Waits until all messages are being sent at the same time, without
+    touching the database.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.barrier = kwargs.pop('barrier')
+        super(BarrierSmsBackend, self).__init__(*args, **kwargs)
+
+    def send_messages(self, sms_messages, reply_to=None,
+                      shortcode_keyword=None, tariff_cent=None):
+        if any(i == 'fail' for i in sms_messages):
+            raise DestinationError('Destination fails')
+        self.barrier.wait()
+        return len(sms_messages)
+
+
+class Barrier(object):
+    # (threading.Barrier is python3 only)
+    def __init__(self, parties):
+        self.parties = parties
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.parties -= 1
+            self.condition.notify_all()
+            deadline = time.time() + 5
+            while self.parties > 0:
+                if time.time() > deadline:
+                    raise RuntimeError('Not all parties arrived')
+                self.condition.wait(0.1)
+
+
+@override_settings(SMS_POOL_SIZE=8)
+class PoolTestCase(SimpleTestCase):
+    def test_send_messages_async(self):
+        backend = BarrierSmsBackend(barrier=Barrier(4))
+        result = SendResult([
+            backend.send_messages_async(['a', 'b']),
+            backend.send_messages_async(['c']),
+            backend.send_messages_async(['d']),
+            backend.send_messages_async(['e'])])
+        # All four calls are in flight at once, or the barrier fails.
+        self.assertEqual(result.get(10), 5)
+        self.assertTrue(result.ready())
+
+        result = backend.send_messages_async(['fail'])
+        self.assertRaises(DestinationError, result.get, 10)
+
+    @override_settings(SMS_POOL_SIZE=0)
+    def test_call_now(self):
+        result = submit(len, 'abc')
+        self.assertTrue(result.ready())
+        self.assertEqual(result.get(), 3)
+        result = submit(int, 'abc')
+        self.assertFalse(result.successful())
+        self.assertRaises(ValueError, result.get)
+
+    def test_get_connection_async(self):
+        result = get_connection_async(
+            'osso.sms.backends.sms_console.ConsoleSmsBackend')
+        self.assertIsInstance(result.get(10), ConsoleSmsBackend)
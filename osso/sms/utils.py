@@ -3,13 +3,20 @@ try:
     u = unicode
 except NameError:
     u = str
+from collections import namedtuple
 
 from osso.sms import gsmencoding
 
 
-__all__ = ('gsmencoding', 'sms_bodies_needed', 'sms_split')
+__all__ = ('gsmencoding', 'sms_bodies_needed', 'sms_split',
+           'sms_split_parts', 'SmsPart')
 gsmencoding  # touch for PEP
 
+# A part of a message: the text, the encoded user data (GSM 03.38
+# septets, one per byte and not packed, or UTF-16 big endian) and the
+# name of that encoding.
+SmsPart = namedtuple('SmsPart', ('text', 'payload', 'encoding'))
+
 
 def sms_bodies_needed(number_of_bytes, single_sms_len=160, multi_sms_len=153):
     '''
@@ -153,3 +160,105 @@ def sms_split(message, single_sms_len=160, multi_sms_len=153):
     # It wasn't. Split the message the old fashioned way.
     return [message[i:(i + multi_sms_len)].decode('gsm-0338')
             for i in range(0, len(message), multi_sms_len)]
+
+
+def sms_split_parts(message, udh_length=6, ucs2=True):
+    '''
+    Split a text message in the parts of a (concatenated) SMS and
+    return them as SmsPart tuples, with the payload already encoded.
+
+    The encoding is GSM 03.38 if all characters are in that character
+    set and UCS-2 (UTF-16) otherwise. With ucs2=False, GSM 03.38 is
+    always used and unknown characters are replaced. An SMS holds 140
+    octets: 160 septets or 70 UTF-16 units. When the message needs
+    more, every part loses udh_length octets (6 for the concatenation
+    header with an 8-bit reference) to the user data header.
+
+    The parts are measured as slices of the text, with the length
+    functions of the codecs, not character by character. The two septet
+    escape sequences and UTF-16 surrogate pairs are never split. Phones
+    join the parts again, so words may be split.
+
+    >>> from .utils import sms_split_parts
+    >>> sms_split_parts(u'')
+    []
+    >>> [(len(i.text), len(i.payload), i.encoding)
+    ...  for i in sms_split_parts(u'x' * 160)]
+    [(160, 160, 'gsm-0338')]
+    >>> [(len(i.text), len(i.payload))
+    ...  for i in sms_split_parts(u'x' * 152 + u'[' + u'x' * 8)]
+    [(152, 152), (9, 10)]
+    >>> [len(i.payload) for i in sms_split_parts(u'x' * 161, udh_length=7)]
+    [152, 9]
+    >>> parts = sms_split_parts(u'x' * 66 + u'\\u20ac\\u0100')
+    >>> [(len(i.text), len(i.payload), i.encoding) for i in parts]
+    [(68, 136, 'utf-16be')]
+    >>> parts = sms_split_parts(u'x' * 70 + u'\\u0100')
+    >>> [(len(i.text), len(i.payload)) for i in parts]
+    [(67, 134), (4, 8)]
+    >>> parts = sms_split_parts(u'x' * 66 + u'\\U0001f600' + u'x' * 4)
+    >>> [len(i.payload) for i in parts]
+    [132, 12]
+    >>> [str(i.text) for i in sms_split_parts(u'a\\u0100', ucs2=False)]
+    ['a?']
+    >>> sms_split_parts(u'@')[0].payload == b'\\x00'
+    True
+    '''
+    message = u(message)
+    if not message:
+        return []
+
+    encoding = 'gsm-0338'
+    try:
+        gsmencoding.encode(message)
+    except UnicodeEncodeError:
+        if ucs2:
+            encoding = 'utf-16be'
+        else:
+            message = gsmencoding.encode(message, 'replace')[0]
+            message = gsmencoding.decode(message)[0]
+
+    if encoding == 'gsm-0338':
+        single_len, multi_len = 160, (140 - udh_length) * 8 // 7
+    else:
+        single_len, multi_len = 70, (140 - udh_length) // 2
+    if _payload_length(message, encoding) <= single_len:
+        return [SmsPart(message, _encode(message, encoding), encoding)]
+
+    ret = []
+    start, j = 0, len(message)
+    while start < j:
+        # take as many characters as there are septets or units in a
+        # part and drop one character per septet or unit too many
+        end = min(start + multi_len, j)
+        excess = _payload_length(message[start:end], encoding) - multi_len
+        while excess > 0:
+            end -= excess
+            excess = (_payload_length(message[start:end], encoding) -
+                      multi_len)
+        # fill up the room that dropping two septet escapes left
+        while (end < j and _payload_length(message[start:(end + 1)],
+                                           encoding) <= multi_len):
+            end += 1
+        if u'\ud800' <= message[end - 1] < u'\udc00' and end - 1 > start:
+            end -= 1  # a narrow build splits surrogate pairs
+        text = message[start:end]
+        ret.append(SmsPart(text, _encode(text, encoding), encoding))
+        start = end
+    return ret
+
+
+def _payload_length(message, encoding):
+    if encoding == 'gsm-0338':
+        # without the 0x0d that encode() adds after a final @
+        return gsmencoding.encoded_length(message) - message.endswith(u'@')
+    return len(message.encode(encoding)) // 2
+
+
+def _encode(text, encoding):
+    if encoding == 'gsm-0338':
+        payload = gsmencoding.encode(text, 'replace')[0]
+        if text.endswith(u'@'):
+            payload = payload[0:-1]  # the 0x0d is only for pack7
+        return payload
+    return text.encode(encoding)